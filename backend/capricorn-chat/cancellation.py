@@ -0,0 +1,103 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cooperative cancellation for work whose client has gone away.
+
+Each Cloud Function deploys from its own directory, so this module is copied
+into every function that uses it. Keep the copies identical.
+
+A streaming response creates one CancellationToken per request and cancels it
+when its generator is closed (client disconnect or a broken write). Code that
+waits or iterates on the request's behalf checks the token, so queued model
+calls never start, backoff sleeps end early and streaming iterators are
+closed instead of drained. The token also counts the work that was avoided.
+"""
+
+import threading
+
+
+class Cancelled(Exception):
+    """Raised inside work abandoned because its request was cancelled."""
+
+
+class CancellationToken:
+    """Thread-safe cancel flag with counters for the calls and tokens it saved."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self.reason = None
+        self.avoided_calls = 0
+        self.abandoned_streams = 0
+        self.avoided_input_tokens = 0
+        self.avoided_output_tokens = 0
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="client_disconnected"):
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+        self._event.set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+    def wait(self, timeout):
+        """Sleep up to timeout seconds; returns True early if cancelled."""
+        return self._event.wait(timeout)
+
+    def record_avoided(self, calls=0, input_tokens=0, output_tokens=0):
+        """Count model calls that were never issued and their estimated input tokens.
+
+        output_tokens estimates what an abandoned stream would still have generated.
+        """
+        with self._lock:
+            self.avoided_calls += calls
+            self.avoided_input_tokens += input_tokens
+            self.avoided_output_tokens += output_tokens
+
+    def iterate(self, iterator):
+        """Yield from a streaming response until cancelled, then close it instead of draining it.
+
+        Closing this generator early (e.g. from a consumer that was itself closed)
+        also closes the response; either way a cancelled stream counts as abandoned.
+        """
+        finished = False
+        try:
+            for item in iterator:
+                self.raise_if_cancelled()
+                yield item
+            finished = True
+        finally:
+            if not finished and self._event.is_set():
+                with self._lock:
+                    self.abandoned_streams += 1
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cancelled": self._event.is_set(),
+                "reason": self.reason,
+                "avoided_calls": self.avoided_calls,
+                "abandoned_streams": self.abandoned_streams,
+                "avoided_input_tokens_estimate": self.avoided_input_tokens,
+                "avoided_output_tokens_estimate": self.avoided_output_tokens,
+            }
@@ -0,0 +1,230 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rolling compaction of chat history.
+
+A chat's Firestore messages hold the initial case, the retrieved articles
+(document messages, full texts included), the final analysis and the
+follow-up turns. Sending all of it on every turn makes each question cost
+more than the last. HistoryCompactor keeps the case and the final analysis
+verbatim, keeps the last few turns verbatim, and replaces everything else
+with a summary stored next to the chat (conversations/{chat}/compaction/summary).
+
+The summary records how many leading messages it covers and a fingerprint of
+them. When turns roll out of the verbatim window, only the newly rolled-out
+messages are folded into the stored summary; if the covered messages changed
+(e.g. articles were re-analyzed) the summary is rebuilt from scratch.
+"""
+
+import hashlib
+import json
+import logging
+import math
+
+from google.cloud import firestore
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+# Messages that are always sent verbatim, wherever they appear
+PINNED_TYPES = ("initial_case", "analysis")
+# Messages that are summarized even when they fall inside the verbatim window
+BULK_TYPES = ("document",)
+
+SUMMARY_PROMPT = """You maintain the working memory of a tumor-board discussion about one pediatric oncology case.
+
+{existing}Fold the new material below into a single updated summary. Use these markdown sections:
+
+### Articles
+One bullet per research article: PMCID, title, year, and the findings relevant to the case (populations, interventions, results with numbers, warnings). Keep every PMCID that has been discussed or could support a recommendation.
+
+### Discussion So Far
+The questions asked, the answers and recommendations given (with their supporting PMCIDs), decisions made and open questions.
+
+Be factual and concise, preserve numbers and PMCIDs exactly, and do not add information that is not in the material. Return only the summary.
+
+<New Material>
+{material}
+</New Material>"""
+
+
+def message_text(message):
+    """Text of a stored message; structured contents are sent as JSON."""
+    content = message.get('content')
+    if isinstance(content, str):
+        return content
+    if isinstance(content, dict) and isinstance(content.get('markdown_content'), str):
+        return content['markdown_content']
+    return json.dumps(content, default=str)
+
+
+def document_articles(message):
+    """Articles of a document message, or None if it is not one.
+
+    The frontend stores them as one JSON string: {"articles": [...], "currentProgress": ...}.
+    """
+    if message.get('type') not in BULK_TYPES:
+        return None
+    content = message.get('content')
+    if isinstance(content, str):
+        try:
+            content = json.loads(content)
+        except ValueError:
+            return None
+    articles = content.get('articles') if isinstance(content, dict) else None
+    if not isinstance(articles, list):
+        return None
+    return [article for article in articles if isinstance(article, dict)]
+
+
+def article_material(number, article, max_chars):
+    """One article for the summarizer: all of its metadata, its text cut to max_chars."""
+    metadata = {key: value for key, value in article.items() if key != 'content'}
+    text = article.get('content') or ''
+    if not isinstance(text, str):
+        text = json.dumps(text, default=str)
+    if len(text) > max_chars:
+        text = text[:max_chars] + "\n[... rest of the article omitted ...]"
+    return f"Article {number}: {json.dumps(metadata, default=str)}\n{text}"
+
+
+def message_role(message):
+    return "user" if message.get('role') == 'user' else "model"
+
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 characters per token)."""
+    return math.ceil(len(text or "") / 4)
+
+
+def fingerprint(messages):
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(json.dumps([message.get('role'), message.get('type'), message_text(message)]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class HistoryCompactor:
+    """Builds the (role, text) history for a chat turn, compacting what falls out of the window."""
+
+    def __init__(self, client, model, verbatim_turns=3, compact_every_turns=2,
+                 max_summary_tokens=4096, max_message_chars=400000, min_article_chars=4000):
+        self.client = client
+        self.model = model
+        self.verbatim_turns = verbatim_turns
+        self.compact_every_turns = compact_every_turns
+        self.max_summary_tokens = max_summary_tokens
+        # A single stored message is cut to this for the summarizer. A document message
+        # splits it between its articles' texts instead, never below min_article_chars
+        # each, so every article and its metadata reach the summary.
+        self.max_message_chars = max_message_chars
+        self.min_article_chars = min_article_chars
+
+    def summary_ref(self, chat_ref):
+        return chat_ref.collection('compaction').document('summary')
+
+    def cut_index(self, messages, covered):
+        """Number of leading messages to summarize; moves in steps so the summary is not redone every turn."""
+        last_bulk = max((idx + 1 for idx, message in enumerate(messages)
+                         if message.get('type') in BULK_TYPES), default=0)
+        window = 2 * self.verbatim_turns
+        if len(messages) - max(covered, last_bulk) <= window + 2 * self.compact_every_turns:
+            # Still within the window plus its slack: keep the current cut
+            return max(covered, last_bulk)
+        return max(len(messages) - window, last_bulk)
+
+    def load_summary(self, chat_ref, messages):
+        """Return the stored summary state if it still matches the chat's messages."""
+        try:
+            doc = self.summary_ref(chat_ref).get()
+        except Exception as e:
+            logger.warning(f"Could not read chat summary: {str(e)}")
+            return None
+        if not doc.exists:
+            return None
+        state = doc.to_dict()
+        covered = state.get('covered_messages', 0)
+        if (state.get('model') != self.model or covered > len(messages)
+                or state.get('fingerprint') != fingerprint(messages[:covered])):
+            return None
+        return state
+
+    def message_material(self, message):
+        """Text of one message as the summarizer sees it."""
+        header = f"[{message.get('role', 'user')} / {message.get('type', 'message')}]"
+        articles = document_articles(message)
+        if not articles:
+            return f"{header}\n{message_text(message)[:self.max_message_chars]}"
+        article_chars = max(self.min_article_chars, self.max_message_chars // len(articles))
+        return "\n\n".join([header] + [article_material(number, article, article_chars)
+                                       for number, article in enumerate(articles, 1)])
+
+    def summarize(self, summary, messages):
+        """Fold messages into summary (or start a new one) with the summary model."""
+        material = "\n\n".join(self.message_material(message) for message in messages)
+        existing = f"The current summary is:\n<Summary>\n{summary}\n</Summary>\n\n" if summary else ""
+        response = self.client.models.generate_content(
+            model=self.model,
+            contents=[types.Content(role="user", parts=[types.Part.from_text(
+                text=SUMMARY_PROMPT.format(existing=existing, material=material))])],
+            config=types.GenerateContentConfig(temperature=0, max_output_tokens=self.max_summary_tokens),
+        )
+        text = (response.text or '').strip()
+        if not text:
+            raise ValueError("Empty summary from Gemini")
+        return text
+
+    def build_history(self, chat_ref, messages):
+        """Return (history, stats): (role, text) pairs to send before the new message.
+
+        Falls back to the uncompacted history if no summary can be produced.
+        """
+        full_tokens = sum(estimate_tokens(message_text(message)) for message in messages)
+        state = self.load_summary(chat_ref, messages)
+        summary = state.get('summary') if state else None
+        covered = state.get('covered_messages', 0) if state else 0
+        cut = self.cut_index(messages, covered)
+        stats = {"messages": len(messages), "full_tokens_estimate": full_tokens,
+                 "summary_reused": bool(summary), "summarized_messages": 0}
+
+        new_material = [message for message in messages[covered:cut] if message.get('type') not in PINNED_TYPES]
+        if new_material:
+            try:
+                summary = self.summarize(summary, new_material)
+                covered = cut
+                stats["summarized_messages"] = len(new_material)
+                self.summary_ref(chat_ref).set({
+                    'summary': summary,
+                    'covered_messages': covered,
+                    'fingerprint': fingerprint(messages[:covered]),
+                    'model': self.model,
+                    'updated_at': firestore.SERVER_TIMESTAMP,
+                })
+            except Exception as e:
+                # Keep what the stored summary covers and send the rest verbatim
+                logger.warning(f"Chat history compaction failed, sending uncompacted messages: {str(e)}")
+
+        history = [(message_role(message), message_text(message))
+                   for message in messages[:covered] if message.get('type') in PINNED_TYPES]
+        if summary:
+            history.append(("user", "Summary of the earlier discussion and the retrieved articles "
+                                    f"(their full texts are no longer included):\n\n{summary}"))
+        history.extend((message_role(message), message_text(message)) for message in messages[covered:])
+
+        stats.update({
+            "compacted_messages": covered,
+            "verbatim_messages": len(messages) - covered,
+            "sent_tokens_estimate": sum(estimate_tokens(text) for _, text in history),
+        })
+        return history, stats
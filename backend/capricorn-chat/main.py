@@ -19,7 +19,16 @@ from flask import jsonify, Response, stream_with_context
 from google import genai
 from google.cloud import firestore
 import json
+import logging
 import os
+import structured_logging
+from cancellation import CancellationToken
+from compaction import HistoryCompactor, estimate_tokens, message_text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+slog = structured_logging.get_logger(__name__)
 
 # Initialize Firestore client with environment variable
 db = firestore.Client(database=os.environ.get('DATABASE_ID', 'capricorn-eu'))
@@ -33,9 +42,32 @@ client = genai.Client(
     location=os.environ.get('LOCATION', 'us-central1'),
 )
 
+# History compaction: the last CHAT_VERBATIM_TURNS turns are sent as-is, older
+# turns and the article payload as a summary kept next to the chat
+compactor = HistoryCompactor(
+    client,
+    model=os.environ.get('CHAT_SUMMARY_MODEL', 'gemini-2.5-flash'),
+    verbatim_turns=int(os.environ.get('CHAT_VERBATIM_TURNS', '3')),
+    compact_every_turns=int(os.environ.get('CHAT_COMPACT_EVERY_TURNS', '2')),
+)
+
+# Longest reply the model may generate
+MAX_OUTPUT_TOKENS = 8192
+
+def expected_reply_tokens(messages):
+    """Typical reply length in this chat: the mean of its earlier replies, or MAX_OUTPUT_TOKENS if none."""
+    replies = [estimate_tokens(message_text(message)) for message in messages
+               if message.get('role') == 'assistant' and message.get('type') == 'message']
+    if not replies:
+        return MAX_OUTPUT_TOKENS
+    return min(sum(replies) // len(replies), MAX_OUTPUT_TOKENS)
+
+def get_chat_ref(user_id, chat_id):
+    return db.collection('chats').document(user_id).collection('conversations').document(chat_id)
+
 def get_chat_history(user_id, chat_id):
     """Retrieve chat history from Firestore."""
-    chat_ref = db.collection('chats').document(user_id).collection('conversations').document(chat_id)
+    chat_ref = get_chat_ref(user_id, chat_id)
     chat_doc = chat_ref.get()
     
     if not chat_doc.exists:
@@ -60,6 +92,8 @@ def create_gemini_prompt():
 
 3. Follow-up questions and discussions about the case and literature
 
+Older parts of a long conversation, and the article full texts, may be replaced by a summary of the articles' key findings and the discussion so far.
+
 Your role is to:
 1. Understand that you're part of an ongoing clinical discussion
 2. Ground your responses in the specific context of:
@@ -80,7 +114,7 @@ Remember:
 - Don't make claims without evidence from the provided articles
 - Focus on answering the specific question while leveraging the rich context available
 
-The conversation will include full article texts and analysis - use this information to provide detailed, evidence-based responses."""
+The conversation will include the article findings and analysis - use this information to provide detailed, evidence-based responses."""
 
 @functions_framework.http
 def chat(request):
@@ -90,11 +124,13 @@ def chat(request):
         headers = {
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'POST',
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Headers': 'Content-Type, X-Request-Id',
             'Access-Control-Max-Age': '3600'
         }
         return ('', 204, headers)
 
+    request_id = structured_logging.new_request_id(request)
+
     # Set CORS headers for main requests
     headers = {
         'Access-Control-Allow-Origin': '*'
@@ -112,9 +148,12 @@ def chat(request):
     if not all([message, user_id, chat_id]):
         return jsonify({'error': 'Missing required fields'}), 400, headers
 
+    log_token = structured_logging.set_request_id(request_id)
     try:
-        # Get chat history
+        # Get chat history, with older turns and article texts compacted into a summary
         chat_history = get_chat_history(user_id, chat_id)
+        history, compaction_stats = compactor.build_history(get_chat_ref(user_id, chat_id), chat_history)
+        slog.info("chat_history", chat_id=chat_id, **compaction_stats)
         
         # Create conversation history for Gemini
         conversation = []
@@ -125,12 +164,11 @@ def chat(request):
             "parts": [create_gemini_prompt()]
         })
         
-        # Add chat history - include all messages with raw content
-        for msg in chat_history:
-            role = "user" if msg.get('role') == 'user' else "model"
+        # Add chat history: pinned messages, the summary, then the recent turns verbatim
+        for role, text in history:
             conversation.append({
                 "role": role,
-                "parts": [msg.get('content')]
+                "parts": [text]
             })
         
         # Add current message
@@ -154,7 +192,7 @@ def chat(request):
         generate_content_config = types.GenerateContentConfig(
             temperature=1,
             top_p=0.95,
-            max_output_tokens=8192,
+            max_output_tokens=MAX_OUTPUT_TOKENS,
             response_modalities=["TEXT"],
             safety_settings=[
                 types.SafetySetting(
@@ -178,20 +216,39 @@ def chat(request):
 
         # Generate streaming response
         def generate():
+            # Closing this generator (client disconnect or a failed write)
+            # closes the model stream instead of letting it run to the end.
+            token = structured_logging.set_request_id(request_id)
+            cancel = CancellationToken()
+            chunks = 0
+            received = []
             try:
-                response = client.models.generate_content_stream(
+                response = cancel.iterate(client.models.generate_content_stream(
                     model="gemini-2.5-pro",
                     contents=contents,
                     config=generate_content_config
-                )
+                ))
                 
                 for chunk in response:
                     if chunk.text:
+                        chunks += 1
+                        received.append(chunk.text)
                         yield f"data: {json.dumps({'text': chunk.text})}\n\n"
                         
+            except GeneratorExit:
+                cancel.cancel()
+                response.close()
+                # The rest of the reply is never generated; estimate it from this chat's earlier replies
+                sent_tokens = estimate_tokens("".join(received))
+                cancel.record_avoided(output_tokens=max(expected_reply_tokens(chat_history) - sent_tokens, 0))
+                slog.info("request_cancelled", chat_id=chat_id, chunks=chunks, **cancel.stats())
+                raise
             except Exception as e:
+                slog.error("chat_failed", chat_id=chat_id, error=str(e))
                 yield f"data: {json.dumps({'error': str(e)})}\n\n"
-            
+            finally:
+                structured_logging.reset_request_id(token)
+
             yield "data: [DONE]\n\n"
 
         return Response(
@@ -205,4 +262,7 @@ def chat(request):
         )
 
     except Exception as e:
+        slog.error("chat_failed", chat_id=chat_id, error=str(e))
         return jsonify({'error': str(e)}), 500, headers
+    finally:
+        structured_logging.reset_request_id(log_token)
@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import flask
+import pytest
+
+REPLY = "A long earlier reply about crizotinib. " * 40
+
+
+@pytest.fixture
+def chat(main, monkeypatch):
+    """The chat handler with a fake model and history; records each request's cancellation token."""
+    tokens = []
+    history = [
+        {'role': 'user', 'type': 'message', 'content': "Which ALK inhibitor?"},
+        {'role': 'assistant', 'type': 'message', 'content': REPLY},
+    ]
+
+    class RecordingToken(main.CancellationToken):
+        def __init__(self):
+            super().__init__()
+            tokens.append(self)
+
+    def stream(model, contents, config):
+        for text in ("Crizotinib ", "is approved ", "for ALK-positive tumours."):
+            yield SimpleNamespace(text=text)
+
+    monkeypatch.setattr(main, "CancellationToken", RecordingToken)
+    monkeypatch.setattr(main, "client", SimpleNamespace(models=SimpleNamespace(generate_content_stream=stream)))
+    monkeypatch.setattr(main, "get_chat_history", lambda user_id, chat_id: history)
+    monkeypatch.setattr(main, "get_chat_ref", lambda user_id, chat_id: None)
+    monkeypatch.setattr(main.compactor, "build_history",
+                        lambda chat_ref, messages: ([], {"compacted": False}))
+    return tokens
+
+
+def post(main, app):
+    with app.test_request_context(method="POST", json={"message": "And the dose?", "userId": "u1", "chatId": "c1"}):
+        return main.chat(flask.request)
+
+
+def test_expected_reply_tokens_follows_earlier_replies(main):
+    replies = [{'role': 'assistant', 'type': 'message', 'content': "x" * 400},
+               {'role': 'assistant', 'type': 'message', 'content': "x" * 800},
+               {'role': 'user', 'type': 'message', 'content': "x" * 4000}]
+    assert main.expected_reply_tokens(replies) == 150
+    assert main.expected_reply_tokens([]) == main.MAX_OUTPUT_TOKENS
+    huge = [{'role': 'assistant', 'type': 'message', 'content': "x" * 100000}]
+    assert main.expected_reply_tokens(huge) == main.MAX_OUTPUT_TOKENS
+
+
+def test_complete_reply_avoids_nothing(main, chat):
+    app = flask.Flask(__name__)
+    response = post(main, app)
+    body = "".join(response.response)
+    assert body.endswith("data: [DONE]\n\n")
+    assert chat[-1].stats()["avoided_output_tokens_estimate"] == 0
+
+
+def test_cancelled_reply_records_the_unsent_output_tokens(main, chat):
+    app = flask.Flask(__name__)
+    response = post(main, app)
+    stream = iter(response.response)
+    assert "Crizotinib" in next(stream)
+    response.close()
+    stats = chat[-1].stats()
+    assert stats["cancelled"]
+    assert stats["abandoned_streams"] == 1
+    # The earlier reply was ~400 tokens; only the first chunk was sent
+    sent = main.estimate_tokens("Crizotinib ")
+    assert stats["avoided_output_tokens_estimate"] == main.estimate_tokens(REPLY) - sent
@@ -0,0 +1,138 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import compaction
+
+
+class FakeModels:
+    def __init__(self, fail=False):
+        self.prompts = []
+        self.fail = fail
+
+    def generate_content(self, model, contents, config):
+        self.prompts.append(contents[0].parts[0].text)
+        if self.fail:
+            raise RuntimeError("summary model unavailable")
+        return SimpleNamespace(text=f"summary {len(self.prompts)}")
+
+
+class FakeDocument:
+    """conversations/{chat}/compaction/summary as a plain dict."""
+
+    def __init__(self):
+        self.data = None
+        self.writes = 0
+
+    def get(self):
+        return SimpleNamespace(exists=self.data is not None, to_dict=lambda: dict(self.data))
+
+    def set(self, data):
+        self.data = data
+        self.writes += 1
+
+
+class FakeChat:
+    def __init__(self):
+        self.summary = FakeDocument()
+
+    def collection(self, name):
+        return SimpleNamespace(document=lambda doc_id: self.summary)
+
+
+def document_message(articles):
+    return {"role": "assistant", "type": "document",
+            "content": json.dumps({"articles": articles, "currentProgress": "done"})}
+
+
+def conversation(turns):
+    messages = [
+        {"role": "user", "type": "initial_case", "content": "Case: 4-year-old with neuroblastoma"},
+        document_message([{"pmcid": "PMC1", "title": "Crizotinib", "points": 90, "content": "text of PMC1"}]),
+        {"role": "assistant", "type": "analysis", "content": {"markdown_content": "## Final analysis"}},
+    ]
+    for turn in range(turns):
+        messages.append({"role": "user", "type": "message", "content": f"question {turn}"})
+        messages.append({"role": "assistant", "type": "message", "content": f"answer {turn}"})
+    return messages
+
+
+@pytest.fixture
+def compactor():
+    return compaction.HistoryCompactor(SimpleNamespace(models=FakeModels()), "summary-model",
+                                       verbatim_turns=2, compact_every_turns=2)
+
+
+def test_document_messages_are_summarized_article_by_article():
+    compactor = compaction.HistoryCompactor(None, "summary-model", max_message_chars=1000, min_article_chars=100)
+    articles = [{"pmcid": f"PMC{n}", "title": f"Title {n}", "journal_title": "Blood", "year": "2022",
+                 "points": n, "content": f"text of PMC{n} " + "x" * 5000} for n in range(20)]
+
+    material = compactor.message_material(document_message(articles))
+
+    # Every article keeps its metadata; only its content is cut, to an even share of the limit
+    for n in range(20):
+        assert f'"pmcid": "PMC{n}", "title": "Title {n}", "journal_title": "Blood", "year": "2022", "points": {n}' in material
+        assert f"text of PMC{n} " in material
+    assert material.count("[... rest of the article omitted ...]") == 20
+    assert len(material) < 20 * (100 + 250)
+
+
+def test_other_messages_are_cut_whole():
+    compactor = compaction.HistoryCompactor(None, "summary-model", max_message_chars=5)
+    assert compactor.message_material({"role": "user", "type": "message", "content": "question"}) == \
+        "[user / message]\nquest"
+    assert compaction.document_articles({"type": "document", "content": "not json"}) is None
+
+
+def test_short_chats_are_sent_verbatim(compactor):
+    messages = conversation(turns=1)
+    history, stats = compactor.build_history(FakeChat(), messages)
+    # The document message is always summarized; the case and everything after it stay verbatim
+    assert history[0] == ("user", "Case: 4-year-old with neuroblastoma")
+    assert "summary 1" in history[1][1]
+    assert stats["summarized_messages"] == 1
+    assert [text for _, text in history[2:]] == ["## Final analysis", "question 0", "answer 0"]
+
+
+def test_old_turns_roll_into_the_summary_in_steps(compactor):
+    chat = FakeChat()
+    compactor.build_history(chat, conversation(turns=1))
+    assert chat.summary.data["covered_messages"] == 2
+
+    # Within the window plus its slack the stored summary is reused as is
+    history, stats = compactor.build_history(chat, conversation(turns=3))
+    assert stats["summary_reused"] and stats["summarized_messages"] == 0
+    assert chat.summary.writes == 1
+
+    history, stats = compactor.build_history(chat, conversation(turns=4))
+    assert stats["summarized_messages"] == 4
+    assert chat.summary.data["covered_messages"] == 7
+    # The analysis rolled out of the window but stays pinned ahead of the summary
+    assert [text for _, text in history[:2]] == ["Case: 4-year-old with neuroblastoma", "## Final analysis"]
+    assert [text for _, text in history[-4:]] == ["question 2", "answer 2", "question 3", "answer 3"]
+    # Only the new material goes to the model, on top of the stored summary
+    assert "summary 1" in compactor.client.models.prompts[-1]
+    assert "question 0" in compactor.client.models.prompts[-1]
+    assert "text of PMC1" not in compactor.client.models.prompts[-1]
+
+
+def test_changed_messages_rebuild_the_summary(compactor):
+    chat = FakeChat()
+    compactor.build_history(chat, conversation(turns=1))
+    changed = conversation(turns=1)
+    changed[1] = document_message([{"pmcid": "PMC9", "title": "Re-analyzed", "points": 1, "content": "new"}])
+    history, stats = compactor.build_history(chat, changed)
+    assert not stats["summary_reused"]
+    assert '"pmcid": "PMC9"' in compactor.client.models.prompts[-1]
+
+
+def test_summary_failure_falls_back_to_the_full_history():
+    compactor = compaction.HistoryCompactor(SimpleNamespace(models=FakeModels(fail=True)), "summary-model")
+    chat = FakeChat()
+    messages = conversation(turns=1)
+    history, stats = compactor.build_history(chat, messages)
+    assert len(history) == len(messages)
+    assert chat.summary.data is None
+    assert stats["compacted_messages"] == 0
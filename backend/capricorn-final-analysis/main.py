@@ -13,18 +13,29 @@
 # limitations under the License.
 
 import functions_framework
-from flask import jsonify, request
+from flask import jsonify, request, Response
 from google import genai
 from google.genai import types
 from google.cloud import bigquery
+import hashlib
 import json
 import logging
+import math
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+import structured_logging
+import content_store
+import result_cache as result_cache_store
+from cancellation import CancellationToken
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
+# Capped JSON records for anything that carries case notes, article text or model output
+slog = structured_logging.get_logger(__name__)
 
 # Initialize clients with environment variables
 GCP_PROJECT = os.environ.get('GENAI_PROJECT_ID') or os.environ.get('GOOGLE_CLOUD_PROJECT') or 'gemini-med-lit-review'
@@ -38,37 +49,61 @@ genai_client = genai.Client(
 )
 bq_client = bigquery.Client(project=os.environ.get('BIGQUERY_PROJECT_ID', GCP_PROJECT))
 
-def get_full_articles(analyzed_articles):
-    """Retrieve full article content from BigQuery using PMCIDs."""
-    # Extract PMCIDs from articles
-    pmcids = [article['pmcid'] for article in analyzed_articles if 'pmcid' in article]
-    pmcids_str = ', '.join([f"'{pmcid}'" for pmcid in pmcids])
-    
-    # Use the same public PMC table as retrieve-full-articles
-    pubmed_table = 'bigquery-public-data.pmc_open_access_commercial.articles'
+# Use the same public PMC table as retrieve-full-articles
+PUBMED_TABLE = 'bigquery-public-data.pmc_open_access_commercial.articles'
+
+# Texts retrieve-full-articles already downloaded. Only a gs:// store shared with
+# its ARTICLE_CONTENT_STORE gives hits across functions; memory is per instance.
+article_store = content_store.open_store(
+    os.environ.get('ARTICLE_CONTENT_STORE', 'memory'),
+    memory_chars=int(os.environ.get('ARTICLE_CONTENT_MEMORY_CHARS', str(16 * 1024 * 1024))),
+)
+
+def fetch_article_contents(pmcids):
+    """Fetch article texts for pmcids from BigQuery in one parameterized query."""
     query = f"""
     SELECT 
         pmc_id as PMCID,
         article_text as content
-    FROM `{pubmed_table}`
-    WHERE pmc_id IN ({pmcids_str})
+    FROM `{PUBMED_TABLE}`
+    WHERE pmc_id IN UNNEST(@pmcids)
     """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("pmcids", "STRING", list(pmcids))]
+    )
+    return {row['PMCID']: row['content'] for row in bq_client.query(query, job_config=job_config).result()}
+
+def get_full_articles(analyzed_articles):
+    """Attach full article content to the analyzed articles.
+
+    Texts come from the shared content store filled during retrieval; only
+    the misses are fetched from BigQuery, and then stored for next time.
+    """
+    # Extract PMCIDs from articles
+    pmcids = [article['pmcid'] for article in analyzed_articles if 'pmcid' in article]
     
     try:
-        query_job = bq_client.query(query)
-        results = list(query_job.result())
+        content_map = article_store.get_many(pmcids)
+        missing = [pmcid for pmcid in dict.fromkeys(pmcids) if pmcid not in content_map]
+        slog.info("content_store_lookup", requested=len(set(pmcids)), hits=len(content_map), misses=len(missing))
+        if missing:
+            try:
+                fetched = fetch_article_contents(missing)
+            except Exception as e:
+                # Continue with what the store had
+                logger.error(f"Error retrieving articles from BigQuery: {str(e)}")
+                fetched = {}
+            article_store.put_many(fetched)
+            content_map.update(fetched)
         
-        if not results:
+        if not content_map:
             logger.error(f"No articles found for PMCIDs: {pmcids}")
             return []
-            
-        # Create mapping of PMCID to content
-        content_map = {row['PMCID']: row['content'] for row in results}
         
         # Update analyzed articles with full content
         articles_with_content = []
         for article in analyzed_articles:
-            pmcid = article['pmcid']
+            pmcid = article.get('pmcid')
             if pmcid in content_map:
                 # Preserve all metadata and add full content
                 article_with_content = article.copy()
@@ -83,23 +118,18 @@ def get_full_articles(analyzed_articles):
         logger.error(f"Error retrieving articles: {str(e)}")
         return []
 
-def create_final_analysis_prompt(case_notes, disease, events, articles):
-    """Create the prompt for final analysis."""
+def format_article_metadata(article):
+    """Return the metadata lines the retrieval stage already produced for one article."""
+    # Format drug results as a comma-separated string
+    drug_results = ', '.join(article.get('drug_results', [])) if article.get('drug_results') else 'None'
     
-    # Create a table of analyzed articles
-    articles_table = []
-    for article in articles:
-        # Format drug results as a comma-separated string
-        drug_results = ', '.join(article.get('drug_results', [])) if article.get('drug_results') else 'None'
-        
-        # Format actionable events
-        events_str = ', '.join([
-            f"{event['event']} ({'matches' if event['matches_query'] else 'no match'})"
-            for event in article.get('events', [])
-        ])
-        
-        articles_table.append(f"""
-PMCID: {article.get('pmcid', 'N/A')}
+    # Format actionable events
+    events_str = ', '.join([
+        f"{event['event']} ({'matches' if event['matches_query'] else 'no match'})"
+        for event in article.get('events', [])
+    ])
+    
+    return f"""PMCID: {article.get('pmcid', 'N/A')}
 Title: {article.get('title', 'N/A')}
 Journal: {article.get('journal_title', 'N/A')} (SJR: {article.get('journal_sjr', 0)})
 Year: {article.get('year', 'N/A')}
@@ -107,12 +137,41 @@ Type: {article.get('paper_type', 'N/A')}
 Cancer Type: {article.get('type_of_cancer', 'N/A')}
 Events: {events_str}
 Drug Results: {drug_results}
-Points: {article.get('overall_points', 0)}
+Points: {article.get('overall_points', 0)}"""
+
+def create_final_analysis_prompt(case_notes, disease, events, articles):
+    """Create the single-call prompt for final analysis, with the full text of every article."""
+    
+    # Create a table of analyzed articles
+    articles_table = []
+    for article in articles:
+        articles_table.append(f"""
+{format_article_metadata(article)}
 Full Text:
 {article.get('content', 'N/A')}
 {'='*80}
 """)
 
+    return build_final_prompt(case_notes, disease, events, "ANALYZED ARTICLES", '\n'.join(articles_table))
+
+def create_synthesis_prompt(case_notes, disease, events, cards, full_text_articles):
+    """Create the map-reduce synthesis prompt: evidence cards, plus full text for the top-scored articles."""
+    sections = [f"""
+{card['text']}
+{'='*80}
+""" for card in cards]
+    if full_text_articles:
+        sections.append("\nFULL TEXT OF THE TOP-SCORED ARTICLES (for detail beyond their evidence cards):\n")
+        sections.extend(f"""
+PMCID: {article.get('pmcid', 'N/A')}
+Full Text:
+{article.get('content', 'N/A')}
+{'='*80}
+""" for article in full_text_articles)
+    return build_final_prompt(case_notes, disease, events, "ANALYZED ARTICLES (evidence cards)", '\n'.join(sections))
+
+def build_final_prompt(case_notes, disease, events, evidence_heading, evidence):
+    """Wrap the article evidence in the case information and the output instructions the UI relies on."""
     prompt = f"""You are a pediatric hematologist sitting on a tumor board for patients with complex diseases. Your goal is to find the best treatment for every patient, considering their actionable events (genetic, immune-related, or other).
 
 CASE INFORMATION:
@@ -121,9 +180,9 @@ CASE INFORMATION:
 Disease: {disease}
 Actionable Events: {', '.join(events)}
 
-ANALYZED ARTICLES:
+{evidence_heading}:
 {'='*80}
-{'\n'.join(articles_table)}
+{evidence}
 {'='*80}
 
 Based on the clinical input, actionable events, and the analyzed articles above, please provide a comprehensive analysis in markdown format with the following sections:
@@ -195,43 +254,325 @@ IMPORTANT: Return the analysis in markdown format with the specified table struc
 
     return prompt
 
-def analyze_with_gemini(prompt):
-    """Analyze the case and articles using Gemini."""
-    generate_content_config = types.GenerateContentConfig(
-        temperature=1,
-        top_p=0.95,
-        max_output_tokens=65535,
-        safety_settings=[
-            types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="OFF"),
-            types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="OFF"),
-            types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="OFF"),
-            types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="OFF"),
-        ],
-        thinking_config=types.ThinkingConfig(
-            thinking_level="HIGH",
+# Final analysis runs as map-reduce by default: a fast model condenses each
+# article into an evidence card in parallel, then one synthesis call reads
+# the cards plus the full text of the top-scored articles that fit the
+# budget. "single" sends every full text in one call, as before.
+FINAL_ANALYSIS_MODE = os.environ.get('FINAL_ANALYSIS_MODE', 'map_reduce')
+CARD_MODEL = os.environ.get('CARD_MODEL', 'gemini-3.1-flash-lite-preview')
+CARD_CONCURRENCY = int(os.environ.get('CARD_CONCURRENCY', '8'))
+# Article text sent to the card model is cut to about this many tokens
+CARD_ARTICLE_MAX_TOKENS = int(os.environ.get('CARD_ARTICLE_MAX_TOKENS', '32000'))
+FULL_TEXT_TOKEN_BUDGET = int(os.environ.get('FULL_TEXT_TOKEN_BUDGET', '60000'))
+FULL_TEXT_MAX_ARTICLES = int(os.environ.get('FULL_TEXT_MAX_ARTICLES', '3'))
+# Upper bound on the estimated synthesis prompt size; article texts are trimmed,
+# lowest-scored first, to stay under it. Inputs above 200k tokens are billed
+# at the long-context rate.
+FINAL_PROMPT_TOKEN_BUDGET = int(os.environ.get('FINAL_PROMPT_TOKEN_BUDGET', '200000'))
+# An article's text is cut down to this many tokens before it is removed entirely
+ARTICLE_MIN_TEXT_TOKENS = int(os.environ.get('ARTICLE_MIN_TEXT_TOKENS', '1000'))
+TRIMMED_MARKER = "\n[... article text trimmed to fit the prompt budget]"
+
+EVIDENCE_CARD_PROMPT = """You are preparing evidence for a pediatric tumor board.
+
+The patient's disease is: {disease}
+The patient's actionable events are: {events}
+
+Condense the article below into a compact evidence card of at most 200 words, as plain text with exactly these lines:
+Population: who was studied (species/cell lines/patients, age group, n)
+Interventions: drugs, combinations or procedures tested
+Key Results: outcomes with numbers where given (response rates, survival, IC50, etc.)
+Relevance: how the findings apply to the patient's disease and actionable events
+Warnings: toxicities, resistance, contraindications or major limitations
+
+Use only information stated in the article.
+
+<Article>
+{article}
+</Article>"""
+
+class FinalAnalysisError(Exception):
+    """Raised when a final analysis cannot be produced; the message is returned to the client."""
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 characters per token) used for prompt-size reporting."""
+    return math.ceil(len(text or "") / 4)
+
+def card_article_text(article):
+    return (article.get('content') or '')[:CARD_ARTICLE_MAX_TOKENS * 4]
+
+def summarize_article(article, disease, events):
+    """Ask the card model for the evidence summary of one article; returns the response."""
+    prompt = EVIDENCE_CARD_PROMPT.format(
+        disease=disease,
+        events=', '.join(events),
+        article=card_article_text(article),
+    )
+    return genai_client.models.generate_content(
+        model=CARD_MODEL,
+        contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
+        config=types.GenerateContentConfig(
+            temperature=0,
+            max_output_tokens=1024,
+            thinking_config=types.ThinkingConfig(thinking_level="LOW"),
         ),
     )
 
+def build_evidence_card(article, disease, events):
+    """Return the article's card: its metadata plus evidence summary, and the card call's token usage."""
+    summary = ""
+    usage = None
+    try:
+        response = summarize_article(article, disease, events)
+        summary = (response.text or '').strip()
+        usage = response.usage_metadata
+    except Exception as e:
+        logger.warning(f"Evidence card failed for {article.get('pmcid')}, using metadata only: {str(e)}")
+    text = format_article_metadata(article) + "\nEvidence Summary:\n" + (
+        summary or "Not available; rely on the metadata above.")
+    return {
+        "pmcid": article.get('pmcid'),
+        "text": text,
+        "summarized": bool(summary),
+        "input_tokens": (usage.prompt_token_count or 0) if usage else 0,
+        "output_tokens": (usage.candidates_token_count or 0) if usage else 0,
+    }
+
+def card_workers(articles):
+    return max(1, min(CARD_CONCURRENCY, len(articles)))
+
+def iter_evidence_cards(articles, disease, events, executor, cancel=None):
+    """Submit one card per article to executor and yield (index, card) as each completes.
+
+    Cards still queued when the executor is shut down with cancel_futures are
+    counted on the cancellation token as avoided calls.
+    """
+    def on_done(future, article):
+        if future.cancelled() and cancel is not None:
+            cancel.record_avoided(calls=1, input_tokens=estimate_tokens(card_article_text(article)))
+
+    futures = {}
+    for idx, article in enumerate(articles):
+        future = executor.submit(structured_logging.propagate(build_evidence_card), article, disease, events)
+        future.add_done_callback(lambda f, article=article: on_done(f, article))
+        futures[future] = idx
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+def build_evidence_cards(articles, disease, events):
+    """Build the evidence cards for all articles in parallel, in article order."""
+    if not articles:
+        return []
+    cards = [None] * len(articles)
+    with ThreadPoolExecutor(max_workers=card_workers(articles)) as executor:
+        for idx, card in iter_evidence_cards(articles, disease, events, executor):
+            cards[idx] = card
+    return cards
+
+def select_full_text_articles(articles, token_budget=None, max_articles=None):
+    """Pick the highest-scoring articles whose full texts fit in token_budget together."""
+    token_budget = FULL_TEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    max_articles = FULL_TEXT_MAX_ARTICLES if max_articles is None else max_articles
+    selected = []
+    used = 0
+    for article in sorted(articles, key=lambda a: a.get('overall_points') or 0, reverse=True):
+        if len(selected) >= max_articles:
+            break
+        tokens = estimate_tokens(article.get('content'))
+        if used + tokens <= token_budget:
+            selected.append(article)
+            used += tokens
+    return selected
+
+def allocate_text_budgets(entries, available, min_text_tokens=None):
+    """Fit entries into available tokens, trimming the lowest-ranked first.
+
+    entries are (fixed_tokens, text_tokens) pairs, highest-ranked first; the
+    fixed part (metadata or evidence card) is kept whole, the text can be
+    trimmed. Texts are first cut down to min_text_tokens, then removed, then
+    whole entries are dropped, each time starting from the lowest rank.
+    Returns one allowance per entry: the text tokens to keep, or None if the
+    entry is dropped.
+    """
+    min_text_tokens = ARTICLE_MIN_TEXT_TOKENS if min_text_tokens is None else min_text_tokens
+    allowances = [text for _, text in entries]
+    excess = sum(fixed + text for fixed, text in entries) - available
+    for floor in (min_text_tokens, 0):
+        for idx in reversed(range(len(entries))):
+            if excess <= 0:
+                return allowances
+            cut = min(excess, max(0, allowances[idx] - floor))
+            allowances[idx] -= cut
+            excess -= cut
+    for idx in reversed(range(len(entries))):
+        if excess <= 0:
+            break
+        excess -= entries[idx][0]
+        allowances[idx] = None
+    return allowances
+
+def trim_text(text, tokens):
+    """Cut text to about tokens, marking the cut so the model knows the article continues."""
+    if estimate_tokens(text) <= tokens:
+        return text
+    if tokens <= estimate_tokens(TRIMMED_MARKER):
+        return ""
+    return text[:tokens * 4 - len(TRIMMED_MARKER)] + TRIMMED_MARKER
+
+def assemble_prompt(render, articles, fixed_tokens, text_tokens, budget=None):
+    """Render the largest prompt that fits budget; returns (prompt, report).
+
+    render(included, texts) builds the prompt from the included articles (in
+    their original order) and their possibly trimmed texts. fixed_tokens and
+    text_tokens give each article's untrimmable and trimmable size. Articles
+    are ranked by overall_points for the allocation.
+    """
+    budget = FINAL_PROMPT_TOKEN_BUDGET if budget is None else budget
+    overhead = estimate_tokens(render([], {}))
+    if overhead > budget:
+        raise FinalAnalysisError(
+            f"Case information alone (~{overhead} tokens) exceeds the prompt budget of {budget} tokens")
+
+    ranked = sorted(range(len(articles)), key=lambda idx: articles[idx].get('overall_points') or 0, reverse=True)
+    # One extra token per entry covers the separators between them
+    allowances = allocate_text_budgets(
+        [(fixed_tokens[idx] + 1, text_tokens[idx]) for idx in ranked], budget - overhead)
+    allowance = dict(zip(ranked, allowances))
+
+    def build():
+        included = [idx for idx in range(len(articles)) if allowance[idx] is not None]
+        texts = {idx: trim_text(articles[idx].get('content') or '', allowance[idx]) for idx in included}
+        return included, render([articles[idx] for idx in included], {articles[idx].get('pmcid'): texts[idx] for idx in included})
+
+    included, prompt = build()
+    # The estimates above are conservative; this only guards against rounding
+    while estimate_tokens(prompt) > budget and included:
+        allowance[min(included, key=lambda idx: (articles[idx].get('overall_points') or 0, -idx))] = None
+        included, prompt = build()
+
+    trimmed = [{"pmcid": articles[idx].get('pmcid'), "kept_tokens": allowance[idx],
+                "original_tokens": text_tokens[idx]}
+               for idx in included if allowance[idx] < text_tokens[idx]]
+    return prompt, {
+        "prompt_budget_tokens": budget,
+        "prompt_tokens_estimate": estimate_tokens(prompt),
+        "articles_included": len(included),
+        "articles_trimmed": trimmed,
+        "articles_dropped": [articles[idx].get('pmcid') for idx in ranked if allowance[idx] is None],
+    }
+
+def assemble_single_prompt(case_notes, disease, events, articles, budget=None):
+    """Return (prompt, report) for the single-call prompt, trimmed to the prompt budget."""
+    def render(included, texts):
+        return create_final_analysis_prompt(case_notes, disease, events, [
+            {**article, 'content': texts[article.get('pmcid')]} for article in included])
+
+    fixed = [estimate_tokens(render([{**article, 'content': ''}], {article.get('pmcid'): ''})) for article in articles]
+    overhead = estimate_tokens(render([], {}))
+    return assemble_prompt(render, articles, [tokens - overhead for tokens in fixed],
+                           [estimate_tokens(article.get('content')) for article in articles], budget)
+
+# Generation settings for the final (synthesis) call
+FINAL_ANALYSIS_CONFIG = types.GenerateContentConfig(
+    temperature=1,
+    top_p=0.95,
+    max_output_tokens=65535,
+    safety_settings=[
+        types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="OFF"),
+        types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="OFF"),
+        types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="OFF"),
+        types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="OFF"),
+    ],
+    thinking_config=types.ThinkingConfig(
+        thinking_level="HIGH",
+    ),
+)
+
+def iter_analysis_chunks(prompt, usage=None, cancel=None):
+    """Yield the text chunks of the final analysis as Gemini streams them.
+
+    The cumulative token usage of the final chunk is copied into usage. With a
+    cancellation token, the model stream is closed as soon as it is cancelled.
+    """
     contents = [
         types.Content(
             role="user",
             parts=[types.Part.from_text(text=prompt)],
         ),
     ]
-
+    stream = genai_client.models.generate_content_stream(
+        model=MODEL,
+        contents=contents,
+        config=FINAL_ANALYSIS_CONFIG,
+    )
+    if cancel is not None:
+        stream = cancel.iterate(stream)
     try:
-        response_text = ""
-        for chunk in genai_client.models.generate_content_stream(
-            model=MODEL,
-            contents=contents,
-            config=generate_content_config,
-        ):
+        for chunk in stream:
+            if chunk.usage_metadata and usage is not None:
+                usage.update({
+                    "input_tokens": chunk.usage_metadata.prompt_token_count or 0,
+                    "output_tokens": chunk.usage_metadata.candidates_token_count or 0,
+                    "thinking_tokens": chunk.usage_metadata.thoughts_token_count or 0,
+                    "cached_tokens": chunk.usage_metadata.cached_content_token_count or 0,
+                })
             if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
                 continue
             if chunk.text:
-                response_text += chunk.text
+                yield chunk.text
+    finally:
+        close = getattr(stream, 'close', None)
+        if close is not None:
+            close()
+
+def create_map_reduce_prompt(case_notes, disease, events, articles, cards, budget=None):
+    """Return (prompt, stats) for the synthesis call over the evidence cards, trimmed to the prompt budget."""
+    full_text_candidates = {article.get('pmcid') for article in select_full_text_articles(articles)}
+    card_by_pmcid = {card["pmcid"]: card for card in cards}
+
+    def render(included, texts):
+        full_text_articles = [{**article, 'content': texts[article.get('pmcid')]} for article in included
+                              if texts.get(article.get('pmcid'))]
+        return create_synthesis_prompt(case_notes, disease, events,
+                                       [card_by_pmcid[article.get('pmcid')] for article in included],
+                                       full_text_articles)
+
+    # Only the full texts picked for the synthesis are trimmable; cards are kept whole
+    candidates = [{**article, 'content': article.get('content') if article.get('pmcid') in full_text_candidates else ''}
+                  for article in articles]
+    overhead = estimate_tokens(render([], {}))
+    fixed = []
+    text = []
+    for article in candidates:
+        if not article['content']:
+            fixed.append(estimate_tokens(render([article], {article.get('pmcid'): ''})) - overhead)
+            text.append(0)
+            continue
+        # Only the content is trimmed; its heading, PMCID line and separator count as fixed
+        content = estimate_tokens(article['content'])
+        fixed.append(estimate_tokens(render([article], {article.get('pmcid'): article['content']})) - content - overhead)
+        text.append(content)
+    prompt, report = assemble_prompt(render, candidates, fixed, text, budget)
+    kept = {item["pmcid"]: item["kept_tokens"] for item in report["articles_trimmed"]}
+    full_text_pmcids = [article.get('pmcid') for article in candidates
+                        if article['content'] and article.get('pmcid') not in report["articles_dropped"]
+                        and kept.get(article.get('pmcid'), math.inf) > estimate_tokens(TRIMMED_MARKER)]
+    return prompt, {
+        "cards_summarized": sum(card["summarized"] for card in cards),
+        "card_input_tokens": sum(card["input_tokens"] for card in cards),
+        "card_output_tokens": sum(card["output_tokens"] for card in cards),
+        "full_text_pmcids": full_text_pmcids,
+        "single_prompt_tokens_estimate": estimate_tokens(
+            create_final_analysis_prompt(case_notes, disease, events, articles)),
+        "prompt_budget": report,
+    }
+
+def analyze_with_gemini(prompt):
+    """Analyze the case and articles using Gemini."""
+    try:
+        response_text = "".join(iter_analysis_chunks(prompt))
 
-        logger.info(f"Gemini model={MODEL} final analysis response length: {len(response_text)} chars")
+        slog.info("gemini_response", model=MODEL, payloads={"response_text": response_text})
 
         if response_text:
             return {"markdown_content": response_text.strip()}
@@ -243,6 +584,115 @@ def analyze_with_gemini(prompt):
         logger.error(f"Error in analyze_with_gemini: {str(e)}")
         return None
 
+class MarkdownSections:
+    """Split streamed markdown at its ## / ### headings and report each section once it closes."""
+
+    HEADING = re.compile(r"^#{2,3} ")
+
+    def __init__(self):
+        self._partial = ""
+        self._title = None
+        self._lines = []
+        self.count = 0
+
+    def feed(self, text):
+        """Add streamed text; returns the sections closed by headings in it."""
+        self._partial += text
+        *lines, self._partial = self._partial.split("\n")
+        closed = []
+        for line in lines:
+            # Only whole lines can be headings; the last partial line waits for more text
+            if self.HEADING.match(line):
+                section = self._close()
+                if section:
+                    closed.append(section)
+                self._title = line.strip()
+            self._lines.append(line)
+        return closed
+
+    def close(self):
+        """Return the last section once the stream has ended (or None)."""
+        if self._partial:
+            self._lines.append(self._partial)
+            self._partial = ""
+        return self._close()
+
+    def _close(self):
+        markdown = "\n".join(self._lines).strip()
+        self._lines = []
+        if not markdown:
+            return None
+        self.count += 1
+        return {"index": self.count, "title": self._title, "markdown": markdown}
+
+# Final analyses keyed by request hash. FINAL_ANALYSIS_CACHE=gs://bucket/prefix shares
+# results and in-flight leases across instances and across the blocking and streaming
+# deployments; left empty, identical requests are only coalesced within one instance.
+result_cache = result_cache_store.open_cache(
+    os.environ.get('FINAL_ANALYSIS_CACHE', ''),
+    max_entries=int(os.environ.get('FINAL_ANALYSIS_CACHE_ENTRIES', '128')),
+    ttl_seconds=float(os.environ.get('FINAL_ANALYSIS_CACHE_TTL_SECONDS', '3600')),
+    lease_seconds=float(os.environ.get('FINAL_ANALYSIS_LEASE_SECONDS', '900')),
+)
+
+def final_analysis_cache_key(case_notes, disease, events, analyzed_articles):
+    """Canonical hash of everything that determines a final analysis."""
+    def normalize(value):
+        return " ".join(str(value).split())
+
+    canonical = {
+        "case_notes": normalize(case_notes),
+        "disease": normalize(disease),
+        "events": sorted(normalize(event) for event in events),
+        "articles": sorted([str(article.get('pmcid')), article.get('overall_points') or 0]
+                           for article in analyzed_articles),
+        "model": MODEL,
+        "mode": FINAL_ANALYSIS_MODE,
+        "card_model": CARD_MODEL if FINAL_ANALYSIS_MODE != 'single' else None,
+        "prompt_budget": FINAL_PROMPT_TOKEN_BUDGET,
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def run_final_analysis(case_notes, disease, events, analyzed_articles):
+    """Fetch the article texts and produce the analysis; returns {"analysis", "stages"}."""
+    # Get full articles from the content store (BigQuery for misses) while preserving metadata
+    articles_with_content = get_full_articles(analyzed_articles)
+    
+    # Counts and sizes only: hashing every full text on each request costs more than it tells
+    slog.info("articles_retrieved", count=len(articles_with_content),
+              pmcids=lambda: [article.get('pmcid') for article in articles_with_content],
+              content_tokens=lambda: sum(estimate_tokens(article.get('content')) for article in articles_with_content))
+    
+    if not articles_with_content:
+        logger.error("Failed to retrieve any articles from the content store or BigQuery")
+        raise FinalAnalysisError('Failed to retrieve articles from BigQuery')
+
+    # Create prompt and analyze
+    stages = {"mode": FINAL_ANALYSIS_MODE, "articles": len(articles_with_content)}
+    if FINAL_ANALYSIS_MODE == 'single':
+        prompt, budget_report = assemble_single_prompt(case_notes, disease, events, articles_with_content)
+        stages["prompt_budget"] = budget_report
+    else:
+        start = time.perf_counter()
+        cards = build_evidence_cards(articles_with_content, disease, events)
+        stages["evidence_cards_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        prompt, card_stats = create_map_reduce_prompt(case_notes, disease, events, articles_with_content, cards)
+        stages.update(card_stats)
+    stages["prompt_tokens_estimate"] = estimate_tokens(prompt)
+    start = time.perf_counter()
+    analysis = analyze_with_gemini(prompt)
+    stages["synthesis_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    slog.info("final_analysis_stages", **stages)
+
+    if not analysis:
+        raise FinalAnalysisError('Failed to generate analysis')
+    return {"analysis": analysis, "stages": stages}
+
+def missing_request_fields(request_json):
+    """Return the names of the required request fields that are missing or empty."""
+    return [field for field in ('case_notes', 'disease', 'events', 'analyzed_articles')
+            if not request_json.get(field)]
+
 @functions_framework.http
 def final_analysis(request):
     """HTTP Cloud Function for final analysis."""
@@ -250,8 +700,8 @@ def final_analysis(request):
     if request.method == 'OPTIONS':
         headers = {
             'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'POST',
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Methods': 'GET, POST',
+            'Access-Control-Allow-Headers': 'Content-Type, X-Request-Id',
             'Access-Control-Max-Age': '3600'
         }
         return ('', 204, headers)
@@ -261,9 +711,19 @@ def final_analysis(request):
         'Content-Type': 'application/json'
     }
 
+    # Report content store and result cache state for monitoring
+    if request.method == 'GET':
+        return jsonify({
+            "content_store": article_store.stats(),
+            "result_cache": result_cache.stats()
+        }), 200, headers
+
+    log_token = structured_logging.set_request_id(structured_logging.new_request_id(request))
     try:
         request_json = request.get_json()
-        logger.info(f"Received request body: {json.dumps(request_json, indent=2)}")
+        slog.info("request_received", fields=lambda: sorted(request_json) if isinstance(request_json, dict) else None,
+                  case_notes_tokens=lambda: estimate_tokens(request_json.get('case_notes'))
+                  if isinstance(request_json, dict) and isinstance(request_json.get('case_notes'), str) else None)
         
         if not request_json:
             logger.error("No JSON data received in request")
@@ -275,50 +735,257 @@ def final_analysis(request):
         events = request_json.get('events')
         analyzed_articles = request_json.get('analyzed_articles')
 
-        # Log each field's presence/absence
-        missing_fields = []
-        if not case_notes:
-            missing_fields.append('case_notes')
-        if not disease:
-            missing_fields.append('disease')
-        if not events:
-            missing_fields.append('events')
-        if not analyzed_articles:
-            missing_fields.append('analyzed_articles')
-
+        missing_fields = missing_request_fields(request_json)
         if missing_fields:
             error_msg = f"Missing required fields: {', '.join(missing_fields)}"
             logger.error(error_msg)
             return jsonify({'error': error_msg}), 400, headers
 
-        # Log analyzed articles before BigQuery
-        logger.info(f"Analyzed articles before BigQuery: {json.dumps(analyzed_articles, indent=2)}")
-
-        # Get full articles from BigQuery while preserving metadata
-        articles_with_content = get_full_articles(analyzed_articles)
-        
-        # Log articles after BigQuery
-        logger.info(f"Articles after BigQuery retrieval: {json.dumps(articles_with_content, indent=2)}")
-        
-        if not articles_with_content:
-            logger.error("Failed to retrieve any articles from BigQuery")
-            return jsonify({'error': 'Failed to retrieve articles from BigQuery'}), 500, headers
-
-        # Create prompt and analyze
-        prompt = create_final_analysis_prompt(case_notes, disease, events, articles_with_content)
-        analysis = analyze_with_gemini(prompt)
+        slog.info("articles_requested", count=len(analyzed_articles),
+                  pmcids=lambda: [article.get('pmcid') for article in analyzed_articles])
 
-        if not analysis:
-            return jsonify({'error': 'Failed to generate analysis'}), 500, headers
+        # Identical requests share one computation and its cached result
+        cache_key = final_analysis_cache_key(case_notes, disease, events, analyzed_articles)
+        try:
+            result, source = result_cache.get_or_compute(
+                cache_key, lambda: run_final_analysis(case_notes, disease, events, analyzed_articles))
+        except FinalAnalysisError as e:
+            return jsonify({'error': str(e)}), 500, headers
+        slog.info("final_analysis_result", source=source, cache_key=cache_key[:16])
 
         return jsonify({
             'success': True,
-            'analysis': analysis
+            'analysis': result['analysis'],
+            'stages': result['stages'],
+            'result_source': source,
+            'content_store': article_store.stats()
         }), 200, headers
 
     except Exception as e:
         logger.error(f"Error in final_analysis: {str(e)}")
         return jsonify({'error': str(e)}), 500, headers
+    finally:
+        structured_logging.reset_request_id(log_token)
+
+def stream_final_analysis(case_notes, disease, events, analyzed_articles, request_id=None):
+    """Stream the final analysis as NDJSON events.
+
+    Events: a processing metadata event, evidence_card progress (map-reduce
+    mode), chunk events with markdown text as Gemini produces it, a section
+    event each time a ## / ### section closes, and a completion metadata
+    event with token usage and stage timings. A client disconnect cancels
+    the outstanding card calls and closes the model stream.
+    """
+    # The generator runs after the view returns, so the request ID is bound here
+    log_token = structured_logging.set_request_id(request_id or structured_logging.new_request_id())
+    cancel = CancellationToken()
+    request_start = time.perf_counter()
+    timing = {}
+    # Model calls not yet issued, counted as avoided if the client goes away
+    unstarted_cards = 0
+    synthesis_started = False
+    # "computed" once this request leads; replays have no model calls to avoid
+    result_source = None
+    cache_key = final_analysis_cache_key(case_notes, disease, events, analyzed_articles)
+    flight = None
+    failure = None
+    try:
+        # Identical requests replay a cached or in-flight result instead of recomputing it
+        while flight is None:
+            source, found = result_cache.begin(cache_key)
+            if source == "lead":
+                flight = found
+                result_source = "computed"
+                break
+            result = found if source == "cache" else found.wait()
+            if result is not None:
+                result_source = source if source == "cache" else "coalesced"
+                slog.info("final_analysis_result", source=result_source, cache_key=cache_key[:16])
+                yield from replay_final_analysis(result, result_source, request_start)
+                return
+
+        start = time.perf_counter()
+        articles_with_content = get_full_articles(analyzed_articles)
+        timing["article_fetch_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        if not articles_with_content:
+            logger.error("Failed to retrieve any articles from the content store or BigQuery")
+            failure = FinalAnalysisError('Failed to retrieve articles from BigQuery')
+            yield json.dumps({"type": "error", "data": {"message": str(failure)}}) + "\n"
+            return
+
+        yield json.dumps({
+            "type": "metadata",
+            "data": {
+                "status": "processing",
+                "mode": FINAL_ANALYSIS_MODE,
+                "total_articles": len(articles_with_content),
+                "request_id": structured_logging.current_request_id()
+            }
+        }) + "\n"
+
+        stats = {}
+        if FINAL_ANALYSIS_MODE != 'single':
+            unstarted_cards = len(articles_with_content)
+        if FINAL_ANALYSIS_MODE == 'single':
+            prompt, budget_report = assemble_single_prompt(case_notes, disease, events, articles_with_content)
+            stats = {"prompt_budget": budget_report}
+        else:
+            start = time.perf_counter()
+            cards = [None] * len(articles_with_content)
+            executor = ThreadPoolExecutor(max_workers=card_workers(articles_with_content))
+            # From here queued cards are counted by iter_evidence_cards when cancelled
+            unstarted_cards = 0
+            try:
+                completed = 0
+                for idx, card in iter_evidence_cards(articles_with_content, disease, events, executor, cancel):
+                    cards[idx] = card
+                    completed += 1
+                    yield json.dumps({
+                        "type": "evidence_card",
+                        "data": {
+                            "pmcid": card["pmcid"],
+                            "summarized": card["summarized"],
+                            "completed": completed,
+                            "total_articles": len(cards)
+                        }
+                    }) + "\n"
+            except GeneratorExit:
+                cancel.cancel()
+                raise
+            finally:
+                # After a disconnect, queued cards never start and running ones are not awaited
+                executor.shutdown(wait=not cancel.cancelled, cancel_futures=cancel.cancelled)
+            timing["evidence_cards_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            prompt, stats = create_map_reduce_prompt(case_notes, disease, events, articles_with_content, cards)
+
+        usage = {}
+        sections = MarkdownSections()
+        parts = []
+        chunks = iter_analysis_chunks(prompt, usage, cancel)
+        synthesis_started = True
+        start = time.perf_counter()
+        try:
+            for text in chunks:
+                if "first_token_ms" not in timing:
+                    timing["first_token_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                parts.append(text)
+                yield json.dumps({"type": "chunk", "data": {"text": text}}) + "\n"
+                for section in sections.feed(text):
+                    yield json.dumps({"type": "section", "data": section}) + "\n"
+        except GeneratorExit:
+            cancel.cancel()
+            chunks.close()
+            raise
+        timing["generation_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        section = sections.close()
+        if section:
+            yield json.dumps({"type": "section", "data": section}) + "\n"
+        timing["request_total_ms"] = round((time.perf_counter() - request_start) * 1000, 1)
+
+        stages = {"mode": FINAL_ANALYSIS_MODE, "articles": len(articles_with_content),
+                  "prompt_tokens_estimate": estimate_tokens(prompt), **stats}
+        analysis = "".join(parts).strip()
+        if analysis:
+            result_cache.finish(cache_key, flight, {"analysis": {"markdown_content": analysis}, "stages": stages})
+        else:
+            failure = FinalAnalysisError('Failed to generate analysis')
+        slog.info("final_analysis_stages", usage=usage, timing=timing, **stages)
+        yield json.dumps({
+            "type": "metadata",
+            "data": {
+                "status": "complete" if sections.count else "empty",
+                "sections": sections.count,
+                "usage": usage,
+                "timing": timing,
+                "stages": stages,
+                "result_source": result_source,
+                "content_store": article_store.stats()
+            }
+        }) + "\n"
+
+    except GeneratorExit:
+        # The client disconnected or a write to it failed
+        if not cancel.cancelled:
+            cancel.cancel()
+        if result_source == "computed":
+            cancel.record_avoided(calls=unstarted_cards + (0 if synthesis_started else 1))
+        slog.info("request_cancelled", result_source=result_source, **cancel.stats())
+        raise
+    except Exception as e:
+        logger.error(f"Error in stream_final_analysis: {str(e)}")
+        failure = e
+        yield json.dumps({"type": "error", "data": {"message": str(e)}}) + "\n"
+    finally:
+        # Waiters see the error, or recompute if this request was cancelled
+        if flight is not None and not flight.done.is_set():
+            result_cache.finish(cache_key, flight, error=failure)
+        structured_logging.reset_request_id(log_token)
+
+def replay_final_analysis(result, source, request_start):
+    """Stream a cached or coalesced result with the same events as a fresh analysis."""
+    analysis = result["analysis"]["markdown_content"]
+    sections = MarkdownSections()
+    yield json.dumps({
+        "type": "metadata",
+        "data": {
+            "status": "processing",
+            "mode": result["stages"].get("mode", FINAL_ANALYSIS_MODE),
+            "total_articles": result["stages"].get("articles"),
+            "request_id": structured_logging.current_request_id(),
+            "result_source": source
+        }
+    }) + "\n"
+    yield json.dumps({"type": "chunk", "data": {"text": analysis}}) + "\n"
+    for section in sections.feed(analysis):
+        yield json.dumps({"type": "section", "data": section}) + "\n"
+    section = sections.close()
+    if section:
+        yield json.dumps({"type": "section", "data": section}) + "\n"
+    yield json.dumps({
+        "type": "metadata",
+        "data": {
+            "status": "complete" if sections.count else "empty",
+            "sections": sections.count,
+            "usage": {},
+            "timing": {"request_total_ms": round((time.perf_counter() - request_start) * 1000, 1)},
+            "stages": result["stages"],
+            "result_source": source,
+            "content_store": article_store.stats()
+        }
+    }) + "\n"
+
+@functions_framework.http
+def final_analysis_stream(request):
+    """Streaming variant of final_analysis: NDJSON events, markdown forwarded as it is generated."""
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'POST',
+            'Access-Control-Allow-Headers': 'Content-Type, X-Request-Id',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'Connection': 'keep-alive'
+    }
+
+    request_json = request.get_json(silent=True)
+    if not request_json:
+        return jsonify({'error': 'No JSON data received'}), 400, headers
+    missing_fields = missing_request_fields(request_json)
+    if missing_fields:
+        return jsonify({'error': f"Missing required fields: {', '.join(missing_fields)}"}), 400, headers
+
+    return Response(
+        stream_final_analysis(request_json['case_notes'], request_json['disease'], request_json['events'],
+                              request_json['analyzed_articles'], structured_logging.new_request_id(request)),
+        headers=headers,
+        mimetype='text/event-stream'
+    )
 
 if __name__ == "__main__":
     app = functions_framework.create_app(target="final_analysis")
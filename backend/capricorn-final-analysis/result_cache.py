@@ -0,0 +1,305 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Final-analysis results keyed by request hash, with single-flight computation.
+
+final_analysis and final_analysis_stream are separate deployments running at
+--concurrency=1, so an in-process cache alone never sees a second identical
+request. The shared store is chosen by FINAL_ANALYSIS_CACHE:
+    (empty)             in-process only (the default)
+    gs://bucket/prefix  results and in-flight leases in Cloud Storage
+Cloud Storage was chosen because the function already depends on it for the
+article content store; both deployments must point at the same prefix.
+
+With a shared store, the first instance to see a key takes a lease object
+(<key>.lease, created only if absent) and computes; other instances poll for
+<key>.json until it appears or the lease goes away, then take over. A leader
+that dies leaves its lease to expire after FINAL_ANALYSIS_LEASE_SECONDS.
+A leader only ever deletes the lease generation it created, so one that
+outlives its lease cannot release the lease of the instance that took over.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class Flight:
+    """One in-progress computation that identical requests wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.waiters = 0
+        # Set when this instance holds the shared lease for the key
+        self.leased = False
+
+    def wait(self):
+        """Return the leader's value, re-raise its error, or return None if it was abandoned."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class GCSResultStore:
+    """Results and leases as JSON objects under gs://bucket/prefix."""
+
+    def __init__(self, bucket_name, prefix="", ttl_seconds=3600, lease_seconds=900, poll_seconds=2.0):
+        from google.cloud import storage
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+        self._not_found = NotFound
+        self._precondition_failed = PreconditionFailed
+        self.bucket = storage.Client().bucket(bucket_name)
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        # Generation of each lease this instance holds
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def _read(self, name):
+        """Return (payload, generation) of an object, or (None, None) if it does not exist."""
+        blob = self.bucket.blob(self.prefix + name)
+        try:
+            data = blob.download_as_bytes()
+        except self._not_found:
+            return None, None
+        return json.loads(data), blob.generation
+
+    def get(self, key):
+        payload, _ = self._read(f"{key}.json")
+        if payload is None or payload.get('expires_at', 0) < time.time():
+            return None
+        return payload.get('value')
+
+    def put(self, key, value):
+        payload = {"expires_at": time.time() + self.ttl_seconds, "value": value}
+        self.bucket.blob(f"{self.prefix}{key}.json").upload_from_string(
+            json.dumps(payload, default=str), content_type='application/json')
+
+    def try_lease(self, key):
+        """Take the lease for key; False if another live instance holds it."""
+        lease = json.dumps({"expires_at": time.time() + self.lease_seconds})
+        for _ in range(2):
+            blob = self.bucket.blob(f"{self.prefix}{key}.lease")
+            try:
+                blob.upload_from_string(lease, content_type='application/json', if_generation_match=0)
+                with self._lock:
+                    self._leases[key] = blob.generation
+                return True
+            except self._precondition_failed:
+                payload, generation = self._read(f"{key}.lease")
+                if payload is not None and payload.get('expires_at', 0) >= time.time():
+                    return False
+                if payload is not None:
+                    # Expired: remove it unless someone else replaced it meanwhile
+                    try:
+                        self.bucket.blob(f"{self.prefix}{key}.lease").delete(if_generation_match=generation)
+                    except (self._not_found, self._precondition_failed):
+                        pass
+        return False
+
+    def release(self, key):
+        with self._lock:
+            generation = self._leases.pop(key, None)
+        if generation is None:
+            return
+        try:
+            self.bucket.blob(f"{self.prefix}{key}.lease").delete(if_generation_match=generation)
+        except (self._not_found, self._precondition_failed):
+            # Expired, and possibly taken over by another instance
+            pass
+
+    def wait(self, key):
+        """Poll until the leader publishes key (its value) or its lease is gone or expired (None)."""
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value
+            payload, _ = self._read(f"{key}.lease")
+            if payload is None or payload.get('expires_at', 0) < time.time():
+                # The leader may have published just before releasing
+                return self.get(key)
+            time.sleep(self.poll_seconds)
+
+
+class ResultCache:
+    """Bounded TTL cache of final analyses with single-flight computation.
+
+    The first request for a key leads and computes; identical requests that
+    arrive while it runs wait for its result instead of repeating the
+    BigQuery fetch and Gemini calls. Only successful results are cached.
+    With a shared store, the cache and the single flight extend to every
+    instance of both deployments.
+    """
+
+    def __init__(self, max_entries=128, ttl_seconds=3600, shared=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._coalesced = 0
+        self._computed = 0
+        self._shared_hits = 0
+        self._remote_coalesced = 0
+        self._shared_errors = 0
+
+    def _shared_error(self, action, e):
+        logger.warning(f"Shared result cache {action} failed: {str(e)}")
+        with self._lock:
+            self._shared_errors += 1
+
+    def begin(self, key):
+        """Return ("cache", value), ("follow", flight) or ("lead", flight) for key."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[1] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return "cache", entry[0]
+            self._entries.pop(key, None)
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                self._coalesced += 1
+                return "follow", flight
+            flight = self._flights[key] = Flight()
+            if self.shared is None:
+                self._computed += 1
+                return "lead", flight
+
+        # The local flight is registered, so identical local requests wait on it
+        # while the shared store is consulted outside the lock
+        try:
+            value = self.shared.get(key)
+        except Exception as e:
+            self._shared_error("read", e)
+            value = None
+        if value is not None:
+            self.finish(key, flight, value)
+            with self._lock:
+                self._hits += 1
+                self._shared_hits += 1
+            return "cache", value
+
+        try:
+            flight.leased = self.shared.try_lease(key)
+        except Exception as e:
+            # Without a usable lease, compute rather than wait on nothing
+            self._shared_error("lease", e)
+            with self._lock:
+                self._computed += 1
+            return "lead", flight
+        if flight.leased:
+            with self._lock:
+                self._computed += 1
+            return "lead", flight
+
+        # Another instance is computing: wait for its result on behalf of this flight
+        threading.Thread(target=self._await_remote, args=(key, flight), daemon=True).start()
+        with self._lock:
+            self._coalesced += 1
+            self._remote_coalesced += 1
+        return "follow", flight
+
+    def _await_remote(self, key, flight):
+        try:
+            value = self.shared.wait(key)
+        except Exception as e:
+            self._shared_error("wait", e)
+            value = None
+        # No value abandons the flight, so its waiters retry and one of them takes the lease
+        self.finish(key, flight, value)
+
+    def finish(self, key, flight, value=None, error=None):
+        """Publish the leader's result to its waiters and cache a successful value.
+
+        Finishing with neither a value nor an error abandons the flight (the
+        leader's client went away); waiters then start a computation of their own.
+        """
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if error is None and value is not None:
+                self._entries[key] = (value, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        if flight.leased:
+            try:
+                if error is None and value is not None:
+                    self.shared.put(key, value)
+                self.shared.release(key)
+            except Exception as e:
+                self._shared_error("write", e)
+        flight.value = value
+        flight.error = error
+        flight.done.set()
+
+    def get_or_compute(self, key, compute):
+        """Return (value, source) where source is "cache", "coalesced" or "computed"."""
+        while True:
+            source, found = self.begin(key)
+            if source == "cache":
+                return found, source
+            if source == "lead":
+                break
+            value = found.wait()
+            if value is not None:
+                return value, "coalesced"
+        try:
+            value = compute()
+        except Exception as e:
+            self.finish(key, found, error=e)
+            raise
+        self.finish(key, found, value)
+        return value, "computed"
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._coalesced + self._computed
+            return {
+                "shared": type(self.shared).__name__ if self.shared else None,
+                "hits": self._hits,
+                "shared_hits": self._shared_hits,
+                "coalesced": self._coalesced,
+                "remote_coalesced": self._remote_coalesced,
+                "computed": self._computed,
+                "hit_rate": round((self._hits + self._coalesced) / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+                "in_flight": len(self._flights),
+                "shared_errors": self._shared_errors,
+            }
+
+
+def open_cache(spec, max_entries=128, ttl_seconds=3600, lease_seconds=900):
+    """Create a ResultCache from a FINAL_ANALYSIS_CACHE value."""
+    spec = (spec or "").strip()
+    if not spec:
+        return ResultCache(max_entries, ttl_seconds)
+    if spec.startswith("gs://"):
+        bucket, _, prefix = spec[len("gs://"):].partition("/")
+        return ResultCache(max_entries, ttl_seconds,
+                           GCSResultStore(bucket, prefix, ttl_seconds=ttl_seconds, lease_seconds=lease_seconds))
+    raise ValueError(f"Unknown FINAL_ANALYSIS_CACHE: {spec}")
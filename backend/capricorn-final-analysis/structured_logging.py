@@ -0,0 +1,175 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Structured, size-capped logging shared by the Capricorn Cloud Functions.
+
+Each Cloud Function deploys from its own directory, so this module is copied
+into every function that uses it. Keep the copies identical.
+
+Log records are single-line JSON objects tagged with the current request ID.
+Large bodies (article texts, prompts, model output) are logged as a size and
+content hash. Full bodies are only written for request IDs listed in
+LOG_DEBUG_REQUEST_IDS. Formatting is deferred until a handler actually emits
+the record, and high-volume events can be sampled.
+"""
+
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import uuid
+
+LOG_FIELD_MAX_CHARS = int(os.environ.get('LOG_FIELD_MAX_CHARS', '1000'))
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+LOG_DEBUG_REQUEST_IDS = {
+    request_id.strip() for request_id in os.environ.get('LOG_DEBUG_REQUEST_IDS', '').split(',') if request_id.strip()
+}
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+
+
+def new_request_id(request=None):
+    """Use the caller's X-Request-Id or Cloud trace ID when present, otherwise a fresh UUID."""
+    if request is not None:
+        header = request.headers.get('X-Request-Id') or request.headers.get('X-Cloud-Trace-Context', '')
+        header = header.split('/')[0].strip()
+        if header:
+            return header
+    return uuid.uuid4().hex
+
+
+def set_request_id(request_id):
+    """Tag subsequent records in this context with request_id; returns a token for reset_request_id."""
+    return _request_id.set(request_id)
+
+
+def reset_request_id(token):
+    try:
+        _request_id.reset(token)
+    except ValueError:
+        # A streaming generator may be closed from a different context
+        _request_id.set(None)
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def propagate(fn):
+    """Wrap fn so it runs with the caller's request ID, e.g. when submitted to a thread pool."""
+    request_id = _request_id.get()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _request_id.set(request_id)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _request_id.reset(token)
+    return wrapper
+
+
+def enable_debug(request_id):
+    """Capture full payloads for request_id from now on (in this process)."""
+    LOG_DEBUG_REQUEST_IDS.add(request_id)
+
+
+def debug_enabled():
+    return _request_id.get() in LOG_DEBUG_REQUEST_IDS
+
+
+def digest(text):
+    """Describe a body by size and content hash instead of logging it."""
+    text = text if isinstance(text, str) else json.dumps(text, default=str)
+    return {"chars": len(text), "sha256": hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]}
+
+
+def cap(value, limit=None):
+    """Truncate a field to at most limit characters, noting how much was cut."""
+    limit = LOG_FIELD_MAX_CHARS if limit is None else limit
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if not isinstance(value, str):
+        text = json.dumps(value, default=str)
+        if len(text) <= limit:
+            return value
+    else:
+        text = value
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...[+{len(text) - limit} chars]"
+
+
+class _LazyRecord:
+    """Defers capping, hashing and JSON encoding until the record is formatted."""
+
+    def __init__(self, event, fields, payloads, request_id, full_payloads):
+        self.event = event
+        self.fields = fields
+        self.payloads = payloads
+        self.request_id = request_id
+        self.full_payloads = full_payloads
+
+    def __str__(self):
+        record = {"event": self.event, "request_id": self.request_id}
+        for key, value in self.fields.items():
+            record[key] = cap(value() if callable(value) else value)
+        for key, value in self.payloads.items():
+            value = value() if callable(value) else value
+            record[key] = value if self.full_payloads else digest(value)
+        return json.dumps(record, default=str)
+
+
+class StructuredLogger:
+    """Thin wrapper over a stdlib logger that emits capped, sampled JSON records."""
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def log(self, level, event, sample_rate=None, payloads=None, **fields):
+        """Log event with fields capped to LOG_FIELD_MAX_CHARS.
+
+        payloads are large bodies: logged as size + hash, or in full for debug
+        request IDs. sample_rate (default 1) drops that fraction of records
+        except for debug request IDs. Callable values are evaluated lazily.
+        """
+        if not self.logger.isEnabledFor(level):
+            return
+        full_payloads = debug_enabled()
+        if not full_payloads and sample_rate is not None and random.random() >= sample_rate:
+            return
+        self.logger.log(level, "%s", _LazyRecord(event, fields, payloads or {}, _request_id.get(), full_payloads))
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def sampled(self, event, **fields):
+        """INFO record subject to LOG_SAMPLE_RATE, for high-volume per-item events."""
+        self.log(logging.INFO, event, sample_rate=LOG_SAMPLE_RATE, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+
+def get_logger(name):
+    return StructuredLogger(logging.getLogger(name))
@@ -0,0 +1,44 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run from this function's directory: python -m pytest tests
+
+main.py creates its Gemini and BigQuery clients at import time, so the
+`main` fixture imports it with anonymous credentials and BigQuery queries
+disabled.
+"""
+
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def main():
+    import google.auth
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import bigquery
+
+    patch = pytest.MonkeyPatch()
+    patch.setattr(google.auth, "default", lambda *args, **kwargs: (AnonymousCredentials(), "test-project"))
+    patch.setattr(bigquery.Client, "query", lambda *args, **kwargs: (_ for _ in ()).throw(RuntimeError("offline")))
+    patch.delenv("ARTICLE_CONTENT_STORE", raising=False)
+    patch.delenv("FINAL_ANALYSIS_CACHE", raising=False)
+    module = importlib.import_module("main")
+    yield module
+    patch.undo()
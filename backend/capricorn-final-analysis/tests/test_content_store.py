@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+import content_store
+
+
+class DictBackend:
+    """Shared-backend stand-in that can be made to fail."""
+
+    def __init__(self, fail=False):
+        self.texts = {}
+        self.fail = fail
+        self.gets = []
+
+    def get(self, pmcid):
+        self.gets.append(pmcid)
+        if self.fail:
+            raise OSError("backend down")
+        return self.texts.get(pmcid)
+
+    def put(self, pmcid, text):
+        if self.fail:
+            raise OSError("backend down")
+        self.texts[pmcid] = text
+
+
+def test_memory_backend_evicts_least_recent_by_characters():
+    memory = content_store.MemoryBackend(max_chars=10)
+    memory.put("PMC1", "aaaa")
+    memory.put("PMC2", "bbbb")
+    memory.get("PMC1")
+    memory.put("PMC3", "cccc")
+    assert memory.get("PMC2") is None
+    assert (memory.get("PMC1"), memory.get("PMC3")) == ("aaaa", "cccc")
+
+
+def test_memory_backend_keeps_one_oversized_text():
+    memory = content_store.MemoryBackend(max_chars=2)
+    memory.put("PMC1", "a long article")
+    assert memory.get("PMC1") == "a long article"
+
+
+def test_disk_backend_round_trip_and_prune(tmp_path):
+    disk = content_store.DiskBackend(str(tmp_path), max_bytes=0)
+    disk.put("PMC1", "first article")
+    assert disk.get("PMC1") == "first article"
+    assert disk.get("PMC2") is None
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+    disk.prune()
+    assert disk.get("PMC1") is None
+
+
+def test_backend_reads_fill_memory_and_count_hits():
+    backend = DictBackend()
+    backend.texts = {"PMC1": "one", "PMC2": "two"}
+    store = content_store.ArticleContentStore(backend)
+
+    assert store.get_many(["PMC1", "PMC2", "PMC3", "PMC1"]) == {"PMC1": "one", "PMC2": "two"}
+    assert store.get_many(["PMC1"]) == {"PMC1": "one"}
+    assert backend.gets.count("PMC1") == 1
+    stats = store.stats()
+    assert (stats["hits"], stats["misses"], stats["bytes_saved"]) == (3, 1, 9)
+
+
+def test_writes_reach_the_backend():
+    backend = DictBackend()
+    store = content_store.ArticleContentStore(backend)
+    store.put_many({"PMC1": "one", "PMC2": "", None: "orphan"}, wait=True)
+    assert backend.texts == {"PMC1": "one"}
+    assert store.stats()["puts"] == 1
+
+
+def test_backend_failures_are_counted_not_raised():
+    store = content_store.ArticleContentStore(DictBackend(fail=True))
+    store.put("PMC1", "one", wait=True)
+    # The in-process LRU still serves the text
+    assert store.get_many(["PMC1", "PMC2"]) == {"PMC1": "one"}
+    assert store.stats()["errors"] == 2
+
+
+def test_open_store_specs(tmp_path):
+    assert content_store.open_store(None).stats()["backend"] == "MemoryBackend"
+    assert content_store.open_store(f"disk:{tmp_path}").stats()["backend"] == "DiskBackend"
+    with pytest.raises(ValueError):
+        content_store.open_store("s3://bucket")
+
+
+def test_final_analysis_fetches_only_store_misses(main, monkeypatch):
+    store = content_store.ArticleContentStore()
+    store.put("PMC1", "stored text")
+    fetched = []
+
+    def fetch(pmcids):
+        fetched.extend(pmcids)
+        return {pmcid: f"{pmcid} from BigQuery" for pmcid in pmcids}
+
+    monkeypatch.setattr(main, "article_store", store)
+    monkeypatch.setattr(main, "fetch_article_contents", fetch)
+
+    articles = main.get_full_articles([{"pmcid": "PMC1", "points": 3}, {"pmcid": "PMC2", "points": 2}])
+
+    assert fetched == ["PMC2"]
+    assert [(article["pmcid"], article["content"]) for article in articles] == [
+        ("PMC1", "stored text"), ("PMC2", "PMC2 from BigQuery")]
+    assert store.get_many(["PMC2"]) == {"PMC2": "PMC2 from BigQuery"}
+
+
+def test_copies_are_identical():
+    backend = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    copies = set()
+    for function in ("capricorn-retrieve-full-articles", "capricorn-final-analysis"):
+        with open(os.path.join(backend, function, "content_store.py"), encoding="utf-8") as file:
+            copies.add(file.read())
+    assert len(copies) == 1
@@ -0,0 +1,123 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from cancellation import CancellationToken
+
+
+def article(pmcid, points, content="Full text."):
+    return {"pmcid": pmcid, "title": f"Title {pmcid}", "journal_title": "Blood", "year": "2022",
+            "paper_type": "clinical trial", "overall_points": points, "content": content,
+            "events": [{"event": "ALK F1174L", "matches_query": True}]}
+
+
+class FakeModels:
+    def __init__(self, fail_for=(), delay=0.0):
+        self.fail_for = set(fail_for)
+        self.delay = delay
+        self.prompts = []
+
+    def generate_content(self, model, contents, config):
+        prompt = contents[0].parts[0].text
+        self.prompts.append(prompt)
+        time.sleep(self.delay)
+        pmcid = next(pmcid for pmcid in ("PMC1", "PMC2", "PMC3") if f"text of {pmcid}" in prompt)
+        if pmcid in self.fail_for:
+            raise RuntimeError("card model unavailable")
+        return SimpleNamespace(text=f" Population: children ({pmcid}) ",
+                               usage_metadata=SimpleNamespace(prompt_token_count=100, candidates_token_count=20))
+
+
+@pytest.fixture
+def models(main, monkeypatch):
+    def install(**kwargs):
+        fake = FakeModels(**kwargs)
+        monkeypatch.setattr(main, "genai_client", SimpleNamespace(models=fake))
+        return fake
+    return install
+
+
+def test_card_holds_metadata_and_summary(main, models):
+    models()
+    card = main.build_evidence_card(article("PMC1", 90, "text of PMC1"), "neuroblastoma", ["ALK F1174L"])
+    assert card["summarized"]
+    assert card["text"].startswith("PMCID: PMC1\nTitle: Title PMC1")
+    assert card["text"].endswith("Evidence Summary:\nPopulation: children (PMC1)")
+    assert (card["input_tokens"], card["output_tokens"]) == (100, 20)
+
+
+def test_failed_card_falls_back_to_metadata(main, models):
+    models(fail_for={"PMC1"})
+    card = main.build_evidence_card(article("PMC1", 90, "text of PMC1"), "neuroblastoma", ["ALK F1174L"])
+    assert not card["summarized"]
+    assert "Title: Title PMC1" in card["text"]
+    assert card["text"].endswith("Not available; rely on the metadata above.")
+    assert card["input_tokens"] == 0
+
+
+def test_card_prompt_text_is_capped(main, models, monkeypatch):
+    fake = models()
+    monkeypatch.setattr(main, "CARD_ARTICLE_MAX_TOKENS", 10)
+    main.build_evidence_card(article("PMC1", 90, "text of PMC1" + "x" * 1000), "neuroblastoma", ["ALK"])
+    assert "text of PMC1" + "x" * 28 + "\n</Article>" in fake.prompts[0]
+
+
+def test_cards_are_built_in_parallel_and_kept_in_order(main, models):
+    models(delay=0.1)
+    articles = [article(f"PMC{n}", n, f"text of PMC{n}") for n in (1, 2, 3)]
+    start = time.perf_counter()
+    cards = main.build_evidence_cards(articles, "neuroblastoma", ["ALK"])
+    assert [card["pmcid"] for card in cards] == ["PMC1", "PMC2", "PMC3"]
+    assert time.perf_counter() - start < 0.25
+
+
+def test_queued_cards_are_counted_as_avoided_when_cancelled(main, models):
+    second_started, release = threading.Event(), threading.Event()
+    fake = models()
+    original = fake.generate_content
+
+    def slow_after_first(**kwargs):
+        if "text of PMC1" not in kwargs["contents"][0].parts[0].text:
+            second_started.set()
+            release.wait(5)
+        return original(**kwargs)
+
+    fake.generate_content = slow_after_first
+    cancel = CancellationToken()
+    articles = [article(f"PMC{n}", n, f"text of PMC{n}") for n in (1, 2, 3)]
+    executor = ThreadPoolExecutor(max_workers=1)
+    cards = main.iter_evidence_cards(articles, "neuroblastoma", ["ALK"], executor, cancel=cancel)
+    assert next(cards)[1]["pmcid"] == "PMC1"
+    second_started.wait(5)
+
+    # What a client disconnect does: stop reading, then cancel the queued cards
+    cards.close()
+    executor.shutdown(wait=False, cancel_futures=True)
+    release.set()
+    executor.shutdown(wait=True)
+    # PMC2 was already running; only PMC3 never started
+    assert cancel.stats()["avoided_calls"] == 1
+
+
+def test_full_text_goes_to_the_best_articles_that_fit(main):
+    articles = [article("PMC1", 10, "a" * 400), article("PMC2", 90, "b" * 4000), article("PMC3", 50, "c" * 400)]
+    selected = main.select_full_text_articles(articles, token_budget=250, max_articles=2)
+    assert [item["pmcid"] for item in selected] == ["PMC3", "PMC1"]
+    assert [item["pmcid"] for item in main.select_full_text_articles(articles, 2000, 1)] == ["PMC2"]
+
+
+def test_synthesis_prompt_has_every_card_and_only_selected_full_texts(main, monkeypatch):
+    monkeypatch.setattr(main, "FULL_TEXT_MAX_ARTICLES", 1)
+    articles = [article("PMC1", 10, "text of PMC1"), article("PMC2", 90, "text of PMC2")]
+    cards = [{"pmcid": pmcid, "text": f"card of {pmcid}", "summarized": True, "input_tokens": 5, "output_tokens": 2}
+             for pmcid in ("PMC1", "PMC2")]
+
+    prompt, stats = main.create_map_reduce_prompt("Case", "neuroblastoma", ["ALK"], articles, cards)
+
+    assert "card of PMC1" in prompt and "card of PMC2" in prompt
+    assert "text of PMC2" in prompt and "text of PMC1" not in prompt
+    assert stats["full_text_pmcids"] == ["PMC2"]
+    assert (stats["cards_summarized"], stats["card_input_tokens"], stats["card_output_tokens"]) == (2, 10, 4)
@@ -0,0 +1,100 @@
+import random
+
+import pytest
+
+
+def article(pmcid, points, tokens):
+    return {"pmcid": pmcid, "title": f"Title {pmcid}", "overall_points": points, "content": "x" * (tokens * 4)}
+
+
+def test_allocation_fits_when_everything_fits(main):
+    assert main.allocate_text_budgets([(10, 100), (10, 50)], 1000, min_text_tokens=20) == [100, 50]
+
+
+def test_lowest_ranked_text_is_trimmed_first(main):
+    # 30 tokens over: taken from the last entry only, which stays above its floor
+    assert main.allocate_text_budgets([(10, 100), (10, 100)], 190, min_text_tokens=20) == [100, 70]
+
+
+def test_texts_go_to_the_floor_then_away_then_entries_are_dropped(main):
+    entries = [(10, 100), (10, 100), (10, 100)]
+    assert main.allocate_text_budgets(entries, 90, min_text_tokens=20) == [20, 20, 20]
+    assert main.allocate_text_budgets(entries, 45, min_text_tokens=20) == [15, 0, 0]
+    assert main.allocate_text_budgets(entries, 15, min_text_tokens=20) == [0, None, None]
+
+
+def test_allocation_stays_within_budget(main):
+    rng = random.Random(0)
+    for _ in range(500):
+        entries = [(rng.randrange(0, 200), rng.randrange(0, 5000)) for _ in range(rng.randrange(1, 12))]
+        available = rng.randrange(0, 20000)
+        allowances = main.allocate_text_budgets(entries, available, min_text_tokens=rng.randrange(0, 500))
+        kept = [(fixed, allowance) for (fixed, _), allowance in zip(entries, allowances) if allowance is not None]
+        assert all(0 <= allowance <= text for (_, text), allowance in zip(entries, allowances) if allowance is not None)
+        assert sum(fixed + allowance for fixed, allowance in kept) <= available or not kept
+        # Nothing is dropped or trimmed when everything fits
+        if sum(fixed + text for fixed, text in entries) <= available:
+            assert allowances == [text for _, text in entries]
+
+
+def test_trim_text_marks_the_cut(main):
+    assert main.trim_text("short", 100) == "short"
+    trimmed = main.trim_text("y" * 4000, 100)
+    assert trimmed.endswith(main.TRIMMED_MARKER)
+    assert main.estimate_tokens(trimmed) <= 100
+    assert main.trim_text("y" * 4000, 1) == ""
+
+
+@pytest.mark.parametrize("budget", [3000, 8000, 20000, 60000])
+def test_single_prompt_stays_within_budget(main, budget):
+    articles = [article(f"PMC{n}", points, 5000) for n, points in enumerate([30, 90, 10, 60, 50])]
+    prompt, report = main.assemble_single_prompt("Case notes", "neuroblastoma", ["ALK F1174L"], articles, budget)
+    assert main.estimate_tokens(prompt) <= budget
+    assert report["prompt_tokens_estimate"] <= budget
+    assert report["articles_included"] + len(report["articles_dropped"]) == 5
+
+
+def test_lowest_scored_articles_lose_text_first(main):
+    articles = [article("PMC_LOW", 10, 5000), article("PMC_HIGH", 90, 5000)]
+    prompt, report = main.assemble_single_prompt("Case notes", "neuroblastoma", ["ALK"], articles, 8000)
+    assert [item["pmcid"] for item in report["articles_trimmed"]] == ["PMC_LOW"]
+    assert report["articles_dropped"] == []
+    # Articles keep their original order in the prompt
+    assert prompt.index("PMC_LOW") < prompt.index("PMC_HIGH")
+
+
+def test_map_reduce_prompt_trims_full_texts_but_keeps_cards(main, monkeypatch):
+    monkeypatch.setattr(main, "FULL_TEXT_TOKEN_BUDGET", 100000)
+    articles = [article(f"PMC{n}", 100 - n, 6000) for n in range(3)]
+    cards = [{"pmcid": item["pmcid"], "text": f"card of {item['pmcid']}", "summarized": True, "input_tokens": 0,
+              "output_tokens": 0} for item in articles]
+
+    prompt, stats = main.create_map_reduce_prompt("Case", "neuroblastoma", ["ALK"], articles, cards, budget=12000)
+
+    assert main.estimate_tokens(prompt) <= 12000
+    assert all(f"card of PMC{n}" in prompt for n in range(3))
+    report = stats["prompt_budget"]
+    assert report["articles_dropped"] == []
+    # The best full text is kept whole; the lowest-scored one is cut to the floor first
+    assert [item["pmcid"] for item in report["articles_trimmed"]] == ["PMC1", "PMC2"]
+    assert report["articles_trimmed"][1]["kept_tokens"] == main.ARTICLE_MIN_TEXT_TOKENS
+    assert stats["full_text_pmcids"] == ["PMC0", "PMC1", "PMC2"]
+
+
+def test_case_information_over_budget_is_an_error(main):
+    with pytest.raises(main.FinalAnalysisError):
+        main.assemble_single_prompt("z" * 40000, "neuroblastoma", ["ALK"], [article("PMC1", 1, 10)], 5000)
+
+
+@pytest.mark.parametrize("budget", [2000, 5000, 9000, 15000, 40000])
+def test_map_reduce_prompt_stays_within_budget_without_dropping_cards(main, monkeypatch, budget):
+    monkeypatch.setattr(main, "FULL_TEXT_TOKEN_BUDGET", 100000)
+    rng = random.Random(budget)
+    articles = [article(f"PMC{n}", rng.randrange(100), rng.randrange(100, 8000)) for n in range(4)]
+    cards = [{"pmcid": item["pmcid"], "text": f"card of {item['pmcid']}", "summarized": True, "input_tokens": 0,
+              "output_tokens": 0} for item in articles]
+
+    prompt, stats = main.create_map_reduce_prompt("Case", "neuroblastoma", ["ALK"], articles, cards, budget=budget)
+
+    assert main.estimate_tokens(prompt) <= budget
+    assert stats["prompt_budget"]["articles_dropped"] == []
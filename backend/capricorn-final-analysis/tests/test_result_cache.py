@@ -0,0 +1,284 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import flask
+import pytest
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+import result_cache
+from result_cache import ResultCache
+
+
+class SharedStore:
+    """In-memory stand-in for GCSResultStore, shared by several ResultCaches."""
+
+    def __init__(self):
+        self.values = {}
+        self.leases = set()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def put(self, key, value):
+        self.values[key] = value
+
+    def try_lease(self, key):
+        with self.lock:
+            if key in self.leases:
+                return False
+            self.leases.add(key)
+            return True
+
+    def release(self, key):
+        self.leases.discard(key)
+
+    def wait(self, key):
+        while key in self.leases and key not in self.values:
+            time.sleep(0.01)
+        return self.values.get(key)
+
+
+def run_concurrently(calls):
+    results = [None] * len(calls)
+    threads = [threading.Thread(target=lambda idx=idx, call=call: results.__setitem__(idx, call()))
+               for idx, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def slow_compute(counter, value="analysis"):
+    def compute():
+        counter.append(1)
+        time.sleep(0.1)
+        return {"value": value}
+    return compute
+
+
+def test_concurrent_identical_calls_are_coalesced():
+    cache = ResultCache()
+    computed = []
+    results = run_concurrently([lambda: cache.get_or_compute("key", slow_compute(computed))] * 5)
+    assert len(computed) == 1
+    assert sorted(source for _, source in results) == ["coalesced"] * 4 + ["computed"]
+    assert all(value == {"value": "analysis"} for value, _ in results)
+    assert cache.get_or_compute("key", slow_compute(computed)) == ({"value": "analysis"}, "cache")
+    assert cache.stats()["hit_rate"] == pytest.approx(5 / 6, abs=1e-3)
+
+
+def test_errors_reach_followers_and_are_not_cached():
+    cache = ResultCache()
+    started = threading.Event()
+
+    def failing():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("model unavailable")
+
+    def lead():
+        try:
+            cache.get_or_compute("key", failing)
+        except ValueError as e:
+            return str(e)
+
+    def follow():
+        started.wait(5)
+        try:
+            cache.get_or_compute("key", lambda: pytest.fail("follower must not compute"))
+        except ValueError as e:
+            return str(e)
+
+    assert run_concurrently([lead, follow]) == ["model unavailable"] * 2
+    assert cache.get_or_compute("key", lambda: {"value": 1}) == ({"value": 1}, "computed")
+
+
+def test_abandoned_flight_lets_a_follower_compute():
+    cache = ResultCache()
+    source, flight = cache.begin("key")
+    assert source == "lead"
+    results = []
+    follower = threading.Thread(target=lambda: results.append(cache.get_or_compute("key", lambda: {"value": 2})))
+    follower.start()
+    time.sleep(0.05)
+    cache.finish("key", flight)
+    follower.join(5)
+    assert results == [({"value": 2}, "computed")]
+
+
+def test_entries_expire_and_are_bounded():
+    cache = ResultCache(max_entries=1, ttl_seconds=0.05)
+    cache.get_or_compute("a", lambda: 1)
+    cache.get_or_compute("b", lambda: 2)
+    assert cache.get_or_compute("a", lambda: 1)[1] == "computed"
+    time.sleep(0.1)
+    assert cache.get_or_compute("a", lambda: 1)[1] == "computed"
+    assert cache.stats()["entries"] == 1
+
+
+def test_instances_sharing_a_store_compute_once():
+    store = SharedStore()
+    first, second = ResultCache(shared=store), ResultCache(shared=store)
+    computed = []
+    results = run_concurrently([lambda cache=cache: cache.get_or_compute("key", slow_compute(computed))
+                                for cache in (first, second, first, second)])
+    assert len(computed) == 1
+    assert [value for value, _ in results] == [{"value": "analysis"}] * 4
+    assert store.leases == set()
+    # A third instance finds the published result
+    assert ResultCache(shared=store).get_or_compute("key", slow_compute(computed)) == ({"value": "analysis"}, "cache")
+
+
+def test_remote_leader_that_gives_up_is_taken_over():
+    store = SharedStore()
+    leader, waiter = ResultCache(shared=store), ResultCache(shared=store)
+    source, flight = leader.begin("key")
+    assert source == "lead" and flight.leased
+    results = []
+    thread = threading.Thread(target=lambda: results.append(waiter.get_or_compute("key", lambda: {"value": 3})))
+    thread.start()
+    time.sleep(0.05)
+    leader.finish("key", flight)
+    thread.join(5)
+    assert results == [({"value": 3}, "computed")]
+    assert waiter.stats()["remote_coalesced"] == 1
+
+
+def test_unreachable_store_falls_back_to_computing():
+    class BrokenStore(SharedStore):
+        def get(self, key):
+            raise OSError("store down")
+
+        def try_lease(self, key):
+            raise OSError("store down")
+
+    cache = ResultCache(shared=BrokenStore())
+    assert cache.get_or_compute("key", lambda: {"value": 4}) == ({"value": 4}, "computed")
+    assert cache.stats()["shared_errors"] == 2
+
+
+class FakeBucket:
+    """Just enough of a Cloud Storage bucket for generation-matched writes and deletes."""
+
+    def __init__(self):
+        self.objects = {}
+        self.generation = 0
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+
+    def download_as_bytes(self):
+        if self.name not in self.bucket.objects:
+            raise NotFound(self.name)
+        data, self.generation = self.bucket.objects[self.name]
+        return data
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        current = self.bucket.objects.get(self.name)
+        if if_generation_match is not None and (current[1] if current else 0) != if_generation_match:
+            raise PreconditionFailed(self.name)
+        self.bucket.generation += 1
+        self.bucket.objects[self.name] = (data.encode("utf-8"), self.bucket.generation)
+        self.generation = self.bucket.generation
+
+    def delete(self, if_generation_match=None):
+        current = self.bucket.objects.get(self.name)
+        if current is None:
+            raise NotFound(self.name)
+        if if_generation_match is not None and current[1] != if_generation_match:
+            raise PreconditionFailed(self.name)
+        del self.bucket.objects[self.name]
+
+
+@pytest.fixture
+def gcs_store(monkeypatch):
+    from google.cloud import storage
+    monkeypatch.setattr(storage, "Client", lambda: SimpleNamespace(bucket=lambda name: FakeBucket()))
+    return result_cache.GCSResultStore("bucket", "final-analysis", ttl_seconds=60, lease_seconds=60,
+                                       poll_seconds=0.01)
+
+
+def test_gcs_lease_is_exclusive_until_released(gcs_store):
+    assert gcs_store.try_lease("key")
+    assert not gcs_store.try_lease("key")
+    gcs_store.put("key", {"value": 1})
+    gcs_store.release("key")
+    assert gcs_store.get("key") == {"value": 1}
+    assert gcs_store.wait("key") == {"value": 1}
+    assert gcs_store.try_lease("key")
+
+
+def test_gcs_expired_lease_is_taken_over(gcs_store):
+    gcs_store.bucket.objects["final-analysis/key.lease"] = (json.dumps({"expires_at": time.time() - 1}).encode(), 7)
+    assert gcs_store.wait("key") is None
+    assert gcs_store.try_lease("key")
+
+
+def test_gcs_release_leaves_a_lease_taken_over_after_expiry(gcs_store):
+    other = result_cache.GCSResultStore("bucket", "final-analysis", lease_seconds=60)
+    other.bucket = gcs_store.bucket
+    gcs_store.lease_seconds = -1
+    assert gcs_store.try_lease("key")
+    # The first leader's lease expires and another instance takes over
+    assert other.try_lease("key")
+    gcs_store.release("key")
+    assert not gcs_store.try_lease("key")
+    assert "final-analysis/key.lease" in gcs_store.bucket.objects
+    other.release("key")
+    assert "final-analysis/key.lease" not in gcs_store.bucket.objects
+
+
+def test_gcs_expired_result_is_a_miss(gcs_store):
+    gcs_store.ttl_seconds = -1
+    gcs_store.put("key", {"value": 1})
+    assert gcs_store.get("key") is None
+
+
+def test_open_cache_specs(gcs_store):
+    assert result_cache.open_cache("").stats()["shared"] is None
+    assert result_cache.open_cache("gs://bucket/prefix").stats()["shared"] == "GCSResultStore"
+    with pytest.raises(ValueError):
+        result_cache.open_cache("redis://cache")
+
+
+def test_stream_and_blocking_deployments_share_results(main, monkeypatch):
+    """A streamed analysis is served from the shared store to the blocking endpoint on another instance."""
+    store = SharedStore()
+    calls = []
+
+    def stream(model, contents, config):
+        calls.append(model)
+        part = SimpleNamespace(text="## Summary\nUse crizotinib.\n")
+        yield SimpleNamespace(text=part.text, usage_metadata=None,
+                              candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+    monkeypatch.setattr(main, "FINAL_ANALYSIS_MODE", "single")
+    monkeypatch.setattr(main, "genai_client", SimpleNamespace(models=SimpleNamespace(generate_content_stream=stream)))
+    monkeypatch.setattr(main, "get_full_articles",
+                        lambda articles: [{**article, "content": "Full text."} for article in articles])
+    body = {"case_notes": "Case", "disease": "neuroblastoma", "events": ["ALK F1174L"],
+            "analyzed_articles": [{"pmcid": "PMC1", "overall_points": 10}]}
+
+    monkeypatch.setattr(main, "result_cache", ResultCache(shared=store))
+    streamed = [json.loads(line) for line in main.stream_final_analysis(
+        body["case_notes"], body["disease"], body["events"], body["analyzed_articles"])]
+    assert streamed[-1]["data"]["result_source"] == "computed"
+
+    monkeypatch.setattr(main, "result_cache", ResultCache(shared=store))
+    with flask.Flask(__name__).test_request_context(method="POST", json=body):
+        response, status, _ = main.final_analysis(flask.request)
+    assert status == 200
+    assert response.get_json()["result_source"] == "cache"
+    assert response.get_json()["analysis"]["markdown_content"] == "## Summary\nUse crizotinib."
+    assert len(calls) == 1
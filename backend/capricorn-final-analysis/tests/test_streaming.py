@@ -0,0 +1,121 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from result_cache import ResultCache
+
+
+def feed_all(main, chunks):
+    sections = main.MarkdownSections()
+    closed = []
+    for chunk in chunks:
+        closed.extend(sections.feed(chunk))
+    last = sections.close()
+    return closed + ([last] if last else []), sections
+
+
+ANALYSIS = ("## Case Analysis: neuroblastoma\n\n"
+            "### 1. Case Summary\nA 4-year-old with ALK F1174L.\n\n"
+            "### 2. Actionable Events Analysis\n| Event | Type |\n|---|---|\n| ALK F1174L | SNV |\n")
+
+
+def test_sections_close_at_each_heading_and_at_end_of_stream(main):
+    sections, tracker = feed_all(main, [ANALYSIS])
+    assert [section["title"] for section in sections] == [
+        "## Case Analysis: neuroblastoma", "### 1. Case Summary", "### 2. Actionable Events Analysis"]
+    assert [section["index"] for section in sections] == [1, 2, 3]
+    assert tracker.count == 3
+    # The final section is only reported by close(), with the table intact
+    assert sections[-1]["markdown"].endswith("| ALK F1174L | SNV |")
+
+
+def test_case_analysis_preamble_is_its_own_section(main):
+    sections, _ = feed_all(main, [ANALYSIS])
+    assert sections[0] == {"index": 1, "title": "## Case Analysis: neuroblastoma",
+                           "markdown": "## Case Analysis: neuroblastoma"}
+
+
+def test_text_before_the_first_heading_is_an_untitled_section(main):
+    sections, _ = feed_all(main, ["Here is the analysis.\n", ANALYSIS])
+    assert sections[0] == {"index": 1, "title": None, "markdown": "Here is the analysis."}
+    assert sections[1]["title"] == "## Case Analysis: neuroblastoma"
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16])
+def test_headings_split_across_chunks_give_the_same_sections(main, size):
+    chunks = [ANALYSIS[i:i + size] for i in range(0, len(ANALYSIS), size)]
+    assert feed_all(main, chunks)[0] == feed_all(main, [ANALYSIS])[0]
+
+
+def test_a_section_is_reported_only_once_its_next_heading_is_complete(main):
+    sections = main.MarkdownSections()
+    assert sections.feed("### 1. Case Summary\nText.\n##") == []
+    # A partial "##" line waits for the rest of its line before it can be a heading
+    assert sections.feed("notes\n") == []
+    assert sections.feed("## Next\n") == [{"index": 1, "title": "### 1. Case Summary",
+                                           "markdown": "### 1. Case Summary\nText.\n##notes"}]
+    assert sections.close() == {"index": 2, "title": "## Next", "markdown": "## Next"}
+    assert sections.close() is None
+
+
+def test_final_section_without_a_trailing_newline_is_closed(main):
+    sections, _ = feed_all(main, ["## Summary\nUse crizotinib", "."])
+    assert sections == [{"index": 1, "title": "## Summary", "markdown": "## Summary\nUse crizotinib."}]
+
+
+@pytest.fixture
+def streaming(main, monkeypatch):
+    """Single-prompt mode with a fake model; records each request's cancellation token."""
+    tokens = []
+
+    class RecordingToken(main.CancellationToken):
+        def __init__(self):
+            super().__init__()
+            tokens.append(self)
+
+    def stream(model, contents, config):
+        for text in ("## Summary\n", "Use crizotinib.\n"):
+            part = SimpleNamespace(text=text)
+            yield SimpleNamespace(text=text, usage_metadata=None,
+                                  candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+    monkeypatch.setattr(main, "CancellationToken", RecordingToken)
+    monkeypatch.setattr(main, "FINAL_ANALYSIS_MODE", "single")
+    monkeypatch.setattr(main, "genai_client", SimpleNamespace(models=SimpleNamespace(generate_content_stream=stream)))
+    monkeypatch.setattr(main, "get_full_articles",
+                        lambda articles: [{**article, "content": "Full text."} for article in articles])
+    monkeypatch.setattr(main, "result_cache", ResultCache())
+    return tokens
+
+
+def start_stream(main):
+    return main.stream_final_analysis("Case", "neuroblastoma", ["ALK F1174L"],
+                                      [{"pmcid": "PMC1", "overall_points": 10}])
+
+
+def test_stream_emits_chunks_sections_and_completion(main, streaming):
+    events = [json.loads(line) for line in start_stream(main)]
+    assert [event["type"] for event in events] == ["metadata", "chunk", "chunk", "section", "metadata"]
+    assert events[3]["data"] == {"index": 1, "title": "## Summary", "markdown": "## Summary\nUse crizotinib."}
+    assert events[-1]["data"]["status"] == "complete"
+    assert events[-1]["data"]["result_source"] == "computed"
+
+
+def test_disconnect_before_synthesis_counts_the_avoided_call(main, streaming):
+    stream = start_stream(main)
+    assert json.loads(next(stream))["data"]["status"] == "processing"
+    stream.close()
+    assert streaming[-1].stats()["avoided_calls"] == 1
+
+
+def test_disconnect_during_a_replay_avoids_no_calls(main, streaming):
+    list(start_stream(main))
+    stream = start_stream(main)
+    first = json.loads(next(stream))
+    assert first["data"]["result_source"] == "cache"
+    stream.close()
+    stats = streaming[-1].stats()
+    assert stats["cancelled"]
+    assert stats["avoided_calls"] == 0
+    assert stats["avoided_input_tokens_estimate"] == 0
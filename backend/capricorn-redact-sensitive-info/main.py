@@ -18,9 +18,15 @@ from google.cloud import dlp_v2
 from google import genai
 from google.genai import types
 import json
+import logging
 import re
 from datetime import datetime
 import os
+import structured_logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Patient text, DLP quotes and model output are sensitive: log them as size + hash only
+slog = structured_logging.get_logger(__name__)
 
 # Initialize DLP client
 dlp_client = dlp_v2.DlpServiceClient()
@@ -207,13 +213,13 @@ If the date cannot be converted, respond with INVALID."""
                 response_text += chunk.text
 
         response_text = response_text.strip()
-        print(f"Gemini model={MODEL} date standardization response: '{response_text}'")
+        slog.info("date_standardized", model=MODEL, payloads={"response_text": response_text})
 
         if not response_text or response_text == 'INVALID':
             raise ValueError("Invalid date format")
         return response_text
     except Exception as e:
-        print(f"Error in standardize_date: {str(e)}")
+        slog.warning("date_standardization_failed", model=MODEL, error=str(e))
         raise ValueError(f"Failed to standardize date: {str(e)}")
 
 def calculate_age(birth_date):
@@ -222,16 +228,19 @@ def calculate_age(birth_date):
     age = today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
     return age
 
-def deidentify_content(project_id, text):
-    """Deidentify sensitive content using DLP API and Gemini for date processing."""
+def deidentify_content(project_id, text, debug_info=None):
+    """Deidentify sensitive content using DLP API and Gemini for date processing.
+
+    Status lines (info types and counts, never the text itself) are appended
+    to debug_info when given.
+    """
     if not text:
         return text
-
-    print(f"Original text: {text}")
+    debug_info = [] if debug_info is None else debug_info
 
     # Get info types for redaction
     info_types = get_info_types()
-    print(f"Info types used for identification: {[t['name'] for t in info_types]}")
+    slog.info("redaction_started", info_types=len(info_types), payloads={"text": text})
 
     # Set up DLP API request for inspection
     inspect_config = {
@@ -249,25 +258,25 @@ def deidentify_content(project_id, text):
         "item": item,
     }
 
-    print("Calling DLP API for content inspection")
     inspect_response = dlp_client.inspect_content(request=inspect_request)
 
     # Process each finding
     for finding in inspect_response.result.findings:
         info_type = finding.info_type.name
         quote = finding.quote
-        print(f"Found {info_type}: {quote}")
+        slog.info("dlp_finding", info_type=info_type, payloads={"quote": quote})
+        debug_info.append(f"Found {info_type}")
 
         if info_type == "DATE_OF_BIRTH":
             try:
                 standardized_date = standardize_date(quote)
                 age = calculate_age(standardized_date)
                 text = text.replace(quote, f"Age: {age}")
-                print(f"Replaced DATE_OF_BIRTH with age: {age}")
+                debug_info.append("Replaced DATE_OF_BIRTH with age")
             except Exception as e:
-                print(f"Error processing DATE_OF_BIRTH: {str(e)}")
+                slog.warning("date_of_birth_redacted", error=str(e))
                 text = text.replace(quote, "[REDACTED DATE_OF_BIRTH]")
-                print(f"Redacted DATE_OF_BIRTH due to processing error")
+                debug_info.append("Redacted DATE_OF_BIRTH due to processing error")
 
     # Set up DLP API request for deidentification of remaining sensitive information
     deidentify_config = {
@@ -294,21 +303,20 @@ def deidentify_content(project_id, text):
     }
 
     try:
-        print("Calling DLP API for content deidentification")
         deidentify_response = dlp_client.deidentify_content(request=deidentify_request)
-        
-        print("DLP API Deidentification Response:")
+
+        redacted = {}
         if hasattr(deidentify_response, 'overview') and hasattr(deidentify_response.overview, 'transformed_overview'):
             for transformation in deidentify_response.overview.transformed_overview.transformation_summaries:
-                print(f"  Info type redacted: {transformation.info_type.name}")
-                print(f"  Occurrences: {transformation.transformed_count}")
-        else:
-            print("  No transformation overview available in the response.")
-        
-        print(f"Final redacted text: {deidentify_response.item.value}")
+                redacted[transformation.info_type.name] = transformation.transformed_count
+                debug_info.append(f"Info type redacted: {transformation.info_type.name} "
+                                  f"(occurrences: {transformation.transformed_count})")
+
+        slog.info("redaction_finished", findings=len(inspect_response.result.findings), redacted=redacted,
+                  payloads={"redacted_text": deidentify_response.item.value})
         return deidentify_response.item.value
     except Exception as e:
-        print(f"Error in deidentify_content: {str(e)}")
+        slog.error("deidentify_failed", error=str(e))
         return None  # Return None instead of raising an exception
 
 @functions_framework.http
@@ -331,34 +339,23 @@ def redact_sensitive_info(request):
 
     debug_info = []
 
-    def capture_print(message):
-        debug_info.append(str(message))
-
+    log_token = structured_logging.set_request_id(structured_logging.new_request_id(request))
     try:
         request_json = request.get_json()
-        print("Received request for redaction")
-        
+
         if not request_json:
-            print("No JSON data received in request")
+            slog.warning("request_rejected", reason="no JSON data")
             return jsonify({'error': 'No JSON data received'}), 400, headers
 
         # Extract text to redact
         text = request_json.get('text')
         if not text:
-            print("No text provided for redaction")
+            slog.warning("request_rejected", reason="no text")
             return jsonify({'error': 'No text provided'}), 400, headers
 
-        # Redirect print statements to capture_print
-        import builtins
-        original_print = builtins.print
-        builtins.print = capture_print
-
         # Redact sensitive information using project ID from environment
         project_id = os.environ.get('DLP_PROJECT_ID', os.environ.get('PROJECT_ID', 'gemini-med-lit-review'))
-        redacted_text = deidentify_content(project_id, text)
-
-        # Restore original print function
-        builtins.print = original_print
+        redacted_text = deidentify_content(project_id, text, debug_info)
 
         if redacted_text is None:
             return jsonify({
@@ -368,10 +365,7 @@ def redact_sensitive_info(request):
             }), 500, headers
 
         # Extract identified info types from debug_info
-        identified_info_types = [line.split(': ')[1] for line in debug_info if line.startswith('Found ')]
-        
-        # Print identified info types
-        print(f"Identified info types: {identified_info_types}")
+        identified_info_types = [line[len('Found '):] for line in debug_info if line.startswith('Found ')]
 
         return jsonify({
             'success': True,
@@ -381,10 +375,10 @@ def redact_sensitive_info(request):
         }), 200, headers
 
     except Exception as e:
-        print(f"Error in redact_sensitive_info: {str(e)}")
-        # Restore original print function in case of exception
-        builtins.print = original_print
+        slog.error("redaction_failed", error=str(e))
         return jsonify({'error': str(e), 'debugInfo': debug_info}), 500, headers
+    finally:
+        structured_logging.reset_request_id(log_token)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functions_framework
+from flask import jsonify
+import logging
+import os
+import scoring
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Same profile as retrieve-full-articles: SCORING_PROFILE_PATH points at a JSON
+# profile (relative to this directory), merged onto the default.
+SCORING_PROFILE_PATH = os.environ.get('SCORING_PROFILE_PATH')
+scoring_profile = (
+    scoring.load_profile(os.path.join(os.path.dirname(os.path.abspath(__file__)), SCORING_PROFILE_PATH))
+    if SCORING_PROFILE_PATH else scoring.resolve_profile()
+)
+
+@functions_framework.http
+def rerank_articles(request):
+    """Re-score prior analyses under a scoring profile, without any Gemini calls.
+
+    Body: {"analyses": [...], "profile": {...}}. Each analysis is an
+    article_analysis payload ({"article_metadata": {...}}) or the metadata
+    itself. The profile may be partial; it is merged onto the deployed one.
+    """
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'POST',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+
+    headers = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
+
+    try:
+        request_json = request.get_json(silent=True)
+        if not request_json or not isinstance(request_json.get('analyses'), list):
+            return jsonify({'error': 'Missing analyses list'}), 400, headers
+
+        profile = scoring.resolve_profile(request_json.get('profile'), base=scoring_profile)
+        metadatas = [
+            analysis.get('article_metadata', analysis) if isinstance(analysis, dict) else {}
+            for analysis in request_json['analyses']
+        ]
+        results = [
+            {
+                "index": idx,
+                "pmcid": metadata.get('PMCID'),
+                "overall_points": points,
+                "point_breakdown": breakdown
+            }
+            for idx, (metadata, (points, breakdown)) in enumerate(zip(metadatas, scoring.score_batch(metadatas, profile)))
+        ]
+        results.sort(key=lambda result: result['overall_points'], reverse=True)
+        return jsonify({
+            "profile_id": scoring.profile_id(profile),
+            "profile": profile,
+            "results": results
+        }), 200, headers
+
+    except scoring.ScoringProfileError as e:
+        return jsonify({'error': str(e)}), 400, headers
+    except Exception as e:
+        logger.error(f"Error re-ranking articles: {str(e)}")
+        return jsonify({'error': str(e)}), 500, headers
+
+if __name__ == "__main__":
+    app = functions_framework.create_app(target="rerank_articles")
+    app.run(host="0.0.0.0", port=8080, debug=True)
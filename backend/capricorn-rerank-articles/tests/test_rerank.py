@@ -0,0 +1,45 @@
+import flask
+
+import main
+import scoring
+
+app = flask.Flask(__name__)
+
+
+def rerank(body):
+    with app.test_request_context(method="POST", json=body):
+        response, status, _ = main.rerank_articles(flask.request)
+        return response.get_json(), status
+
+
+def test_analyses_are_rescored_and_sorted():
+    analyses = [
+        {"article_metadata": {"PMCID": "PMC1", "novelty": True}},
+        {"PMCID": "PMC2", "disease_match": True},
+    ]
+    body, status = rerank({"analyses": analyses})
+    assert status == 200
+    assert [(result["pmcid"], result["overall_points"]) for result in body["results"]] == [("PMC2", 50), ("PMC1", 10)]
+    assert body["profile_id"] == scoring.profile_id(scoring.resolve_profile())
+
+
+def test_partial_profile_is_merged_onto_the_deployed_one():
+    body, status = rerank({"analyses": [{"PMCID": "PMC1", "novelty": True, "disease_match": True}],
+                           "profile": {"weights": {"novelty": 100}}})
+    assert status == 200
+    assert body["results"][0]["overall_points"] == 150
+    assert body["profile"]["weights"]["disease_match"] == 50
+
+
+def test_bad_requests_are_rejected():
+    assert rerank({"analyses": "PMC1"})[1] == 400
+    assert rerank({"analyses": [], "profile": {"weights": {"impact_factor": 1}}})[1] == 400
+
+
+def test_malformed_profiles_are_rejected():
+    analyses = [{"PMCID": "PMC1"}]
+    for profile in ("strict", ["weights"], 3, {"weights": ["novelty", 100]}):
+        body, status = rerank({"analyses": analyses, "profile": profile})
+        assert status == 400, profile
+        assert "JSON object" in body["error"]
+    assert rerank({"analyses": analyses, "profile": None})[1] == 200
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Offline cohort batch mode for article retrieval and analysis
+Reads a JSONL file of cases, retrieves and analyzes articles for all of them
+with the same pipeline as the Cloud Function, and writes one result JSONL per case
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Shares the vector search, analysis cache, rate controller and scoring with the function
+import main
+
+CHECKPOINT_FILE = 'checkpoint.jsonl'
+RETRIEVAL_FILE = 'retrieval.jsonl'
+
+def read_jsonl(path):
+    """Yield parsed lines, skipping blanks and a truncated last line left by a crash."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Warning: skipping unreadable line in {path}")
+
+def append_jsonl(file, record):
+    """Append one record and flush it to disk so a crash loses at most the line being written."""
+    file.write(json.dumps(record) + "\n")
+    file.flush()
+    os.fsync(file.fileno())
+
+def load_cases(cases_path):
+    """Read cases (disease, events_text, num_articles, methodology) and give each a file-safe case_id.
+
+    Raises ValueError if two cases end up with the same case_id, since they
+    would overwrite each other's rankings and results.
+    """
+    cases = []
+    seen = {}
+    for lineno, case in enumerate(read_jsonl(cases_path), 1):
+        if not case.get('events_text'):
+            print(f"Warning: case on line {lineno} has no events_text, skipping")
+            continue
+        raw_id = str(case.get('case_id') or case.get('id') or f"case-{lineno}")
+        case_id = re.sub(r'[^A-Za-z0-9._-]+', '_', raw_id)
+        if case_id in seen:
+            raise ValueError(f"Case id '{raw_id}' on line {lineno} maps to '{case_id}', "
+                             f"already used by the case on line {seen[case_id]}")
+        seen[case_id] = lineno
+        cases.append({
+            'case_id': case_id,
+            'disease': case.get('disease'),
+            'events_text': case['events_text'],
+            'num_articles': int(case.get('num_articles', 15)),
+            'methodology_content': case.get('methodology_content') or case.get('methodology'),
+        })
+    return cases
+
+def retrieve_rankings(cases, output_dir):
+    """Return case_id -> ranked hits, running the vector search only for cases not checkpointed yet."""
+    retrieval_path = os.path.join(output_dir, RETRIEVAL_FILE)
+    rankings = {record['case_id']: record['hits'] for record in read_jsonl(retrieval_path)}
+    with open(retrieval_path, 'a', encoding='utf-8') as file:
+        for case in cases:
+            if case['case_id'] in rankings:
+                continue
+            hits = main.search_article_ids(case['events_text'], case['num_articles'], disease=case['disease'])
+            rankings[case['case_id']] = [
+                {'pmc_id': hit['pmc_id'], 'pmid': hit['pmid'], 'distance': hit['distance']} for hit in hits
+            ]
+            append_jsonl(file, {'case_id': case['case_id'], 'hits': rankings[case['case_id']]})
+            print(f"Retrieved {len(hits)} articles for {case['case_id']}")
+    return rankings
+
+def plan_work(cases, rankings):
+    """Deduplicate (pmcid, context) analyses across cases.
+
+    Two cases share an analysis when the article, disease, events and
+    methodology normalize to the same analysis cache key.
+    """
+    work = {}
+    for case in cases:
+        for hit in rankings[case['case_id']]:
+            key = main.analysis_cache_key(hit['pmc_id'], case['disease'], case['events_text'],
+                                          case['methodology_content'])
+            hit['work_key'] = key
+            work.setdefault(key, {
+                'pmcid': hit['pmc_id'],
+                'disease': case['disease'],
+                'events_text': case['events_text'],
+                'methodology_content': case['methodology_content'],
+            })
+    return work
+
+def run_work(work, done, output_dir, concurrency, include_text):
+    """Analyze pending work units in parallel, checkpointing each result as it finishes."""
+    pending = {key: unit for key, unit in work.items() if key not in done}
+    if not pending:
+        return 0
+    # One BigQuery query for the texts of every pending article across the cohort
+    articles = main.fetch_articles_by_id({unit['pmcid'] for unit in pending.values()})
+    failed = 0
+
+    def analyze(unit):
+        row = articles.get(unit['pmcid'])
+        if row is None:
+            return None
+        return main.analyze_with_gemini(row['article_text'], unit['pmcid'], unit['methodology_content'],
+                                        unit['disease'], unit['events_text'])
+
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+    with open(checkpoint_path, 'a', encoding='utf-8') as file, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as executor:
+        futures = {executor.submit(analyze, unit): key for key, unit in pending.items()}
+        for count, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            try:
+                analysis = future.result()
+            except Exception as e:
+                print(f"Error analyzing {pending[key]['pmcid']}: {str(e)}")
+                analysis = None
+            if analysis is None:
+                # Not checkpointed, so the next run retries it
+                failed += 1
+                continue
+            if not include_text:
+                analysis.pop('full_article_text', None)
+            done[key] = analysis
+            append_jsonl(file, {'work_key': key, 'analysis': analysis})
+            print(f"[{count}/{len(pending)}] Analyzed {pending[key]['pmcid']}")
+    return failed
+
+def write_case_results(cases, rankings, done, output_dir):
+    """Write <case_id>.jsonl with one line per retrieved article, in retrieval order."""
+    for case in cases:
+        path = os.path.join(output_dir, f"{case['case_id']}.jsonl")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            for rank, hit in enumerate(rankings[case['case_id']], 1):
+                record = {'article_number': rank, 'pmcid': hit['pmc_id'], 'distance': hit['distance']}
+                analysis = done.get(hit['work_key'])
+                if analysis is None:
+                    record['error'] = f"Failed to analyze article {hit['pmc_id']}"
+                else:
+                    record['analysis'] = analysis
+                file.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, path)
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Retrieve and analyze articles for a cohort of cases offline')
+    parser.add_argument('--cases', required=True, help='JSONL file of cases (case_id, disease, events_text, num_articles, methodology)')
+    parser.add_argument('--output-dir', required=True, help='Directory for per-case results and checkpoints')
+    parser.add_argument('--concurrency', type=int, default=int(main.gemini_rate_controller.max_limit),
+                        help='Analyses in flight (default: GEMINI_MAX_CONCURRENCY; the rate controller adapts below it)')
+    parser.add_argument('--include-text', action='store_true', help='Keep full_article_text in the results')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.cases):
+        print(f"Error: cases file '{args.cases}' not found")
+        sys.exit(1)
+    os.makedirs(args.output_dir, exist_ok=True)
+    start = time.time()
+
+    try:
+        cases = load_cases(args.cases)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+    print(f"Loaded {len(cases)} cases from {args.cases}")
+
+    # Points are checkpointed with each analysis, so scoring must never run
+    # against missing journal data: those articles would keep SJR 0 on resume
+    if not main.journal_data_stats()["loaded"] and not main.fetch_journal_impact_data():
+        print("Error: journal impact data could not be loaded; refusing to score articles without it")
+        sys.exit(1)
+
+    rankings = retrieve_rankings(cases, args.output_dir)
+    work = plan_work(cases, rankings)
+    total_hits = sum(len(hits) for hits in rankings.values())
+    print(f"{total_hits} retrieved articles -> {len(work)} unique analyses")
+
+    # Resume: analyses already checkpointed by a previous run are not repeated
+    done = {record['work_key']: record['analysis']
+            for record in read_jsonl(os.path.join(args.output_dir, CHECKPOINT_FILE))
+            if record.get('work_key') in work}
+    print(f"{len(done)} analyses restored from checkpoint, {len(work) - len(done)} pending")
+
+    failed = run_work(work, done, args.output_dir, max(1, args.concurrency), args.include_text)
+    write_case_results(cases, rankings, done, args.output_dir)
+
+    print(f"\nDone in {time.time() - start:.1f}s: {len(done)} analyses, {failed} failed (rerun to retry)")
+    print(json.dumps({
+        "rate_limiter": main.gemini_rate_controller.stats(),
+        "telemetry": main.stage_metrics.stats(),
+    }, indent=2))
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,250 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Article full texts keyed by PMCID, shared between retrieval and final analysis.
+
+retrieve_full_articles writes every article text it downloads; final_analysis
+reads them back instead of querying BigQuery again. Each Cloud Function
+deploys from its own directory, so this module is copied into both. Keep the
+copies identical.
+
+The backend is chosen by ARTICLE_CONTENT_STORE:
+    memory              in-process LRU only (the default)
+    disk:/some/dir      gzip files in a directory (local runs and batch jobs)
+    gs://bucket/prefix  gzip objects in Cloud Storage (separate deployments)
+Disk and Cloud Storage backends sit behind an in-process LRU.
+
+Deployed Cloud Functions never share a filesystem, and /tmp in gen2 is
+memory-backed, so gs:// is the only store that actually shares texts
+between retrieve_full_articles and final_analysis.
+"""
+
+import gzip
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def _file_name(pmcid):
+    # PMCIDs are "PMC" plus digits; anything else is reduced to a safe name
+    return "".join(ch for ch in pmcid if ch.isalnum() or ch in "-_") + ".txt.gz"
+
+
+class MemoryBackend:
+    """LRU of article texts bounded by total characters."""
+
+    def __init__(self, max_chars=16 * 1024 * 1024):
+        self.max_chars = max_chars
+        self._entries = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def get(self, pmcid):
+        with self._lock:
+            text = self._entries.get(pmcid)
+            if text is not None:
+                self._entries.move_to_end(pmcid)
+            return text
+
+    def put(self, pmcid, text):
+        with self._lock:
+            previous = self._entries.pop(pmcid, None)
+            if previous is not None:
+                self._chars -= len(previous)
+            self._entries[pmcid] = text
+            self._chars += len(text)
+            while self._chars > self.max_chars and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._chars -= len(evicted)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskBackend:
+    """One gzip file per article in a directory, pruned oldest-first above max_bytes."""
+
+    PRUNE_EVERY = 50
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._puts = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, pmcid):
+        try:
+            with gzip.open(os.path.join(self.directory, _file_name(pmcid)), 'rt', encoding='utf-8') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, pmcid, text):
+        path = os.path.join(self.directory, _file_name(pmcid))
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as file:
+            file.write(text)
+        # Readers never see a partially written file
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._puts += 1
+            prune = self._puts % self.PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".txt.gz"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class GCSBackend:
+    """One gzip object per article under gs://bucket/prefix."""
+
+    def __init__(self, bucket_name, prefix=""):
+        from google.cloud import storage
+        from google.api_core.exceptions import NotFound
+        self._not_found = NotFound
+        self.bucket = storage.Client().bucket(bucket_name)
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+
+    def get(self, pmcid):
+        try:
+            data = self.bucket.blob(self.prefix + _file_name(pmcid)).download_as_bytes()
+        except self._not_found:
+            return None
+        return gzip.decompress(data).decode('utf-8')
+
+    def put(self, pmcid, text):
+        self.bucket.blob(self.prefix + _file_name(pmcid)).upload_from_string(
+            gzip.compress(text.encode('utf-8')), content_type='application/gzip')
+
+
+class ArticleContentStore:
+    """PMCID -> article text with an in-process LRU in front of an optional shared backend."""
+
+    def __init__(self, backend=None, memory_chars=16 * 1024 * 1024, workers=8):
+        self.memory = MemoryBackend(memory_chars)
+        self.backend = backend
+        self.workers = workers
+        # Writes to a shared backend happen off the request path, in order
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="content-store") if backend else None
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._bytes_served = 0
+        self._puts = 0
+        self._bytes_stored = 0
+        self._errors = 0
+
+    def _backend_get(self, pmcid):
+        try:
+            return self.backend.get(pmcid)
+        except Exception as e:
+            logger.warning(f"Content store read failed for {pmcid}: {str(e)}")
+            with self._lock:
+                self._errors += 1
+            return None
+
+    def get_many(self, pmcids):
+        """Return {pmcid: text} for the PMCIDs found in the store."""
+        found = {}
+        missing = []
+        for pmcid in dict.fromkeys(pmcids):
+            text = self.memory.get(pmcid)
+            if text is not None:
+                found[pmcid] = text
+            else:
+                missing.append(pmcid)
+        if missing and self.backend is not None:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(missing))) as pool:
+                for pmcid, text in zip(missing, pool.map(self._backend_get, missing)):
+                    if text is not None:
+                        found[pmcid] = text
+                        self.memory.put(pmcid, text)
+        with self._lock:
+            self._hits += len(found)
+            self._misses += len(set(pmcids)) - len(found)
+            self._bytes_served += sum(len(text.encode('utf-8')) for text in found.values())
+        return found
+
+    def _backend_put(self, pmcid, text):
+        try:
+            self.backend.put(pmcid, text)
+        except Exception as e:
+            logger.warning(f"Content store write failed for {pmcid}: {str(e)}")
+            with self._lock:
+                self._errors += 1
+
+    def put_many(self, items, wait=False):
+        """Store {pmcid: text}; shared-backend writes are asynchronous unless wait is set."""
+        items = {pmcid: text for pmcid, text in items.items() if pmcid and text}
+        futures = []
+        for pmcid, text in items.items():
+            self.memory.put(pmcid, text)
+            if self._writer is not None:
+                futures.append(self._writer.submit(self._backend_put, pmcid, text))
+        with self._lock:
+            self._puts += len(items)
+            self._bytes_stored += sum(len(text.encode('utf-8')) for text in items.values())
+        if wait:
+            for future in futures:
+                future.result()
+
+    def put(self, pmcid, text, wait=False):
+        self.put_many({pmcid: text}, wait=wait)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "backend": type(self.backend).__name__ if self.backend else "MemoryBackend",
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 3) if lookups else 0.0,
+                "bytes_saved": self._bytes_served,
+                "puts": self._puts,
+                "bytes_stored": self._bytes_stored,
+                "errors": self._errors,
+                "memory_entries": len(self.memory),
+            }
+
+
+def open_store(spec, memory_chars=16 * 1024 * 1024):
+    """Create an ArticleContentStore from an ARTICLE_CONTENT_STORE value."""
+    spec = (spec or "memory").strip()
+    if spec == "memory":
+        return ArticleContentStore(None, memory_chars)
+    if spec.startswith("disk:"):
+        return ArticleContentStore(DiskBackend(spec[len("disk:"):]), memory_chars)
+    if spec.startswith("gs://"):
+        bucket, _, prefix = spec[len("gs://"):].partition("/")
+        return ArticleContentStore(GCSBackend(bucket, prefix), memory_chars)
+    raise ValueError(f"Unknown ARTICLE_CONTENT_STORE: {spec}")
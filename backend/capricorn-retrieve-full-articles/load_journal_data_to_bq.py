@@ -4,8 +4,10 @@ Script to load SCImago Journal Rank data into BigQuery
 This script processes the scimagojr CSV file and loads it into BigQuery
 """
 import csv
+import json
 import os
 import sys
+import time
 from google.cloud import bigquery
 import argparse
 
@@ -87,12 +89,25 @@ def load_data_to_bigquery(project_id, dataset_id, table_id, journals_data):
     table = client.get_table(table_ref)
     print(f"Loaded {table.num_rows} rows into {table_ref}")
 
+def write_snapshot(snapshot_path, journals_data):
+    """Write the compact journal snapshot that main.py loads at cold start"""
+    # Same ordering as the BigQuery fetch (SJR descending)
+    journals = sorted(journals_data, key=lambda journal: journal['sjr'], reverse=True)
+    with open(snapshot_path, 'w', encoding='utf-8') as file:
+        json.dump({
+            'fetched_at': time.time(),
+            'journals': [[journal['title'], journal['sjr']] for journal in journals]
+        }, file, separators=(',', ':'))
+    print(f"Wrote {len(journals)} journals to snapshot {snapshot_path}")
+
 def main():
     parser = argparse.ArgumentParser(description='Load SCImago Journal Rank data into BigQuery')
     parser.add_argument('--project-id', required=True, help='GCP Project ID')
     parser.add_argument('--dataset-id', required=True, help='BigQuery Dataset ID (e.g., journal_rank)')
     parser.add_argument('--table-id', default='scimagojr_2024', help='BigQuery Table ID (default: scimagojr_2024)')
     parser.add_argument('--csv-file', default='scimagojr_2024.csv', help='Path to SCImago CSV file')
+    parser.add_argument('--snapshot-file', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'journal_snapshot.json'),
+                        help='Local snapshot shipped with the function (default: journal_snapshot.json next to this script, empty to skip)')
     
     args = parser.parse_args()
     
@@ -118,6 +133,10 @@ def main():
     print(f"Loading data into BigQuery...")
     load_data_to_bigquery(args.project_id, args.dataset_id, args.table_id, journals)
     
+    # Write the local snapshot so cold starts don't wait on BigQuery
+    if args.snapshot_file:
+        write_snapshot(args.snapshot_file, journals)
+    
     print("\nDone! Journal data has been loaded into BigQuery.")
     print(f"\nTo update your application to use this new table:")
     print(f"1. Update the query in fetch_journal_impact_data() in main.py to use '{args.table_id}' instead of 'scimagojr_2023'")
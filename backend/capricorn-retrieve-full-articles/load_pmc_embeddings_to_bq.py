@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Script to build a deduplicated PMC embedding table in BigQuery
+The public PMC table has duplicate rows for ~113K PMCIDs; this script materializes
+one row per pmc_id with only the id and embedding columns, optionally adds a
+vector index, and measures the over-fetch factor VECTOR_SEARCH needs on the
+source table, for deployments that keep searching it
+"""
+import argparse
+import math
+from google.cloud import bigquery
+
+SOURCE_TABLE = 'bigquery-public-data.pmc_open_access_commercial.articles'
+
+def create_dedup_table(client, source_table, table_ref):
+    """Materialize one embedding row per pmc_id
+
+    The table is only read by VECTOR_SEARCH (article texts are fetched from the
+    source table), so it is not clustered.
+    """
+    query = f"""
+    CREATE OR REPLACE TABLE `{table_ref}` AS
+    SELECT pmc_id, pmid, ml_generate_embedding_result
+    FROM `{source_table}`
+    WHERE ARRAY_LENGTH(ml_generate_embedding_result) > 0
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY pmc_id ORDER BY pmid) = 1
+    """
+    client.query(query).result()
+    table = client.get_table(table_ref)
+    print(f"Created {table_ref} with {table.num_rows} rows")
+
+def count_duplicates(client, source_table):
+    """Return (rows, distinct pmc_ids) in the source table"""
+    query = f"""
+    SELECT COUNT(*) AS total_rows, COUNT(DISTINCT pmc_id) AS distinct_ids
+    FROM `{source_table}`
+    """
+    row = list(client.query(query).result())[0]
+    return row['total_rows'], row['distinct_ids']
+
+def create_vector_index(client, table_ref, index_name, index_type, num_lists):
+    """Create a vector index on the embedding column (BigQuery needs at least 5,000 rows)"""
+    options = [f"index_type = '{index_type}'", "distance_type = 'EUCLIDEAN'"]
+    if index_type == 'IVF' and num_lists:
+        options.append(f"ivf_options = '{{\"num_lists\": {num_lists}}}'")
+    query = f"""
+    CREATE VECTOR INDEX IF NOT EXISTS `{index_name}`
+    ON `{table_ref}`(ml_generate_embedding_result)
+    OPTIONS({', '.join(options)})
+    """
+    client.query(query).result()
+    print(f"Created {index_type} vector index {index_name} on {table_ref} (built asynchronously by BigQuery)")
+
+def measure_over_fetch(client, table_ref, num_queries, top_k):
+    """Run sample searches against table_ref and return rows / distinct pmc_ids per query
+
+    A factor of 1.0 means top_k rows are always top_k distinct articles, which
+    holds by construction for the deduplicated table; measure the source table.
+    """
+    query = f"""
+    WITH queries AS (
+        SELECT pmc_id AS query_id, ml_generate_embedding_result AS embedding
+        FROM `{table_ref}` TABLESAMPLE SYSTEM (1 PERCENT)
+        WHERE ARRAY_LENGTH(ml_generate_embedding_result) > 0
+        LIMIT {num_queries}
+    )
+    SELECT query.query_id, COUNT(*) AS total_rows, COUNT(DISTINCT base.pmc_id) AS distinct_ids
+    FROM VECTOR_SEARCH(
+        TABLE `{table_ref}`,
+        'ml_generate_embedding_result',
+        (SELECT query_id, embedding FROM queries),
+        'embedding',
+        top_k => {top_k}
+    )
+    GROUP BY query.query_id
+    """
+    return [row['total_rows'] / max(row['distinct_ids'], 1) for row in client.query(query).result()]
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a deduplicated PMC embedding table in BigQuery')
+    parser.add_argument('--project-id', required=True, help='GCP Project ID')
+    parser.add_argument('--dataset-id', default='pmc_embeddings', help='BigQuery Dataset ID (default: pmc_embeddings)')
+    parser.add_argument('--table-id', default='articles_dedup', help='BigQuery Table ID (default: articles_dedup)')
+    parser.add_argument('--location', default='US', help='Dataset location; must match the source table (default: US)')
+    parser.add_argument('--source-table', default=SOURCE_TABLE, help=f'Source PMC table (default: {SOURCE_TABLE})')
+    parser.add_argument('--vector-index', choices=['IVF', 'TREE_AH'], help='Also create a vector index of this type')
+    parser.add_argument('--num-lists', type=int, default=0, help='IVF num_lists (default: chosen by BigQuery)')
+    parser.add_argument('--measure-queries', type=int, default=20, help='Sample searches used to measure the source table over-fetch (0 to skip)')
+    parser.add_argument('--measure-top-k', type=int, default=75, help='top_k of each sample search (default: 75, i.e. 15 articles x 5)')
+
+    args = parser.parse_args()
+
+    client = bigquery.Client(project=args.project_id)
+    table_ref = f"{args.project_id}.{args.dataset_id}.{args.table_id}"
+
+    # Create dataset if it doesn't exist
+    dataset = bigquery.Dataset(f"{args.project_id}.{args.dataset_id}")
+    dataset.location = args.location
+    client.create_dataset(dataset, exists_ok=True)
+
+    total_rows, distinct_ids = count_duplicates(client, args.source_table)
+    print(f"Source {args.source_table}: {total_rows} rows, {distinct_ids} distinct PMCIDs "
+          f"({total_rows - distinct_ids} duplicate rows)")
+
+    print(f"\nCreating deduplicated embedding table...")
+    create_dedup_table(client, args.source_table, table_ref)
+
+    if args.vector_index:
+        create_vector_index(client, table_ref, f"{args.table_id}_embedding_index", args.vector_index, args.num_lists)
+
+    source_factor = None
+    if args.measure_queries > 0:
+        print(f"\nMeasuring source table over-fetch with {args.measure_queries} sample searches (top_k={args.measure_top_k})...")
+        ratios = measure_over_fetch(client, args.source_table, args.measure_queries, args.measure_top_k)
+        if ratios:
+            # Round the worst observed ratio up so a search rarely comes back short
+            source_factor = math.ceil(max(ratios) * 10) / 10
+            print(f"  mean {sum(ratios) / len(ratios):.2f}, max {max(ratios):.2f} rows per distinct article")
+        else:
+            print("  no sample queries returned results")
+
+    print("\nDone! Deduplicated embeddings have been loaded into BigQuery.")
+    print(f"\nTo use this table, set this environment variable on retrieve-full-articles and redeploy")
+    print("(every row is a distinct article, so VECTOR_SEARCH_OVERFETCH defaults to 1.0):")
+    print(f"  PMC_EMBEDDING_TABLE={table_ref}")
+    if source_factor is not None:
+        print(f"\nDeployments that keep searching {args.source_table} can set:")
+        print(f"  VECTOR_SEARCH_OVERFETCH={source_factor}")
+
+if __name__ == "__main__":
+    main()
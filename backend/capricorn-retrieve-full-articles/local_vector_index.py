@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process IVF vector search over the PMC embeddings.
+
+An alternative to BigQuery VECTOR_SEARCH that avoids per-query job startup
+latency. The corpus changes rarely, so it is exported once and indexed
+offline with this script:
+
+    python local_vector_index.py export --project-id $PROJECT_ID --out-dir pmc_index
+    python local_vector_index.py build --dir pmc_index
+    python local_vector_index.py benchmark --dir pmc_index
+
+export writes a deduplicated float32 matrix (embeddings.f32) with pmc_id/pmid
+arrays. build clusters it with k-means and rewrites the rows grouped by list
+(ivf_vectors.f32), so each probed list is a contiguous slice of a memory map
+and searching never copies the matrix. Distances are Euclidean, like the
+VECTOR_SEARCH default.
+"""
+
+import argparse
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+EMBEDDINGS_FILE = 'embeddings.f32'
+IVF_VECTORS_FILE = 'ivf_vectors.f32'
+META_FILE = 'meta.json'
+ID_DTYPE = 'S16'
+
+
+def export_embeddings(client, table, out_dir, page_size=10000):
+    """Write one float32 row per pmc_id from table, plus pmc_ids.npy/pmids.npy and meta.json."""
+    query = f"""
+    SELECT pmc_id, pmid, ml_generate_embedding_result
+    FROM `{table}`
+    WHERE ARRAY_LENGTH(ml_generate_embedding_result) > 0
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY pmc_id ORDER BY pmid) = 1
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    pmc_ids, pmids = [], []
+    seen = set()
+    dim = None
+    with open(os.path.join(out_dir, EMBEDDINGS_FILE), 'wb') as file:
+        for row in client.query(query).result(page_size=page_size):
+            if row['pmc_id'] in seen:
+                continue
+            vector = np.asarray(row['ml_generate_embedding_result'], dtype=np.float32)
+            if dim is None:
+                dim = len(vector)
+            if len(vector) != dim:
+                continue
+            seen.add(row['pmc_id'])
+            pmc_ids.append(row['pmc_id'])
+            pmids.append(row['pmid'] or '')
+            file.write(vector.tobytes())
+            if len(pmc_ids) % 100000 == 0:
+                print(f"Exported {len(pmc_ids)} embeddings")
+    np.save(os.path.join(out_dir, 'pmc_ids.npy'), np.array(pmc_ids, dtype=ID_DTYPE))
+    np.save(os.path.join(out_dir, 'pmids.npy'), np.array(pmids, dtype=ID_DTYPE))
+    with open(os.path.join(out_dir, META_FILE), 'w', encoding='utf-8') as file:
+        json.dump({'dim': dim, 'count': len(pmc_ids), 'source': table, 'exported_at': time.time()}, file)
+    print(f"Exported {len(pmc_ids)} embeddings of dimension {dim} to {out_dir}")
+
+
+def load_matrix(path, count, dim):
+    """Map a raw float32 matrix read-only without reading it into memory."""
+    return np.memmap(path, dtype=np.float32, mode='r', shape=(count, dim))
+
+
+def nearest_centroids(vectors, centroids, chunk_size=65536):
+    """Index of the closest centroid for every row, computed in chunks."""
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_size):
+        block = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        assignments[start:start + len(block)] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+    return assignments
+
+
+def train_kmeans(sample, nlist, iterations=20, seed=0):
+    """Plain Lloyd k-means; empty lists are reseeded from random sample rows."""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=nlist)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def build_index(index_dir, nlist=None, sample_size=None, iterations=20, seed=0):
+    """Cluster the exported matrix and write the list-ordered IVF files next to it."""
+    with open(os.path.join(index_dir, META_FILE), encoding='utf-8') as file:
+        meta = json.load(file)
+    count, dim = meta['count'], meta['dim']
+    vectors = load_matrix(os.path.join(index_dir, EMBEDDINGS_FILE), count, dim)
+    nlist = min(nlist or max(1, int(4 * math.sqrt(count))), count)
+    sample_size = min(sample_size or max(nlist * 64, 10000), count)
+
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(vectors[np.sort(rng.choice(count, sample_size, replace=False))], dtype=np.float32)
+    print(f"Training {nlist} lists on {sample_size} of {count} vectors")
+    centroids = train_kmeans(sample, nlist, iterations, seed)
+
+    assignments = nearest_centroids(vectors, centroids)
+    order = np.argsort(assignments, kind='stable')
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignments, minlength=nlist))
+
+    # Rewrite rows grouped by list so every list is a contiguous slice
+    ordered = np.memmap(os.path.join(index_dir, IVF_VECTORS_FILE), dtype=np.float32, mode='w+', shape=(count, dim))
+    norms = np.empty(count, dtype=np.float32)
+    for start in range(0, count, 65536):
+        block = np.asarray(vectors[np.sort(order[start:start + 65536])], dtype=np.float32)
+        # Sorted reads are faster on the memory map; restore list order afterwards
+        block = block[np.argsort(np.argsort(order[start:start + 65536]))]
+        ordered[start:start + len(block)] = block
+        norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+    ordered.flush()
+    del ordered
+
+    np.save(os.path.join(index_dir, 'ivf_centroids.npy'), centroids)
+    np.save(os.path.join(index_dir, 'ivf_offsets.npy'), offsets)
+    np.save(os.path.join(index_dir, 'ivf_norms.npy'), norms)
+    np.save(os.path.join(index_dir, 'ivf_pmc_ids.npy'), np.load(os.path.join(index_dir, 'pmc_ids.npy'))[order])
+    np.save(os.path.join(index_dir, 'ivf_pmids.npy'), np.load(os.path.join(index_dir, 'pmids.npy'))[order])
+    meta.update({'nlist': nlist, 'built_at': time.time()})
+    with open(os.path.join(index_dir, META_FILE), 'w', encoding='utf-8') as file:
+        json.dump(meta, file)
+    sizes = np.diff(offsets)
+    print(f"Built IVF index: {nlist} lists, {sizes.min()}-{sizes.max()} vectors per list")
+
+
+class IVFIndex:
+    """Memory-mapped IVF index; search results are deduplicated by pmc_id."""
+
+    def __init__(self, centroids, offsets, vectors, norms, pmc_ids, pmids, nprobe=32):
+        self.centroids = centroids
+        self.centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        self.offsets = offsets
+        self.vectors = vectors
+        self.norms = norms
+        self.pmc_ids = pmc_ids
+        self.pmids = pmids
+        self.nprobe = nprobe
+
+    @classmethod
+    def load(cls, index_dir, nprobe=32):
+        """Open an index built by build_index; only the centroids are read into memory."""
+        with open(os.path.join(index_dir, META_FILE), encoding='utf-8') as file:
+            meta = json.load(file)
+        return cls(
+            centroids=np.load(os.path.join(index_dir, 'ivf_centroids.npy')),
+            offsets=np.load(os.path.join(index_dir, 'ivf_offsets.npy')),
+            vectors=load_matrix(os.path.join(index_dir, IVF_VECTORS_FILE), meta['count'], meta['dim']),
+            norms=np.load(os.path.join(index_dir, 'ivf_norms.npy'), mmap_mode='r'),
+            pmc_ids=np.load(os.path.join(index_dir, 'ivf_pmc_ids.npy'), mmap_mode='r'),
+            pmids=np.load(os.path.join(index_dir, 'ivf_pmids.npy'), mmap_mode='r'),
+            nprobe=nprobe,
+        )
+
+    def __len__(self):
+        return len(self.norms)
+
+    def stats(self):
+        return {"vectors": len(self), "dim": self.vectors.shape[1], "lists": len(self.centroids),
+                "nprobe": self.nprobe}
+
+    def _results(self, distances, rows, k):
+        """Closest k rows with distinct pmc_ids, as VECTOR_SEARCH-style hits."""
+        if len(rows) == 0:
+            return []
+        # Look at a few more than k so duplicates can be skipped without a full sort
+        candidates = min(len(rows), 4 * k)
+        top = np.argpartition(distances, candidates - 1)[:candidates]
+        top = top[np.argsort(distances[top])]
+        results = self._dedup(distances, rows, top, k)
+        if len(results) < k and candidates < len(rows):
+            results = self._dedup(distances, rows, np.argsort(distances), k)
+        return results
+
+    def _dedup(self, distances, rows, positions, k):
+        results = []
+        seen = set()
+        for position in positions:
+            row = rows[position]
+            pmc_id = self.pmc_ids[row].decode('utf-8')
+            if pmc_id in seen:
+                continue
+            seen.add(pmc_id)
+            results.append({
+                "pmc_id": pmc_id,
+                "pmid": self.pmids[row].decode('utf-8') or None,
+                "distance": math.sqrt(max(float(distances[position]), 0.0)),
+            })
+            if len(results) == k:
+                break
+        return results
+
+    def search(self, query, k=15, nprobe=None):
+        """Approximate top-k by Euclidean distance over the nprobe closest lists."""
+        query = np.asarray(query, dtype=np.float32)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probe = np.argpartition(self.centroid_norms - 2 * self.centroids @ query, nprobe - 1)[:nprobe]
+        query_norm = float(query @ query)
+        distances, rows = [], []
+        for list_id in probe:
+            start, end = int(self.offsets[list_id]), int(self.offsets[list_id + 1])
+            if start == end:
+                continue
+            # A slice of the memory map: no copy of the list's vectors
+            distances.append(self.norms[start:end] - 2 * (self.vectors[start:end] @ query) + query_norm)
+            rows.append(np.arange(start, end))
+        if not rows:
+            return []
+        return self._results(np.concatenate(distances), np.concatenate(rows), k)
+
+    def exact_search(self, query, k=15, chunk_size=65536):
+        """Brute-force top-k over every vector, for benchmarking recall."""
+        query = np.asarray(query, dtype=np.float32)
+        query_norm = float(query @ query)
+        distances = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), chunk_size):
+            end = min(start + chunk_size, len(self))
+            distances[start:end] = self.norms[start:end] - 2 * (self.vectors[start:end] @ query) + query_norm
+        return self._results(distances, np.arange(len(self)), k)
+
+
+def benchmark(index, num_queries=100, k=15, nprobes=(1, 4, 8, 16, 32, 64), noise=0.01, seed=0):
+    """Measure recall@k against exact search, and latency, for several nprobe values.
+
+    Queries are corpus vectors with Gaussian noise (scaled to the vector norm),
+    so they are near, but not exactly on, indexed points.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(index), min(num_queries, len(index)), replace=False)
+    queries = []
+    for row in rows:
+        vector = np.asarray(index.vectors[row], dtype=np.float32)
+        scale = noise * float(np.linalg.norm(vector)) / math.sqrt(len(vector))
+        queries.append(vector + rng.normal(0, scale, len(vector)).astype(np.float32))
+
+    start = time.perf_counter()
+    truth = [{hit["pmc_id"] for hit in index.exact_search(query, k)} for query in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = {"queries": len(queries), "k": k, "exact_ms": round(exact_ms, 2), "ivf": []}
+    for nprobe in nprobes:
+        nprobe = min(nprobe, len(index.centroids))
+        start = time.perf_counter()
+        found = [{hit["pmc_id"] for hit in index.search(query, k, nprobe=nprobe)} for query in queries]
+        elapsed_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = sum(len(hits & expected) / max(len(expected), 1) for hits, expected in zip(found, truth)) / len(queries)
+        report["ivf"].append({"nprobe": nprobe, "recall_at_k": round(recall, 4), "ms": round(elapsed_ms, 2)})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export, build and benchmark the local PMC vector index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='Export embeddings from BigQuery to a float32 matrix')
+    export_parser.add_argument('--project-id', required=True, help='GCP Project ID used to run the export query')
+    export_parser.add_argument('--table', default='bigquery-public-data.pmc_open_access_commercial.articles',
+                               help='Embedding table (e.g. the table built by load_pmc_embeddings_to_bq.py)')
+    export_parser.add_argument('--out-dir', required=True, help='Directory for the exported files')
+
+    build_parser = subparsers.add_parser('build', help='Build the IVF index from an export')
+    build_parser.add_argument('--dir', required=True, help='Export directory')
+    build_parser.add_argument('--nlist', type=int, help='Number of lists (default: 4 * sqrt(N))')
+    build_parser.add_argument('--sample-size', type=int, help='Training sample size (default: 64 * nlist)')
+    build_parser.add_argument('--iterations', type=int, default=20, help='k-means iterations (default: 20)')
+
+    bench_parser = subparsers.add_parser('benchmark', help='Report recall@k against exact search')
+    bench_parser.add_argument('--dir', required=True, help='Index directory')
+    bench_parser.add_argument('--queries', type=int, default=100, help='Number of sample queries (default: 100)')
+    bench_parser.add_argument('--k', type=int, default=15, help='Results per query (default: 15)')
+    bench_parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32, 64], help='nprobe values to try')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        from google.cloud import bigquery
+        export_embeddings(bigquery.Client(project=args.project_id), args.table, args.out_dir)
+    elif args.command == 'build':
+        build_index(args.dir, args.nlist, args.sample_size, args.iterations)
+    else:
+        print(json.dumps(benchmark(IVFIndex.load(args.dir), args.queries, args.k, args.nprobe), indent=2))
+
+
+if __name__ == "__main__":
+    main()
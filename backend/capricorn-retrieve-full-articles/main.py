@@ -22,18 +22,213 @@ import logging
 import time
 import math
 import os
-from datetime import datetime
+import queue
+import random
+import re
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+import uuid
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import structured_logging
+import local_vector_index
+import scoring
+import content_store
+from cancellation import CancellationToken, Cancelled
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
+# Capped JSON records for anything that carries article text, prompts or model output
+slog = structured_logging.get_logger(__name__)
 
-# Global variable to store journal impact data
+# Common ISO 4 journal-title abbreviations, expanded before matching so that
+# e.g. "J Clin Oncol" and "Journal of Clinical Oncology" normalize identically.
+JOURNAL_ABBREVIATIONS = {
+    "acad": "academy", "adv": "advances", "am": "american", "ann": "annals", "biochem": "biochemistry",
+    "biol": "biology", "br": "british", "chem": "chemistry", "clin": "clinical", "commun": "communications",
+    "dis": "diseases", "eur": "european", "exp": "experimental", "front": "frontiers", "genet": "genetics",
+    "haematol": "haematology", "hematol": "hematology", "hum": "human", "immunol": "immunology",
+    "int": "international", "j": "journal", "lett": "letters", "leuk": "leukemia", "med": "medicine",
+    "mol": "molecular", "nat": "nature", "natl": "national", "oncol": "oncology", "pathol": "pathology",
+    "pediatr": "pediatrics", "pharmacol": "pharmacology", "physiol": "physiology", "proc": "proceedings",
+    "rep": "reports", "res": "research", "rev": "reviews", "sci": "science", "syst": "systems",
+    "ther": "therapeutics", "transl": "translational", "transplant": "transplantation",
+}
+JOURNAL_STOPWORDS = {"the", "of", "and", "for", "in", "on", "a"}
+# PubMed qualifies some abbreviations with a place or publisher the table does not
+# carry: "Cancers (Basel)", "Science (New York, N.Y.)"
+JOURNAL_QUALIFIER_RE = re.compile(r"\s*[(\[][^)\]]*[)\]]")
+
+def normalize_journal_title(title):
+    """Casefold, strip accents and punctuation, expand abbreviations and drop stopwords."""
+    text = unicodedata.normalize("NFKD", title or "")
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    text = text.replace("&", " and ")
+    tokens = re.findall(r"[a-z0-9]+", text)
+    tokens = [JOURNAL_ABBREVIATIONS.get(token, token) for token in tokens]
+    return " ".join(token for token in tokens if token not in JOURNAL_STOPWORDS)
+
+def title_trigrams(normalized):
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 characters per token) used for prompt-size reporting."""
+    return math.ceil(len(text or "") / 4)
+
+def tokens_match(query_token, title_token):
+    """True if one token abbreviates the other ("adv"/"advances", "pediatrics"/"pediatric")."""
+    if query_token == title_token:
+        return True
+    shorter, longer = sorted((query_token, title_token), key=len)
+    return len(shorter) >= 3 and longer.startswith(shorter)
+
+class JournalIndex:
+    """Normalized-title index over the SCImago table for deterministic SJR lookup.
+
+    Exact normalized matches are resolved with a dict; everything else falls
+    back to a trigram inverted index. A candidate qualifies only if every
+    query token matches one of its tokens (exactly or as a prefix), so a
+    shorter title that merely starts like the query ("Blood" for "Blood Adv",
+    "Leukemia" for "Leukemia & Lymphoma") is never picked. Qualifying titles
+    are scored by trigram Dice similarity blended with the share of their own
+    tokens the query covers. A parenthesized qualifier ("Cancers (Basel)") is
+    dropped from the query when the title does not match with it.
+    """
+
+    def __init__(self, journal_data, min_score=0.7):
+        self.min_score = min_score
+        self._titles = []
+        self._exact = {}
+        self._trigrams = []
+        self._tokens = []
+        self._postings = {}
+        # Size of the journal table as it used to be embedded in every prompt
+        self.legacy_prompt_tokens = estimate_tokens("".join(f"- {title}: {sjr}\n" for title, sjr in journal_data.items()))
+        for title, sjr in journal_data.items():
+            normalized = normalize_journal_title(title)
+            if not normalized:
+                continue
+            # Rows are ordered by SJR descending, so keep the first title per key
+            if normalized in self._exact:
+                continue
+            doc_id = len(self._titles)
+            self._titles.append((title, sjr))
+            self._exact[normalized] = doc_id
+            grams = title_trigrams(normalized)
+            self._trigrams.append(grams)
+            self._tokens.append(set(normalized.split()))
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(doc_id)
+
+    def __len__(self):
+        return len(self._titles)
+
+    def lookup(self, journal_title):
+        """Return (matched_title, sjr, score) for the best match, or (None, 0, 0) if none qualifies."""
+        normalized = normalize_journal_title(journal_title)
+        if not normalized:
+            return None, 0, 0
+        if normalized in self._exact:
+            title, sjr = self._titles[self._exact[normalized]]
+            return title, sjr, 1.0
+        # Titles that keep their qualifier in the table matched above; otherwise match without it
+        unqualified = normalize_journal_title(JOURNAL_QUALIFIER_RE.sub(" ", journal_title))
+        if unqualified and unqualified != normalized:
+            normalized = unqualified
+            if normalized in self._exact:
+                title, sjr = self._titles[self._exact[normalized]]
+                return title, sjr, 1.0
+
+        grams = title_trigrams(normalized)
+        tokens = set(normalized.split())
+        overlap = Counter()
+        for gram in grams:
+            overlap.update(self._postings.get(gram, ()))
+
+        best_id, best_score = None, 0.0
+        for doc_id, shared in overlap.most_common(50):
+            doc_tokens = self._tokens[doc_id]
+            if not all(any(tokens_match(token, doc_token) for doc_token in doc_tokens) for token in tokens):
+                continue
+            dice = 2 * shared / (len(grams) + len(self._trigrams[doc_id]))
+            covered = sum(1 for doc_token in doc_tokens if any(tokens_match(token, doc_token) for token in tokens))
+            score = 0.5 * dice + 0.5 * covered / len(doc_tokens)
+            if score > best_score:
+                best_id, best_score = doc_id, score
+        if best_id is None or best_score < self.min_score:
+            return None, 0, best_score
+        title, sjr = self._titles[best_id]
+        return title, sjr, best_score
+
+    def stats(self):
+        return {"titles": len(self._titles), "legacy_prompt_tokens": self.legacy_prompt_tokens}
+
+# Global variables to store journal impact data and its title index. Both are
+# replaced together by install_journal_data, so readers always see a
+# consistent pair.
 journal_impact_data = {}
+journal_index = JournalIndex({})
+journal_data_status = {"source": None, "fetched_at": None, "last_error": None}
+journal_data_lock = threading.Lock()
+
+# Snapshot shipped with the deployment (relative paths are resolved against this
+# file's directory, not the working directory), and a writable copy refreshed from BigQuery
+JOURNAL_SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     os.environ.get('JOURNAL_SNAPSHOT_PATH', 'journal_snapshot.json'))
+JOURNAL_SNAPSHOT_CACHE_PATH = os.environ.get('JOURNAL_SNAPSHOT_CACHE_PATH', '/tmp/journal_snapshot.json')
+JOURNAL_REFRESH_SECONDS = float(os.environ.get('JOURNAL_REFRESH_SECONDS', str(24 * 3600)))
+JOURNAL_BACKGROUND_REFRESH = os.environ.get('JOURNAL_BACKGROUND_REFRESH', 'true').lower() == 'true'
+
+def install_journal_data(data, fetched_at, source):
+    """Build the title index for data and swap both globals in atomically."""
+    global journal_impact_data, journal_index
+    index = JournalIndex(data)
+    with journal_data_lock:
+        journal_impact_data = data
+        journal_index = index
+        journal_data_status.update({"source": source, "fetched_at": fetched_at, "last_error": None})
+    logger.info(f"Loaded {len(data)} journal impact records ({len(index)} indexed titles) from {source}")
+
+def read_journal_snapshot(path):
+    """Read a snapshot file written by write_journal_snapshot; return (data, fetched_at) or None."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        return {title: float(sjr) for title, sjr in snapshot['journals']}, float(snapshot['fetched_at'])
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Ignoring unreadable journal snapshot {path}: {str(e)}")
+        return None
+
+def write_journal_snapshot(path, data, fetched_at):
+    """Write a compact snapshot atomically (temp file + rename)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"fetched_at": fetched_at, "journals": [[title, sjr] for title, sjr in data.items()]},
+                  f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def load_journal_snapshot():
+    """Install the newest available local snapshot. Returns True if one was loaded."""
+    newest = None
+    for path in (JOURNAL_SNAPSHOT_CACHE_PATH, JOURNAL_SNAPSHOT_PATH):
+        snapshot = read_journal_snapshot(path)
+        if snapshot and (newest is None or snapshot[1] > newest[1]):
+            newest = (snapshot[0], snapshot[1], f"snapshot:{path}")
+    if newest is None:
+        logger.warning("No local journal snapshot found")
+        return False
+    install_journal_data(*newest)
+    return True
 
 def fetch_journal_impact_data():
-    """Fetch journal impact data from BigQuery and store in memory."""
-    global journal_impact_data
+    """Fetch journal impact data from BigQuery, install it and refresh the local snapshot."""
     project_id = os.environ.get('GENAI_PROJECT_ID', 'gemini-med-lit-review')
     journal_dataset = os.environ.get('JOURNAL_DATASET', 'journal_rank')
     query = f"""
@@ -50,10 +245,64 @@ def fetch_journal_impact_data():
         results = query_job.result()
         
         # Convert to dictionary for faster lookups
-        journal_impact_data = {row['title']: float(row['sjr']) for row in results}
-        logger.info(f"Loaded {len(journal_impact_data)} journal impact records")
+        data = {row['title']: float(row['sjr']) for row in results}
+        fetched_at = time.time()
+        install_journal_data(data, fetched_at, "bigquery")
+        try:
+            write_journal_snapshot(JOURNAL_SNAPSHOT_CACHE_PATH, data, fetched_at)
+        except OSError as e:
+            logger.error(f"Could not write journal snapshot {JOURNAL_SNAPSHOT_CACHE_PATH}: {str(e)}")
+        return True
     except Exception as e:
         logger.error(f"Error fetching journal impact data: {str(e)}")
+        with journal_data_lock:
+            journal_data_status["last_error"] = str(e)
+        return False
+
+def init_journal_data(background=None):
+    """Load journal data before any article is scored; returns True once SJR lookups are available.
+
+    The local snapshot is used when present. Without one, BigQuery is queried
+    synchronously, since scoring against an empty index would silently give
+    every article an SJR of 0. The background refresh, if enabled, keeps the
+    data current (and retries a failed initial fetch).
+    """
+    background = JOURNAL_BACKGROUND_REFRESH if background is None else background
+    loaded = load_journal_snapshot() or fetch_journal_impact_data()
+    if not loaded:
+        logger.error("Journal impact data unavailable; SJR lookups return 0 until a refresh succeeds")
+    if background:
+        threading.Thread(target=journal_refresh_loop, name="journal-refresh", daemon=True).start()
+    return loaded
+
+def journal_refresh_loop():
+    """Refresh journal data from BigQuery whenever it is missing or older than the TTL."""
+    while True:
+        age = journal_data_age()
+        if age is None or age >= JOURNAL_REFRESH_SECONDS:
+            ok = fetch_journal_impact_data()
+            # Back off to a shorter retry interval after a failure
+            wait = JOURNAL_REFRESH_SECONDS if ok else min(300, JOURNAL_REFRESH_SECONDS)
+        else:
+            wait = JOURNAL_REFRESH_SECONDS - age
+        time.sleep(max(wait, 1))
+
+def journal_data_age():
+    fetched_at = journal_data_status["fetched_at"]
+    return None if fetched_at is None else max(0.0, time.time() - fetched_at)
+
+def journal_data_stats():
+    """Report whether journal data is loaded, whether it is stale and how old it is."""
+    age = journal_data_age()
+    with journal_data_lock:
+        return {
+            "loaded": len(journal_impact_data) > 0,
+            "stale": age is None or age >= JOURNAL_REFRESH_SECONDS,
+            "age_seconds": None if age is None else round(age),
+            "source": journal_data_status["source"],
+            "last_error": journal_data_status["last_error"],
+            **journal_index.stats(),
+        }
 
 # Initialize clients with environment variables
 GCP_PROJECT = os.environ.get('GENAI_PROJECT_ID') or os.environ.get('GOOGLE_CLOUD_PROJECT') or 'gemini-med-lit-review'
@@ -67,141 +316,726 @@ client = genai.Client(
 )
 bq_client = bigquery.Client(project=os.environ.get('BIGQUERY_PROJECT_ID', GCP_PROJECT))
 
-def normalize_journal_score(sjr):
-    """Normalize journal SJR score to points between 0-25 to align with other scoring metrics."""
-    if not sjr:
-        return 0
-    # Use log scale to handle large range of SJR values (0 to 106094)
-    # Add 1 to avoid log(0)
-    # Multiply by 5 to align with other point values (5, 10, 15, 25)
-    normalized = math.log(sjr + 1) * 5
-    # Cap at 25 points to match the scale of other point calculations
-    return min(normalized, 25)
+# Number of articles analyzed in parallel per request. Requests may ask for a
+# different value via the `concurrency` field, bounded by MAX_ANALYSIS_CONCURRENCY.
+DEFAULT_ANALYSIS_CONCURRENCY = int(os.environ.get('ANALYSIS_CONCURRENCY', '5'))
+MAX_ANALYSIS_CONCURRENCY = int(os.environ.get('MAX_ANALYSIS_CONCURRENCY', '15'))
+
+# Gemini usage_metadata attributes reported as token counts
+USAGE_FIELDS = [
+    ("input_tokens", "prompt_token_count"),
+    ("output_tokens", "candidates_token_count"),
+    ("thinking_tokens", "thoughts_token_count"),
+    ("cached_tokens", "cached_content_token_count"),
+]
+
+class StageMetrics:
+    """Process-wide counters and rolling latency histograms per pipeline stage."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._samples = {}
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, stage, ms):
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(maxlen=self.window)
+            samples.append(ms)
+
+    def count(self, name, value=1):
+        if value:
+            with self._lock:
+                self._counters[name] += value
+
+    def stats(self):
+        """Return counters and count/p50/p95/max (ms) over the last `window` samples per stage."""
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self._samples.items()}
+            counters = dict(self._counters)
+        stages = {}
+        for stage, values in samples.items():
+            stages[stage] = {
+                "count": len(values),
+                "p50_ms": round(values[int(0.50 * (len(values) - 1))], 1),
+                "p95_ms": round(values[int(0.95 * (len(values) - 1))], 1),
+                "max_ms": round(values[-1], 1),
+            }
+        return {"counters": counters, "stages": stages}
+
+stage_metrics = StageMetrics(window=int(os.environ.get('TELEMETRY_WINDOW', '1000')))
+
+class Trace:
+    """Stage durations (ms), Gemini token usage and retries for one article or request.
+
+    Every recorded stage and token count is also published to stage_metrics.
+    """
+
+    def __init__(self):
+        self.stages = Counter()
+        self.usage = Counter()
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def record(self, name, ms):
+        with self._lock:
+            self.stages[name] += ms
+        stage_metrics.observe(name, ms)
+
+    def add_usage(self, usage_metadata):
+        if usage_metadata is None:
+            return
+        for key, attr in USAGE_FIELDS:
+            value = getattr(usage_metadata, attr, None) or 0
+            with self._lock:
+                self.usage[key] += value
+            stage_metrics.count(key, value)
+
+    def count_retry(self):
+        with self._lock:
+            self.retries += 1
+        stage_metrics.count("retries")
+
+    def merge(self, data):
+        """Add another trace's as_dict() into this one without republishing it."""
+        with self._lock:
+            self.stages.update(data.get("stages_ms", {}))
+            self.usage.update(data.get("usage", {}))
+            self.retries += data.get("retries", 0)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "stages_ms": {name: round(ms, 1) for name, ms in self.stages.items()},
+                "usage": dict(self.usage),
+                "retries": self.retries,
+            }
+
+class RateLimitExceeded(Exception):
+    """Raised when a Gemini call cannot be admitted within its maximum total wait."""
+
+def is_resource_exhausted(error):
+    """Return True if the exception is a Gemini 429 quota error."""
+    return "429 RESOURCE_EXHAUSTED" in str(error)
+
+# How often a cancellable quota wait wakes to check whether its client has gone
+CANCEL_POLL_SECONDS = float(os.environ.get('CANCEL_POLL_SECONDS', '0.5'))
+
+class AdaptiveRateController:
+    """Process-wide AIMD admission control for Gemini calls.
+
+    Calls hold a permit from a pool whose size adapts to the quota we observe:
+    every successful call grows the limit additively (about +1 per window of
+    `limit` successes) and a 429 halves it and opens a shared, jittered
+    cooldown. All workers wait on the same cooldown, so a quota hit slows the
+    whole process down once instead of every request retrying on its own
+    schedule.
+
+    The scope is one instance, not the deployment. Retrieval is deployed with
+    --concurrency=1, so in practice the window paces the article workers of
+    the request in flight, and the learned limit and cooldown carry over to
+    the instance's next request. Instances do not coordinate; each backs off
+    on its own 429s, which is what keeps the project-wide quota in check.
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=16, decrease_factor=0.5,
+                 base_backoff=5.0, max_backoff=60.0, max_wait=600.0, clock=time.monotonic):
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.limit = min(max(float(initial_limit), self.min_limit), self.max_limit)
+        self.decrease_factor = decrease_factor
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        # Monotonic seconds; injectable so cooldowns can be tested without sleeping
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._cooldown_until = 0.0
+        self._consecutive_throttles = 0
+        self._calls = 0
+        self._throttles = 0
+        self._timeouts = 0
+        self._cancelled = 0
+
+    def _acquire(self, deadline, cancel=None):
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    now = self._clock()
+                    if cancel is not None and cancel.cancelled:
+                        self._cancelled += 1
+                        raise Cancelled(cancel.reason)
+                    if now >= deadline:
+                        self._timeouts += 1
+                        raise RateLimitExceeded("Timed out waiting for Gemini quota")
+                    # A cancellable waiter wakes periodically to notice its client has gone
+                    poll = CANCEL_POLL_SECONDS if cancel is not None else float('inf')
+                    if now < self._cooldown_until:
+                        self._cond.wait(min(self._cooldown_until - now, deadline - now, poll))
+                    elif self._in_flight < int(self.limit):
+                        self._in_flight += 1
+                        return
+                    else:
+                        self._cond.wait(min(deadline - now, poll))
+            finally:
+                self._waiting -= 1
+
+    def _release(self, outcome):
+        with self._cond:
+            self._in_flight -= 1
+            now = self._clock()
+            if outcome == "throttled":
+                self._throttles += 1
+                # Only cut the limit once per congestion event; calls that were
+                # already in flight when the cooldown opened report the same 429.
+                if now >= self._cooldown_until:
+                    self._consecutive_throttles += 1
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    backoff = min(self.base_backoff * (2 ** (self._consecutive_throttles - 1)), self.max_backoff)
+                    self._cooldown_until = now + random.uniform(backoff / 2, backoff)
+            elif outcome == "success":
+                self._calls += 1
+                self._consecutive_throttles = 0
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def call(self, fn, max_wait=None, trace=None, cancel=None, estimated_tokens=0):
+        """Run fn() under the controller, retrying 429s until max_wait seconds have elapsed.
+
+        With a trace, time spent waiting for a permit and 429 retries are recorded on it.
+        With a cancellation token, a cancelled request stops waiting (for a permit or
+        a 429 cooldown) and raises Cancelled; a call that never started is counted on
+        the token as avoided, with estimated_tokens of input.
+        """
+        deadline = self._clock() + (max_wait if max_wait is not None else self.max_wait)
+        attempt = 0
+        while True:
+            try:
+                if trace is None:
+                    self._acquire(deadline, cancel)
+                else:
+                    with trace.stage("quota_wait"):
+                        self._acquire(deadline, cancel)
+            except Cancelled:
+                if attempt == 0:
+                    cancel.record_avoided(calls=1, input_tokens=estimated_tokens)
+                raise
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_resource_exhausted(e):
+                    self._release("error")
+                    raise
+                self._release("throttled")
+                attempt += 1
+                if trace is not None:
+                    trace.count_retry()
+                logger.warning(f"Received RESOURCE_EXHAUSTED error. Attempt {attempt}. Current limit {self.limit:.2f}")
+                continue
+            self._release("success")
+            return result
+
+    def stats(self):
+        """Return the current limit, load and counters for monitoring."""
+        with self._cond:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self._in_flight,
+                "queue_depth": self._waiting,
+                "cooldown_remaining_s": round(max(0.0, self._cooldown_until - self._clock()), 2),
+                "successful_calls": self._calls,
+                "throttled_calls": self._throttles,
+                "timed_out_calls": self._timeouts,
+                "cancelled_waits": self._cancelled,
+            }
+
+# Shared by every Gemini call in this process (one request at a time with --concurrency=1).
+gemini_rate_controller = AdaptiveRateController(
+    initial_limit=float(os.environ.get('GEMINI_INITIAL_CONCURRENCY', '4')),
+    min_limit=float(os.environ.get('GEMINI_MIN_CONCURRENCY', '1')),
+    max_limit=float(os.environ.get('GEMINI_MAX_CONCURRENCY', '16')),
+    max_wait=float(os.environ.get('GEMINI_MAX_WAIT_SECONDS', '600')),
+)
+
+def normalize_text(text):
+    """Casefold and collapse whitespace so equivalent inputs share a cache key."""
+    return " ".join((text or "").split()).casefold()
+
+def normalize_events(events_text):
+    """Normalize a newline-separated events list into a sorted, de-duplicated string."""
+    events = {normalize_text(line) for line in (events_text or "").splitlines()}
+    return "\n".join(sorted(event for event in events if event))
+
+def analysis_cache_key(pmcid, disease=None, events_text=None, methodology_content=None):
+    """Build the cache key for one article analysed in one patient context."""
+    methodology_hash = hashlib.sha256((methodology_content or "").encode("utf-8")).hexdigest()
+    # The model sees the compacted article, so compaction settings are part of the context
+    compaction = [ARTICLE_SECTIONS, ARTICLE_TOKEN_BUDGET] if ARTICLE_COMPACTION else None
+    key_parts = [pmcid, normalize_text(disease), normalize_events(events_text), methodology_hash, MODEL, compaction]
+    return hashlib.sha256(json.dumps(key_parts).encode("utf-8")).hexdigest()
+
+class AnalysisCache:
+    """Two-tier cache of per-article Gemini analyses.
+
+    An in-memory LRU sits in front of a SQLite file so entries survive across
+    requests on the same instance (and across instances when the path is on a
+    shared volume). Only the model output is stored; PMCID, link, points and
+    the article text are re-attached on every hit so year-based scoring stays
+    current.
+    """
+
+    def __init__(self, path, memory_entries=256, max_entries=5000, ttl_seconds=30 * 24 * 3600):
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = {"memory": 0, "disk": 0}
+        self._misses = 0
+        self._stores = 0
+        self._evictions = 0
+        self._db = None
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analyses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS analyses_accessed ON analyses (accessed)")
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Analysis cache store unavailable at {path}, using memory only: {str(e)}")
+            self._db = None
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[1] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self._hits["memory"] += 1
+                return json.loads(entry[0])
+            self._memory.pop(key, None)
+
+            row = None
+            if self._db is not None:
+                try:
+                    row = self._db.execute("SELECT value, created FROM analyses WHERE key = ?", (key,)).fetchone()
+                    if row and now - row[1] >= self.ttl_seconds:
+                        self._db.execute("DELETE FROM analyses WHERE key = ?", (key,))
+                        self._db.commit()
+                        row = None
+                    elif row:
+                        self._db.execute("UPDATE analyses SET accessed = ? WHERE key = ?", (now, key))
+                        self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Analysis cache read failed: {str(e)}")
+                    row = None
+            if not row:
+                self._misses += 1
+                return None
+            self._hits["disk"] += 1
+            self._remember(key, row[0], row[1])
+            return json.loads(row[0])
+
+    def contains(self, key):
+        """Return True if a fresh entry exists, without touching counters or recency."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[1] < self.ttl_seconds:
+                return True
+            if self._db is None:
+                return False
+            try:
+                row = self._db.execute("SELECT created FROM analyses WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error:
+                return False
+            return bool(row) and now - row[0] < self.ttl_seconds
+
+    def put(self, key, value):
+        now = time.time()
+        serialized = json.dumps(value)
+        with self._lock:
+            self._stores += 1
+            self._remember(key, serialized, now)
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO analyses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, serialized, now, now),
+                )
+                self._db.execute("DELETE FROM analyses WHERE created < ?", (now - self.ttl_seconds,))
+                overflow = self._db.execute("SELECT COUNT(*) FROM analyses").fetchone()[0] - self.max_entries
+                if overflow > 0:
+                    self._db.execute(
+                        "DELETE FROM analyses WHERE key IN (SELECT key FROM analyses ORDER BY accessed LIMIT ?)",
+                        (overflow,),
+                    )
+                    self._evictions += overflow
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Analysis cache write failed: {str(e)}")
+
+    def _remember(self, key, serialized, created):
+        self._memory[key] = (serialized, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            self._evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits["memory"] + self._hits["disk"] + self._misses
+            return {
+                "memory_hits": self._hits["memory"],
+                "disk_hits": self._hits["disk"],
+                "misses": self._misses,
+                "hit_rate": round((lookups - self._misses) / lookups, 3) if lookups else 0.0,
+                "stores": self._stores,
+                "evictions": self._evictions,
+                "memory_entries": len(self._memory),
+            }
+
+analysis_cache = AnalysisCache(
+    os.environ.get('ANALYSIS_CACHE_PATH', '/tmp/capricorn_analysis_cache.sqlite'),
+    memory_entries=int(os.environ.get('ANALYSIS_CACHE_MEMORY_ENTRIES', '256')),
+    max_entries=int(os.environ.get('ANALYSIS_CACHE_MAX_ENTRIES', '5000')),
+    ttl_seconds=float(os.environ.get('ANALYSIS_CACHE_TTL_SECONDS', str(30 * 24 * 3600))),
+)
+
+class TTLCache:
+    """Thread-safe in-memory LRU with a per-entry TTL and hit/miss counters."""
+
+    def __init__(self, max_entries=128, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[1] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry[0]
+            self._entries.pop(key, None)
+            self._misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses, "entries": len(self._entries)}
+
+# normalized query text -> embedding vector, and embedding key -> ranked search results
+embedding_cache = TTLCache(
+    max_entries=int(os.environ.get('EMBEDDING_CACHE_ENTRIES', '512')),
+    ttl_seconds=float(os.environ.get('EMBEDDING_CACHE_TTL_SECONDS', str(7 * 24 * 3600))),
+)
+search_cache = TTLCache(
+    max_entries=int(os.environ.get('SEARCH_CACHE_ENTRIES', '256')),
+    ttl_seconds=float(os.environ.get('SEARCH_CACHE_TTL_SECONDS', str(24 * 3600))),
+)
+
+class JobStore:
+    """SQLite store of retrieval jobs and their finished per-article events.
+
+    A job records its request parameters and ranked hits; each analyzed or
+    skipped article is stored as soon as it finishes, so a client that
+    reconnects with the job ID gets those events replayed and only the
+    remaining articles are analyzed. Jobs expire ttl_seconds after creation.
+
+    The store lives in this instance's /tmp, which is memory-backed on Cloud
+    Functions, so events are stored without their full article text (see
+    restore_article_texts) and a job can only be resumed on the same instance.
+    """
+
+    def __init__(self, path, ttl_seconds=6 * 3600):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._running = {}
+        self._resumed = 0
+        self._replayed = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, params TEXT NOT NULL, ranked TEXT, created REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS job_events ("
+            "job_id TEXT NOT NULL, article_number INTEGER NOT NULL, event TEXT NOT NULL, "
+            "PRIMARY KEY (job_id, article_number))"
+        )
+        self._db.commit()
+
+    def create(self, job_id, params, ranked):
+        now = time.time()
+        with self._lock:
+            expired = [row[0] for row in self._db.execute(
+                "SELECT job_id FROM jobs WHERE created < ?", (now - self.ttl_seconds,))]
+            for expired_id in expired:
+                self._db.execute("DELETE FROM job_events WHERE job_id = ?", (expired_id,))
+                self._db.execute("DELETE FROM jobs WHERE job_id = ?", (expired_id,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, params, ranked, created) VALUES (?, ?, ?, ?)",
+                (job_id, json.dumps(params), json.dumps(ranked), now),
+            )
+            self._db.commit()
+
+    def get(self, job_id):
+        """Return {"params", "ranked"} for a live job, or None if unknown or expired."""
+        with self._lock:
+            row = self._db.execute("SELECT params, ranked, created FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if not row or time.time() - row[2] >= self.ttl_seconds:
+            return None
+        return {"params": json.loads(row[0]), "ranked": json.loads(row[1])}
+
+    def add_event(self, job_id, article_number, event):
+        analysis = event.get("data", {}).get("analysis")
+        if isinstance(analysis, dict) and "full_article_text" in analysis:
+            analysis = {key: value for key, value in analysis.items() if key != "full_article_text"}
+            event = {**event, "data": {**event["data"], "analysis": analysis}}
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO job_events (job_id, article_number, event) VALUES (?, ?, ?)",
+                (job_id, article_number, json.dumps(event)),
+            )
+            self._db.commit()
+
+    def events(self, job_id):
+        """Return {article_number: event} for every finished article of the job."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT article_number, event FROM job_events WHERE job_id = ?", (job_id,)).fetchall()
+        return {row[0]: json.loads(row[1]) for row in rows}
+
+    def start(self, job_id):
+        """Mark job_id as being processed by a stream in this process."""
+        with self._lock:
+            self._running[job_id] = threading.Event()
+
+    def finish(self, job_id):
+        with self._lock:
+            done = self._running.pop(job_id, None)
+        if done:
+            done.set()
+
+    def wait(self, job_id, timeout):
+        """Wait up to timeout seconds for a running job; returns True once it is not running here."""
+        with self._lock:
+            done = self._running.get(job_id)
+        return done is None or done.wait(timeout)
+
+    def record_resume(self, replayed):
+        with self._lock:
+            self._resumed += 1
+            self._replayed += replayed
+
+    def stats(self):
+        with self._lock:
+            jobs = self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            return {"jobs": jobs, "running": len(self._running), "resumed": self._resumed,
+                    "replayed_events": self._replayed}
+
+job_store = JobStore(
+    os.environ.get('JOB_STORE_PATH', '/tmp/capricorn_retrieval_jobs.sqlite'),
+    ttl_seconds=float(os.environ.get('JOB_TTL_SECONDS', str(6 * 3600))),
+)
+
+# Article texts downloaded here are written to the content store so
+# final_analysis can read them instead of querying BigQuery again. Sharing
+# needs both functions on the same gs:// store; the default, memory, only
+# reuses texts within this instance (see content_store.py).
+article_store = content_store.open_store(
+    os.environ.get('ARTICLE_CONTENT_STORE', 'memory'),
+    memory_chars=int(os.environ.get('ARTICLE_CONTENT_MEMORY_CHARS', str(16 * 1024 * 1024))),
+)
+
+# Scoring weights live in a versioned profile (see scoring.py). SCORING_PROFILE_PATH
+# points at a JSON profile (relative to this directory), merged onto the default,
+# used for new analyses. Re-ranking is served by capricorn-rerank-articles.
+SCORING_PROFILE_PATH = os.environ.get('SCORING_PROFILE_PATH')
+scoring_profile = (
+    scoring.load_profile(os.path.join(os.path.dirname(os.path.abspath(__file__)), SCORING_PROFILE_PATH))
+    if SCORING_PROFILE_PATH else scoring.resolve_profile()
+)
 
 def calculate_points(metadata, query_disease=None):
     """Calculate points based on article metadata and return both total and breakdown."""
-    points = 0
-    breakdown = {}
-    
-    # Journal impact points
-    if metadata.get('journal_title') and metadata.get('journal_sjr'):
-        journal_title = metadata['journal_title']
-        sjr = float(metadata['journal_sjr'])
-        if sjr > 0:
-            impact_points = normalize_journal_score(sjr)
-            points += impact_points
-            breakdown['journal_impact'] = impact_points
-            logger.info(f"Journal '{journal_title}' has SJR {sjr}, awarded {impact_points:.2f} points")
-        else:
-            logger.info(f"Journal '{journal_title}' has no SJR score")
-    
-    # Year-based points: -5 points per year difference from current year
-    current_year = datetime.now().year
-    if metadata.get('year'):
-        try:
-            article_year = int(metadata.get('year'))
-            year_diff = current_year - article_year
-            year_points = -5 * year_diff
-            points += year_points
-            breakdown['year'] = year_points
-        except (ValueError, TypeError):
-            # If year is not a valid integer, skip year-based points
-            pass
-    
-    # Disease Match: +50 points
-    if metadata.get('disease_match'):
-        points += 50
-        breakdown['disease_match'] = 50
-    
-    # Pediatric Focus: +20 points
-    if metadata.get('pediatric_focus'):
-        points += 20
-        breakdown['pediatric_focus'] = 20
-    
-    # Paper Type: +40 points for clinical trial, -5 points for review
-    paper_type = metadata.get('paper_type', '').lower()
-    if 'clinical trial' in paper_type:
-        points += 40
-        breakdown['paper_type'] = 40
-    elif 'review' in paper_type:
-        points -= 5
-        breakdown['paper_type'] = -5
-    
-    # Actionable Events: +15 points per matched event
-    actionable_events = metadata.get('actionable_events', [])
-    matched_events = sum(1 for event in actionable_events if event.get('matches_query', False))
-    if matched_events > 0:
-        event_points = matched_events * 15
-        points += event_points
-        breakdown['actionable_events'] = event_points
-    
-    # Drugs Tested: +5 points
-    if metadata.get('drugs_tested'):
-        points += 5
-        breakdown['drugs_tested'] = 5
-    
-    # Drug Results: +50 points for actual positive treatment shown
-    if metadata.get('treatment_shown'):
-        points += 50
-        breakdown['treatment_shown'] = 50
-    
-    # Cell Studies: +5 points
-    if metadata.get('cell_studies'):
-        points += 5
-        breakdown['cell_studies'] = 5
-    
-    # Mice Studies: +10 points
-    if metadata.get('mice_studies'):
-        points += 10
-        breakdown['mice_studies'] = 10
-    
-    # Case Report: +5 points
-    if metadata.get('case_report'):
-        points += 5
-        breakdown['case_report'] = 5
-    
-    # Series of Case Reports: +10 points
-    if metadata.get('series_of_case_reports'):
-        points += 10
-        breakdown['series_of_case_reports'] = 10
-    
-    # Clinical Study: +15 points
-    if metadata.get('clinical_study'):
-        points += 15
-        breakdown['clinical_study'] = 15
-    
-    # Clinical Study on Children: +20 points
-    if metadata.get('clinical_study_on_children'):
-        points += 20
-        breakdown['clinical_study_on_children'] = 20
-    
-    # Novelty: +10 points
-    if metadata.get('novelty'):
-        points += 10
-        breakdown['novelty'] = 10
-    
-    return points, breakdown
+    return scoring.score_batch([metadata], scoring_profile)[0]
+
+# Section-aware article compaction. PMC full text carries references,
+# acknowledgements, funding statements and supplementary legends that add
+# tokens without informing the analysis; only ARTICLE_SECTIONS are sent to the
+# model, filled in ARTICLE_SECTION_PRIORITY order up to ARTICLE_TOKEN_BUDGET.
+ARTICLE_COMPACTION = os.environ.get('ARTICLE_COMPACTION', 'true').lower() == 'true'
+ARTICLE_SECTIONS = [name.strip() for name in os.environ.get(
+    'ARTICLE_SECTIONS', 'title,abstract,case,methods,results,discussion,tables').split(',') if name.strip()]
+# The case section of a case report carries its clinical content, so it ranks with the results
+ARTICLE_SECTION_PRIORITY = ['title', 'abstract', 'case', 'results', 'discussion', 'tables', 'methods', 'introduction', 'body']
+ARTICLE_TOKEN_BUDGET = int(os.environ.get('ARTICLE_TOKEN_BUDGET', '16000'))
+
+SECTION_HEADINGS = [
+    ('abstract', r'abstract|summary'),
+    ('introduction', r'introduction|background'),
+    ('case', r'(clinical )?case (presentations?|reports?|descriptions?|histor(y|ies)|summar(y|ies)|details|series)'
+             r'|(description|presentation) of (the )?cases?|patient presentation'),
+    ('methods', r'(materials?|patients|subjects)( and| &) methods|methods?|methodology|study design|experimental procedures'),
+    ('results', r'results?( and discussion)?|findings'),
+    ('discussion', r'discussion|conclusions?|interpretation|concluding remarks'),
+    ('dropped', r'references?|bibliography|literature cited|acknowledge?ments?|funding( information| statement)?'
+                r'|author(s\'?)? contributions?|(competing|conflicts?( of)?) interests?|declaration of interests?'
+                r'|disclosures?|supplementary (material|materials|data|information|figures?|tables?)|supporting information'
+                r'|abbreviations|data availability( statement)?|ethics (approval|statement)|footnotes|figure legends?'),
+]
+SECTION_HEADING_RE = [(name, re.compile(rf'(?:{pattern})', re.IGNORECASE)) for name, pattern in SECTION_HEADINGS]
+HEADING_NUMBER_RE = re.compile(r'^(?:\d+(?:\.\d+)*\.?|[IVX]+\.)\s+')
+TABLE_CAPTION_RE = re.compile(r'^table\s+[0-9IVX]+\b', re.IGNORECASE)
+
+def classify_heading(line):
+    """Return the canonical section name if line is a recognised section heading, else None."""
+    text = line.strip()
+    # Table captions start a "tables" block that runs until the next heading
+    if TABLE_CAPTION_RE.match(text) and len(text) <= 300:
+        return 'tables'
+    if not text or len(text) > 80:
+        return None
+    text = HEADING_NUMBER_RE.sub('', text).rstrip(':. ').strip()
+    for name, pattern in SECTION_HEADING_RE:
+        if pattern.fullmatch(text):
+            return name
+    return None
+
+def split_article_sections(article_text):
+    """Split PMC full text into (section_name, text) blocks in document order.
+
+    The first non-empty line is the title and text before the first
+    recognised heading (authors, affiliations) is "body". Unrecognised
+    sub-headings such as "2.1 Patients" stay inside the enclosing section.
+    """
+    sections = []
+    current, lines = 'title', []
+    for line in article_text.splitlines():
+        if current == 'title' and line.strip() and any(l.strip() for l in lines):
+            sections.append(('title', '\n'.join(lines)))
+            current, lines = 'body', []
+        heading = classify_heading(line)
+        if heading and current != 'title':
+            if any(l.strip() for l in lines):
+                sections.append((current, '\n'.join(lines)))
+            current, lines = heading, []
+        lines.append(line)
+    if any(l.strip() for l in lines):
+        sections.append((current, '\n'.join(lines)))
+    return sections
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text to about max_tokens, preferring a paragraph, then sentence, boundary."""
+    limit = max_tokens * 4
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    for boundary in ('\n\n', '. '):
+        position = cut.rfind(boundary)
+        if position > limit // 2:
+            return cut[:position + 1].rstrip() + '\n[...]'
+    return cut.rstrip() + ' [...]'
+
+def compact_article(article_text, sections=None, token_budget=None):
+    """Return (compacted_text, report) keeping only the configured sections within the token budget.
+
+    Sections are admitted in ARTICLE_SECTION_PRIORITY order; the first one that
+    does not fit is truncated to the remaining budget and lower-priority
+    sections are dropped. The kept sections are emitted in document order.
+    """
+    sections = ARTICLE_SECTIONS if sections is None else sections
+    token_budget = ARTICLE_TOKEN_BUDGET if token_budget is None else token_budget
+    original_tokens = estimate_tokens(article_text)
+    parsed = split_article_sections(article_text)
+
+    # Without recognisable headings we cannot select sections; just apply the budget
+    if not any(name not in ('title', 'body') for name, _ in parsed):
+        compacted = truncate_to_tokens(article_text, token_budget)
+        return compacted, {
+            "original_tokens": original_tokens,
+            "compacted_tokens": estimate_tokens(compacted),
+            "sections_kept": ["body"],
+            "sections_truncated": ["body"] if compacted != article_text else [],
+        }
+
+    wanted = [i for i, (name, _) in enumerate(parsed) if name in sections]
+    priority = {name: rank for rank, name in enumerate(ARTICLE_SECTION_PRIORITY)}
+    remaining = token_budget
+    kept, truncated = {}, []
+    for i in sorted(wanted, key=lambda i: (priority.get(parsed[i][0], len(priority)), i)):
+        if remaining <= 0:
+            break
+        name, text = parsed[i]
+        tokens = estimate_tokens(text)
+        if tokens > remaining:
+            text = truncate_to_tokens(text, remaining)
+            truncated.append(name)
+            tokens = estimate_tokens(text)
+        kept[i] = text
+        remaining -= tokens
 
-def create_gemini_prompt(article_text, pmcid, methodology_content=None, disease=None, events_text=None):
+    compacted = '\n\n'.join(kept[i] for i in sorted(kept))
+    return compacted, {
+        "original_tokens": original_tokens,
+        "compacted_tokens": estimate_tokens(compacted),
+        "sections_kept": sorted({parsed[i][0] for i in kept}),
+        "sections_truncated": truncated,
+    }
+
+JOURNAL_LOOKUP_NOTE = "(Journal SJR scores are looked up automatically from the extracted journal_title; just report the journal title as printed in the article and leave journal_sjr as 0.)"
+
+# The article goes last so everything before it is a stable prefix shared by
+# every article of a case, which Gemini's implicit caching can reuse (reported
+# as cached_tokens in the telemetry); the methodology's {article_text}
+# placeholder points there instead.
+ARTICLE_PLACEHOLDER = re.compile(r"(?:<Article>\s*)?\{article_text\}(?:\s*</Article>)?")
+ARTICLE_REFERENCE = "(The article to analyze is provided in the <Article> block at the end of this prompt.)"
+JSON_ONLY_INSTRUCTION = "IMPORTANT: Return ONLY the raw JSON object. Do not include any explanatory text, markdown formatting, or code blocks. The response should start with '{' and end with '}' with no other characters before or after."
+
+def create_prompt_prefix(methodology_content=None, disease=None, events_text=None):
+    """Return the part of the article prompt shared by every article of a patient context."""
     # Add disease and events context to the prompt if provided
     disease_context = f"\nThe patient's disease is: {disease}\n" if disease else ""
     events_context = f"\nThe patient's actionable events are: {events_text}\n" if events_text else ""
     
-    # Create journal context string
-    journal_context = ""
-    for title, sjr in journal_impact_data.items():
-        journal_context += f"- {title}: {sjr}\n"
+    # SJR scores are resolved locally from journal_title after the call, so
+    # methodologies that still carry the {journal_context} placeholder get a
+    # short note instead of the full SCImago table.
+    journal_context = JOURNAL_LOOKUP_NOTE
 
     # Default methodology if none provided
     if not methodology_content:
         methodology_content = """You are an expert pediatric oncologist and you are the chair of the International Leukemia Tumor Board. Your goal is to evaluate full research articles related to oncology, especially those concerning pediatric leukemia, to identify potential advancements in treatment and understanding of the disease.{disease_context}{events_context}
 
-Journal Impact Data (SJR scores):
-The following is a list of journal titles and their SJR scores. When extracting the journal title from the article, find the best matching title from this list and use its SJR score. If no match is found, use 0 as the SJR score.
-
-Journal Titles and Scores:
-{journal_context}
-
 <Article>
 {article_text}
 </Article>
@@ -222,8 +1056,7 @@ Please analyze the article and provide a JSON response with the following struct
   "article_metadata": {
     "title": "...",
     "year": "...",
-    "journal_title": "...",  // Extract the journal title from the article
-    "journal_sjr": 0,        // Look up the SJR score from the provided list. Use the score of the best matching journal title, or 0 if no match found
+    "journal_title": "...",  // Extract the full journal title from the article
     "cancer_focus": true/false,
     "pediatric_focus": true/false,
     "type_of_cancer": "...",
@@ -250,25 +1083,213 @@ Please analyze the article and provide a JSON response with the following struct
 
 Important: The response must be valid JSON and follow this exact structure. Do not include any explanatory text, markdown formatting, or code blocks. Return only the raw JSON object."""
 
-    # Log the article text format
-    logger.info(f"Article text to be inserted:\n{article_text}")
-    
     # Replace all placeholders
-    prompt = methodology_content
-    prompt = prompt.replace("{article_text}", article_text)
+    prompt = ARTICLE_PLACEHOLDER.sub(lambda _: ARTICLE_REFERENCE, methodology_content)
+    prompt = prompt.replace("{disease_context}", disease_context)
+    prompt = prompt.replace("{events_context}", events_context)
     prompt = prompt.replace("{disease}", disease if disease else "")
     prompt = prompt.replace("{events}", events_text if events_text else "")
     prompt = prompt.replace("{journal_context}", journal_context)
+    return f"{prompt}\n\n{JSON_ONLY_INSTRUCTION}"
+
+def create_article_suffix(article_text):
+    """Return the per-article part of the prompt, sent after the shared prefix."""
+    return f"<Article>\n{article_text}\n</Article>"
+
+# Article metadata schema, defined once: it is sent to the model as the
+# response schema and used to validate what comes back. journal_sjr is not
+# part of it because it is filled in locally from journal_title.
+ARTICLE_METADATA_PROPERTIES = {
+    "title": {"type": "STRING"},
+    "year": {"type": "STRING"},
+    "journal_title": {"type": "STRING"},
+    "cancer_focus": {"type": "BOOLEAN"},
+    "pediatric_focus": {"type": "BOOLEAN"},
+    "type_of_cancer": {"type": "STRING"},
+    "disease_match": {"type": "BOOLEAN"},
+    "paper_type": {"type": "STRING"},
+    "actionable_events": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {"event": {"type": "STRING"}, "matches_query": {"type": "BOOLEAN"}},
+            "required": ["event", "matches_query"],
+        },
+    },
+    "drugs_tested": {"type": "BOOLEAN"},
+    "drug_results": {"type": "ARRAY", "items": {"type": "STRING"}},
+    "treatment_shown": {"type": "BOOLEAN"},
+    "cell_studies": {"type": "BOOLEAN"},
+    "mice_studies": {"type": "BOOLEAN"},
+    "case_report": {"type": "BOOLEAN"},
+    "series_of_case_reports": {"type": "BOOLEAN"},
+    "clinical_study": {"type": "BOOLEAN"},
+    "clinical_study_on_children": {"type": "BOOLEAN"},
+    "novelty": {"type": "BOOLEAN"},
+}
+ARTICLE_ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "article_metadata": {
+            "type": "OBJECT",
+            "properties": ARTICLE_METADATA_PROPERTIES,
+            "required": list(ARTICLE_METADATA_PROPERTIES),
+        },
+    },
+    "required": ["article_metadata"],
+}
+# An article is dropped only if one of these is still missing after repair
+REQUIRED_ARTICLE_FIELDS = ['title', 'journal_title', 'cancer_focus', 'type_of_cancer', 'paper_type', 'actionable_events']
+REPAIR_MODEL = os.environ.get('REPAIR_MODEL', MODEL)
+
+ARTICLE_REPAIR_PROMPT = """You previously analyzed the research article below for a pediatric oncology tumor board, but some fields of the article metadata were missing or invalid.
+
+The patient's disease is: {disease}
+The patient's actionable events are: {events}
+
+<Article>
+{article}
+</Article>
+
+Return a JSON object containing only these fields of the article metadata: {fields}.
+For actionable_events, set matches_query to true when the event matches one of the patient's actionable events."""
+
+structured_output_counts = {"first_pass": 0, "repaired": 0, "failed": 0}
+structured_output_lock = threading.Lock()
+
+def record_structured_output(outcome):
+    with structured_output_lock:
+        structured_output_counts[outcome] += 1
+
+def structured_output_stats():
+    with structured_output_lock:
+        return dict(structured_output_counts)
+
+def matches_schema(value, schema):
+    """Strictly check value against a response-schema fragment."""
+    kind = schema["type"]
+    if kind == "STRING":
+        return isinstance(value, str)
+    if kind == "BOOLEAN":
+        return isinstance(value, bool)
+    if kind == "NUMBER":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if kind == "ARRAY":
+        return isinstance(value, list) and all(matches_schema(item, schema["items"]) for item in value)
+    if kind == "OBJECT":
+        return (isinstance(value, dict)
+                and all(field in value for field in schema.get("required", []))
+                and all(matches_schema(value[field], sub) for field, sub in schema["properties"].items() if field in value))
+    return False
+
+def invalid_article_fields(metadata):
+    """Return the schema fields that are missing from metadata or have the wrong type."""
+    return [field for field, schema in ARTICLE_METADATA_PROPERTIES.items()
+            if field not in metadata or not matches_schema(metadata[field], schema)]
+
+def parse_json_object(text):
+    """Parse model output as JSON, falling back to the ```json fence or outermost braces."""
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    if '```json' in text:
+        text = text.split('```json')[1].split('```')[0].strip()
+    elif '{' in text and '}' in text:
+        text = text[text.find('{'):text.rfind('}') + 1]
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON parse error at position {e.pos}: {e.msg}")
+        logger.error(f"Error context: {text[max(0, e.pos-50):min(len(text), e.pos+50)]}")
+        return None
+
+def repair_article_fields(article_text, fields, disease=None, events_text=None, trace=None, cancel=None):
+    """Ask for just the given metadata fields with a small, low-thinking call."""
+    prompt = ARTICLE_REPAIR_PROMPT.format(
+        disease=disease or "not specified",
+        events=events_text or "not specified",
+        article=article_text,
+        fields=", ".join(fields),
+    )
+    generate_content_config = types.GenerateContentConfig(
+        temperature=1,
+        max_output_tokens=4096,
+        response_mime_type="application/json",
+        response_schema={
+            "type": "OBJECT",
+            "properties": {field: ARTICLE_METADATA_PROPERTIES[field] for field in fields},
+            "required": list(fields),
+        },
+        thinking_config=types.ThinkingConfig(thinking_level="LOW"),
+    )
+    response = gemini_rate_controller.call(lambda: client.models.generate_content(
+        model=REPAIR_MODEL,
+        contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
+        config=generate_content_config,
+    ), trace=trace, cancel=cancel, estimated_tokens=estimate_tokens(prompt))
+    if trace is not None:
+        trace.add_usage(response.usage_metadata)
+    return parse_json_object(response.text) or {}
+
+def finalize_analysis(analysis, pmcid, article_text, disease=None):
+    """Attach PMCID, link, points and the article text to a parsed analysis."""
+    metadata = analysis['article_metadata']
+    # Resolve the SJR score locally from the extracted journal title
+    matched_title, sjr, _ = journal_index.lookup(metadata.get('journal_title'))
+    metadata['journal_sjr'] = sjr
+    metadata['journal_match'] = matched_title
+
+    # Add PMCID and generate link
+    metadata['PMCID'] = pmcid
+    metadata['link'] = f'https://www.ncbi.nlm.nih.gov/pmc/articles/{pmcid}/'
     
-    # Log the final prompt
-    logger.info(f"Final prompt with article inserted:\n{prompt}")
+    # Calculate points with disease information
+    points, point_breakdown = calculate_points(metadata, disease)
+    metadata['overall_points'] = points
+    metadata['point_breakdown'] = point_breakdown
+    metadata['scoring_profile'] = scoring.profile_id(scoring_profile)
     
-    return prompt
+    # Store full article text at top level
+    analysis['full_article_text'] = article_text
+    logger.info("Added full article text and calculated points")
+    return analysis
+
+def analyze_with_gemini(article_text, pmcid, methodology_content=None, disease=None, events_text=None, trace=None,
+                        cancel=None):
+    # Stage timings and token usage go to the caller's trace when given; a
+    # cancelled token abandons the Gemini call (raising Cancelled)
+    trace = trace if trace is not None else Trace()
 
-def analyze_with_gemini(article_text, pmcid, methodology_content=None, disease=None, events_text=None):
-    # Create prompt with JSON-only instruction
-    prompt = create_gemini_prompt(article_text, pmcid, methodology_content, disease, events_text)
-    prompt += "\n\nIMPORTANT: Return ONLY the raw JSON object. Do not include any explanatory text, markdown formatting, or code blocks. The response should start with '{' and end with '}' with no other characters before or after."
+    # Reuse a previous analysis of this article in the same patient context
+    with trace.stage("cache_lookup"):
+        cache_key = analysis_cache_key(pmcid, disease, events_text, methodology_content)
+        cached = analysis_cache.get(cache_key)
+    if cached:
+        logger.info(f"Analysis cache hit for {pmcid}")
+        with trace.stage("scoring"):
+            return finalize_analysis(cached, pmcid, article_text, disease)
+
+    # Send only the informative sections of the article, within the token budget
+    compaction = None
+    prompt_article_text = article_text
+    if ARTICLE_COMPACTION:
+        with trace.stage("compaction"):
+            prompt_article_text, compaction = compact_article(article_text)
+        logger.info(f"Compacted {pmcid} from ~{compaction['original_tokens']} to ~{compaction['compacted_tokens']} tokens")
+
+    # The shared prefix is identical for every article of a patient context;
+    # only the article itself changes between calls.
+    with trace.stage("prompt_build"):
+        prefix_text = create_prompt_prefix(methodology_content, disease, events_text)
+        suffix = create_article_suffix(prompt_article_text)
+        prompt = f"{prefix_text}\n\n{suffix}"
+
+    # Log sizes, and the prefix as a hash; full bodies only for debug request IDs
+    slog.sampled("prompt_built", prefix_tokens=estimate_tokens(prefix_text), article_tokens=estimate_tokens(suffix),
+                 legacy_journal_table_tokens=journal_index.legacy_prompt_tokens,
+                 payloads={"prompt_prefix": prefix_text})
     
     # Configure Gemini with user's standard config pattern
     generate_content_config = types.GenerateContentConfig(
@@ -284,193 +1305,652 @@ def analyze_with_gemini(article_text, pmcid, methodology_content=None, disease=N
         thinking_config=types.ThinkingConfig(
             thinking_level="HIGH",
         ),
+        response_mime_type="application/json",
+        response_schema=ARTICLE_ANALYSIS_SCHEMA,
     )
     
-    # Create content with prompt
-    contents = [
-        types.Content(
-            role="user",
-            parts=[types.Part.from_text(text=prompt)],
-        ),
-    ]
-    
-    # Initialize retry parameters
-    base_delay = 5  # Start with 5 seconds
-    attempt = 0
-    
-    while True:  # Keep trying indefinitely
-        try:
-            # Use streaming to collect the response
-            response_text = ""
-            for chunk in client.models.generate_content_stream(
-                model=MODEL,
-                contents=contents,
-                config=generate_content_config,
-            ):
-                if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
-                    continue
-                if chunk.text:
-                    response_text += chunk.text
-            
-            # Create a simple response object for compatibility with existing parsing
-            class StreamedResponse:
-                def __init__(self, text):
-                    self.text = text
-            response = StreamedResponse(response_text)
-            break  # If successful, break out of the retry loop
-        except Exception as e:
-            error_str = str(e)
-            if "429 RESOURCE_EXHAUSTED" in error_str:
-                attempt += 1
-                # Calculate exponential backoff delay with a maximum of 5 minutes
-                delay = min(base_delay * (2 ** (attempt - 1)), 300)  # Cap at 300 seconds (5 minutes)
-                logger.warning(f"Received RESOURCE_EXHAUSTED error. Attempt {attempt}. Waiting {delay} seconds before retry...")
-                time.sleep(delay)
-            else:
-                # If it's not a 429 error, raise immediately
-                raise
+    def collect_response():
+        # Create content with prompt
+        contents = [
+            types.Content(
+                role="user",
+                parts=[types.Part.from_text(text=prompt)],
+            ),
+        ]
+
+        # Use streaming to collect the response
+        response_text = ""
+        usage_metadata = None
+        first_chunk_ms = None
+        start = time.perf_counter()
+        stream = client.models.generate_content_stream(
+            model=MODEL,
+            contents=contents,
+            config=generate_content_config,
+        )
+        # Stop reading (and close the connection) as soon as the client has gone
+        if cancel is not None:
+            stream = cancel.iterate(stream)
+        for chunk in stream:
+            if first_chunk_ms is None:
+                first_chunk_ms = (time.perf_counter() - start) * 1000
+            # The final chunk carries the cumulative usage, possibly with no parts
+            if chunk.usage_metadata:
+                usage_metadata = chunk.usage_metadata
+            if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+                continue
+            if chunk.text:
+                response_text += chunk.text
+        # Only the attempt that succeeded is recorded; 429s show up as retries
+        trace.record("gemini_first_token", first_chunk_ms or 0.0)
+        trace.record("gemini_generation", (time.perf_counter() - start) * 1000)
+        trace.add_usage(usage_metadata)
+        return response_text
+
+    # Admission, 429 backoff and the total wait cap are handled process-wide
+    response_text = gemini_rate_controller.call(collect_response, trace=trace, cancel=cancel,
+                                                estimated_tokens=estimate_tokens(prompt))
     
     try:
-        # Log Gemini's raw response with clear markers
-        logger.info("========== RAW GEMINI RESPONSE START ==========")
-        logger.info(response.text)
-        logger.info("========== RAW GEMINI RESPONSE END ============")
-        
-        # Clean up response text
-        text = response.text.strip()
-        
-        # Try to find JSON object
-        try:
-            # First try to find JSON between ```json and ``` markers
-            if '```json' in text:
-                text = text.split('```json')[1].split('```')[0].strip()
-            # If that fails, try to find JSON between { and }
-            elif '{' in text and '}' in text:
-                start = text.find('{')
-                end = text.rfind('}') + 1
-                text = text[start:end]
-            
-            # Remove any non-JSON text before or after
-            text = text.strip()
-            
-            # Log cleaned text before parsing
-            logger.info("========== CLEANED TEXT START ==========")
-            logger.info(text)
-            logger.info("========== CLEANED TEXT END ============")
-            
-            # Try to parse as JSON
+        slog.sampled("gemini_response", pmcid=pmcid, payloads={"response_text": response_text})
+
+        with trace.stage("parse"):
+            analysis = parse_json_object(response_text)
+            valid = isinstance(analysis, dict) and isinstance(analysis.get('article_metadata'), dict)
+            # Validate against the schema and re-ask only for the fields that failed
+            bad_fields = invalid_article_fields(analysis['article_metadata']) if valid else []
+        if not valid:
+            logger.error("Invalid JSON structure - missing article_metadata")
+            record_structured_output("failed")
+            return None
+
+        metadata = analysis['article_metadata']
+        if not bad_fields:
+            record_structured_output("first_pass")
+        else:
+            logger.warning(f"Article {pmcid} missing or invalid fields {bad_fields}; requesting repair")
             try:
-                analysis = json.loads(text)
-                logger.info("Successfully parsed JSON")
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON parse error at position {e.pos}: {e.msg}")
-                logger.error(f"Error context: {text[max(0, e.pos-50):min(len(text), e.pos+50)]}")
+                with trace.stage("repair"):
+                    repaired = repair_article_fields(prompt_article_text, bad_fields, disease, events_text,
+                                                     trace=trace, cancel=cancel)
+                metadata.update({field: repaired[field] for field in bad_fields if field in repaired})
+            except Cancelled:
                 raise
-            
-            # Validate required fields
-            if not isinstance(analysis, dict) or 'article_metadata' not in analysis:
-                logger.error("Invalid JSON structure - missing article_metadata")
+            except Exception as e:
+                logger.error(f"Field repair failed for {pmcid}: {str(e)}")
+            bad_fields = invalid_article_fields(metadata)
+            if any(field in REQUIRED_ARTICLE_FIELDS for field in bad_fields):
+                logger.error(f"Invalid JSON structure - missing {bad_fields}")
+                record_structured_output("failed")
                 return None
-                
-            metadata = analysis['article_metadata']
-            required_fields = ['title', 'journal_title', 'journal_sjr', 'cancer_focus', 'type_of_cancer', 'paper_type', 'actionable_events']
-            for field in required_fields:
-                if field not in metadata:
-                    logger.error(f"Invalid JSON structure - missing {field}")
-                    return None
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse JSON: {str(e)}")
-            logger.error(f"Cleaned response was: {text}")
-            return None
-        
-        # Process metadata and calculate points
-        if 'article_metadata' in analysis:
-            metadata = analysis['article_metadata']
-            # Add PMCID and generate link
-            metadata['PMCID'] = pmcid
-            metadata['link'] = f'https://www.ncbi.nlm.nih.gov/pmc/articles/{pmcid}/'
-            
-            # Calculate points with disease information
-            points, point_breakdown = calculate_points(metadata, disease)
-            metadata['overall_points'] = points
-            metadata['point_breakdown'] = point_breakdown
-            
-            # Store full article text at top level
-            analysis['full_article_text'] = article_text
-            logger.info("Added full article text and calculated points")
+            # Optional fields that still do not validate are dropped, as before
+            for field in bad_fields:
+                metadata.pop(field, None)
+            record_structured_output("repaired")
         
-        return analysis
+        # Cache the raw model output, then process metadata and calculate points
+        if compaction:
+            analysis['compaction'] = compaction
+        analysis_cache.put(cache_key, analysis)
+        with trace.stage("scoring"):
+            return finalize_analysis(analysis, pmcid, article_text, disease)
+    except Cancelled:
+        raise
     except Exception as e:
         logger.error(f"Error analyzing article with Gemini: {str(e)}")
+        record_structured_output("failed")
         return None
 
-def create_bq_query(events_text, num_articles=15, disease=None):
-    project_id = os.environ.get('BIGQUERY_PROJECT_ID', GCP_PROJECT)
-    model_dataset = os.environ.get('MODEL_DATASET', 'model')
-    # Use the new public PMC table
-    pubmed_table = 'bigquery-public-data.pmc_open_access_commercial.articles'
-    embedding_model = f'{project_id}.{model_dataset}.textembed'
+# Optional cascade stage: a fast, low-cost model screens title+abstract for
+# disease relevance before an article gets the full HIGH-thinking analysis.
+RELEVANCE_GATE = os.environ.get('RELEVANCE_GATE', 'false').lower() == 'true'
+RELEVANCE_GATE_MODEL = os.environ.get('RELEVANCE_GATE_MODEL', 'gemini-2.5-flash-lite')
+RELEVANCE_THRESHOLD = float(os.environ.get('RELEVANCE_THRESHOLD', '0.5'))
 
+RELEVANCE_PROMPT = """You are screening research articles for a pediatric oncology tumor board.
+
+The patient's disease is: {disease}
+The patient's actionable events are: {events}
+
+Decide whether the article below is relevant to this patient's disease (same or closely related cancer type, or a treatment/biomarker directly applicable to it). Judge only from the title and abstract.
+
+<Article>
+{article}
+</Article>
+
+Return a JSON object with "relevant" (true/false), "confidence" (0 to 1, how sure you are of that verdict) and "reason" (one short sentence)."""
+
+def extract_title_abstract(article_text, max_tokens=1500):
+    """Return the title and abstract of an article, or its opening text if no abstract is found."""
+    sections = split_article_sections(article_text)
+    picked = [text for name, text in sections if name in ('title', 'abstract')]
+    if len(picked) < 2:
+        return truncate_to_tokens(article_text, max_tokens)
+    return truncate_to_tokens('\n\n'.join(picked), max_tokens)
+
+def check_relevance(article_text, disease=None, events_text=None, trace=None, cancel=None):
+    """Ask the gate model for a relevance verdict; returns (probability_relevant, reason)."""
+    prompt = RELEVANCE_PROMPT.format(
+        disease=disease or "not specified",
+        events=events_text or "not specified",
+        article=extract_title_abstract(article_text),
+    )
+    generate_content_config = types.GenerateContentConfig(
+        temperature=0,
+        max_output_tokens=256,
+        response_mime_type="application/json",
+        response_schema={
+            "type": "OBJECT",
+            "properties": {
+                "relevant": {"type": "BOOLEAN"},
+                "confidence": {"type": "NUMBER"},
+                "reason": {"type": "STRING"},
+            },
+            "required": ["relevant", "confidence", "reason"],
+        },
+        thinking_config=types.ThinkingConfig(thinking_budget=0),
+    )
+    response = gemini_rate_controller.call(lambda: client.models.generate_content(
+        model=RELEVANCE_GATE_MODEL,
+        contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
+        config=generate_content_config,
+    ), trace=trace, cancel=cancel, estimated_tokens=estimate_tokens(prompt))
+    if trace is not None:
+        trace.add_usage(response.usage_metadata)
+    verdict = json.loads(response.text)
+    confidence = min(max(float(verdict.get("confidence", 0)), 0.0), 1.0)
+    relevant = bool(verdict.get("relevant"))
+    # Express the verdict as the probability that the article is relevant
+    probability = confidence if relevant else 1.0 - confidence
+    return probability, verdict.get("reason", "")
+
+# Use the new public PMC table
+PUBMED_TABLE = 'bigquery-public-data.pmc_open_access_commercial.articles'
+
+# Deduplicated id/embedding copy of PUBMED_TABLE built by
+# load_pmc_embeddings_to_bq.py. When set, VECTOR_SEARCH runs against it and
+# article texts are always fetched from PUBMED_TABLE by ID.
+PMC_EMBEDDING_TABLE = os.environ.get('PMC_EMBEDDING_TABLE')
+# Rows searched per requested article. The loader script measures this for
+# the deduplicated table (1.0: no duplicates left to skip over).
+VECTOR_SEARCH_OVERFETCH = float(os.environ.get('VECTOR_SEARCH_OVERFETCH', '1.0' if PMC_EMBEDDING_TABLE else '5'))
+MAX_VECTOR_SEARCH_ROWS = 500
+# Extra VECTOR_SEARCH options JSON for an indexed table, e.g. '{"fraction_lists_to_search": 0.05}'
+VECTOR_SEARCH_OPTIONS = os.environ.get('VECTOR_SEARCH_OPTIONS')
+
+# In-process IVF index built with local_vector_index.py. When set, searches run
+# against it instead of BigQuery VECTOR_SEARCH; query embeddings come from the
+# embedding cache or the Vertex AI endpoint behind the BigQuery textembed model.
+LOCAL_VECTOR_INDEX_DIR = os.environ.get('LOCAL_VECTOR_INDEX_DIR')
+LOCAL_VECTOR_INDEX_NPROBE = int(os.environ.get('LOCAL_VECTOR_INDEX_NPROBE', '32'))
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'text-embedding-005')
+EMBEDDING_TASK_TYPE = os.environ.get('EMBEDDING_TASK_TYPE', 'RETRIEVAL_QUERY')
+embedding_client = genai.Client(
+    vertexai=True,
+    project=GCP_PROJECT,
+    location=os.environ.get('EMBEDDING_LOCATION', 'us-central1'),
+) if LOCAL_VECTOR_INDEX_DIR else None
+local_index = None
+
+def load_local_index():
+    """Memory-map the local index; searches fall back to BigQuery if it cannot be opened."""
+    global local_index
+    try:
+        local_index = local_vector_index.IVFIndex.load(LOCAL_VECTOR_INDEX_DIR, nprobe=LOCAL_VECTOR_INDEX_NPROBE)
+        logger.info(f"Loaded local vector index from {LOCAL_VECTOR_INDEX_DIR}: {local_index.stats()}")
+    except Exception as e:
+        logger.error(f"Could not load local vector index {LOCAL_VECTOR_INDEX_DIR}, using BigQuery: {str(e)}")
+
+def embed_query(query_body):
+    """Embed the search text with the same model the corpus was embedded with."""
+    response = embedding_client.models.embed_content(
+        model=EMBEDDING_MODEL,
+        contents=[query_body],
+        config=types.EmbedContentConfig(task_type=EMBEDDING_TASK_TYPE),
+    )
+    return list(response.embeddings[0].values)
+
+def search_local_index(cache_key, events_text, num_articles, disease=None):
+    """Return pmc_id/pmid/distance hits from the in-process index."""
+    query_embedding = embedding_cache.get(cache_key)
+    if query_embedding is None:
+        query_embedding = embed_query(build_query_body(events_text, disease))
+        embedding_cache.put(cache_key, query_embedding)
+    return local_index.search(query_embedding, num_articles)
+
+def vector_search_top_k(num_articles):
+    """Rows to fetch from VECTOR_SEARCH so that num_articles distinct PMCIDs survive the dedup."""
+    top_k = math.ceil(num_articles * VECTOR_SEARCH_OVERFETCH)
+    if not PMC_EMBEDDING_TABLE:
+        # Small requests on the duplicated table still get a +20 margin
+        top_k = max(top_k, num_articles + 20)
+    return min(max(top_k, num_articles), MAX_VECTOR_SEARCH_ROWS)
+
+def build_query_body(events_text, disease=None):
     # Anchor the embedding query to the patient's disease so VECTOR_SEARCH returns
     # disease-relevant articles. Eval validation: 12% -> 100% disease relevance for
     # B-ALL case 1 with disease prepended; off-topic citations (Sezary syndrome,
     # NSCLC) eliminated; recommendations shifted to clinically appropriate
     # therapies (CAR-T, ADC). When disease is None, behavior is unchanged.
-    query_body = f"{disease}\n\n{events_text}" if disease else events_text
+    return f"{disease}\n\n{events_text}" if disease else events_text
+
+def create_bq_query(events_text, num_articles=15, disease=None, query_embedding=None, include_text=True):
+    """Build the vector search script.
+
+    With query_embedding the cached vector is inlined as a literal and only the
+    search runs. Without it the embedding is generated in the same script and
+    returned on the first result row so the caller can cache it. With
+    include_text=False only pmc_id/pmid/distance are carried through the
+    over-fetch and dedup; texts are fetched afterwards by ID. Searches against
+    PMC_EMBEDDING_TABLE never include text and skip the dedup step.
+    """
+    project_id = os.environ.get('BIGQUERY_PROJECT_ID', GCP_PROJECT)
+    model_dataset = os.environ.get('MODEL_DATASET', 'model')
+    embedding_model = f'{project_id}.{model_dataset}.textembed'
+
+    query_body = build_query_body(events_text, disease)
 
     # The public PMC corpus has duplicate rows for ~113K PMCIDs (data quality
     # issue at ingestion -- see note to corpus maintainer). Without dedup,
     # VECTOR_SEARCH returns all duplicate rows and a user requesting
     # num_articles=3 can get the same article three times.
-    # Strategy: over-fetch (5x or +20, capped at 500), dedupe by pmc_id keeping
-    # the row with smallest distance (best similarity), then LIMIT to the
-    # user's requested num_articles. Vector search is cheap; the expensive
-    # per-article Gemini analysis only runs on the deduped set.
-    over_fetch = min(max(num_articles * 5, num_articles + 20), 500)
+    # Strategy: over-fetch (VECTOR_SEARCH_OVERFETCH, capped at 500), dedupe by
+    # pmc_id keeping the row with smallest distance (best similarity), then
+    # LIMIT to the user's requested num_articles. Vector search is cheap; the
+    # expensive per-article Gemini analysis only runs on the deduped set.
+    # The deduplicated PMC_EMBEDDING_TABLE needs neither the margin nor the dedup.
+    over_fetch = vector_search_top_k(num_articles)
+    search_options = f", options => '{VECTOR_SEARCH_OPTIONS}'" if VECTOR_SEARCH_OPTIONS else ""
 
-    return f"""
-    DECLARE query_text STRING;
+    if query_embedding is not None:
+        embedding_literal = "[" + ", ".join(repr(float(value)) for value in query_embedding) + "]"
+        declare_embedding = f"DECLARE query_embedding ARRAY<FLOAT64> DEFAULT {embedding_literal};"
+        embedding_column = ""
+    else:
+        declare_embedding = f"""DECLARE query_text STRING;
+    DECLARE query_embedding ARRAY<FLOAT64>;
     SET query_text = \"\"\"
     {query_body}
     \"\"\";
+    SET query_embedding = (
+        SELECT ml_generate_embedding_result
+        FROM ML.GENERATE_EMBEDDING(
+            MODEL `{embedding_model}`,
+            (SELECT query_text AS content)
+        )
+    );"""
+        embedding_column = ",\n           IF(ROW_NUMBER() OVER (ORDER BY distance) = 1, query_embedding, ARRAY<FLOAT64>[]) AS query_embedding"
+
+    if PMC_EMBEDDING_TABLE:
+        return f"""
+    {declare_embedding}
+
+    SELECT base.pmc_id, base.pmid, distance{embedding_column}
+    FROM VECTOR_SEARCH(
+        TABLE `{PMC_EMBEDDING_TABLE}`,
+        'ml_generate_embedding_result',
+        (SELECT query_embedding AS ml_generate_embedding_result),
+        top_k => {over_fetch}{search_options}
+    )
+    ORDER BY distance
+    LIMIT {num_articles}
+    """
+
+    text_column = "article_text, " if include_text else ""
+
+    return f"""
+    {declare_embedding}
 
     WITH vector_results AS (
-        SELECT base.pmc_id, base.pmid, base.article_text, distance
+        SELECT base.pmc_id, base.pmid, {"base.article_text, " if include_text else ""}distance
         FROM VECTOR_SEARCH(
-            TABLE `{pubmed_table}`,
+            TABLE `{PUBMED_TABLE}`,
             'ml_generate_embedding_result',
-            (SELECT ml_generate_embedding_result
-             FROM ML.GENERATE_EMBEDDING(
-                 MODEL `{embedding_model}`,
-                 (SELECT query_text AS content)
-             )),
-            top_k => {over_fetch}
+            (SELECT query_embedding AS ml_generate_embedding_result),
+            top_k => {over_fetch}{search_options}
         )
     ),
     deduped AS (
-        SELECT pmc_id, pmid, article_text, distance,
+        SELECT pmc_id, pmid, {text_column}distance,
                ROW_NUMBER() OVER (PARTITION BY pmc_id ORDER BY distance) AS rn
         FROM vector_results
     )
-    SELECT pmc_id, pmid, article_text, distance
+    SELECT pmc_id, pmid, {text_column}distance{embedding_column}
     FROM deduped
     WHERE rn = 1
     ORDER BY distance
     LIMIT {num_articles}
     """
 
-def stream_response(events_text, methodology_content=None, disease=None, num_articles=15):
+# Retrieval modes: "two_phase" ranks IDs first and streams texts for the
+# winners only; "single" carries article_text through the search query.
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'two_phase')
+ARTICLE_FETCH_PAGE_SIZE = int(os.environ.get('ARTICLE_FETCH_PAGE_SIZE', '2'))
+
+def iter_articles_by_id(pmc_ids, page_size=None):
+    """Yield (pmc_id, pmid, article_text) rows for pmc_ids from one parameterized query, page by page."""
+    query = f"""
+    SELECT pmc_id, pmid, article_text
+    FROM `{PUBMED_TABLE}`
+    WHERE pmc_id IN UNNEST(@pmc_ids)
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY pmc_id) = 1
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("pmc_ids", "STRING", list(pmc_ids))]
+    )
+    yield from bq_client.query(query, job_config=job_config).result(page_size=page_size)
+
+def fetch_articles_by_id(pmc_ids):
+    """Fetch article text for the given PMCIDs in one parameterized query, keyed by pmc_id."""
+    return {row['pmc_id']: row for row in iter_articles_by_id(pmc_ids)}
+
+def query_cache_key(events_text, disease=None):
+    return hashlib.sha256(normalize_text(build_query_body(events_text, disease)).encode("utf-8")).hexdigest()
+
+def cached_ranking(cache_key, num_articles):
+    """Return the cached top num_articles hits, sliced from a larger cached search if possible."""
+    ranked = search_cache.get(cache_key)
+    if ranked and ranked["num_articles"] >= num_articles:
+        logger.info(f"Vector search cache hit: serving {num_articles} of {len(ranked['results'])} cached results")
+        return ranked["results"][:num_articles]
+    return None
+
+def run_vector_search(cache_key, events_text, num_articles, disease=None, include_text=True):
+    """Run the vector search, reusing a cached query embedding, and cache the embedding and ranking.
+
+    Uses the local index when one is loaded, falling back to BigQuery if it fails.
+    """
+    results = None
+    if local_index is not None:
+        try:
+            results = search_local_index(cache_key, events_text, num_articles, disease)
+        except Exception as e:
+            logger.error(f"Local vector search failed, using BigQuery: {str(e)}")
+
+    # The deduplicated embedding table and the local index have no article_text
+    search_text = include_text and not PMC_EMBEDDING_TABLE and results is None
+    if results is None:
+        query_embedding = embedding_cache.get(cache_key)
+        query = create_bq_query(events_text, num_articles, disease=disease,
+                                query_embedding=query_embedding, include_text=search_text)
+        columns = ('pmc_id', 'pmid', 'article_text', 'distance') if search_text else ('pmc_id', 'pmid', 'distance')
+
+        results = []
+        for row in bq_client.query(query).result():
+            if query_embedding is None and row.get('query_embedding'):
+                query_embedding = list(row['query_embedding'])
+                embedding_cache.put(cache_key, query_embedding)
+            results.append({key: row[key] for key in columns})
+
+    search_cache.put(cache_key, {
+        "num_articles": num_articles,
+        "results": [{"pmc_id": r["pmc_id"], "pmid": r["pmid"], "distance": r["distance"]} for r in results],
+    })
+    if include_text and not search_text:
+        articles = fetch_articles_by_id([r["pmc_id"] for r in results])
+        results = [{**articles[r["pmc_id"]], "distance": r["distance"]} for r in results if r["pmc_id"] in articles]
+    return results
+
+def search_article_ids(events_text, num_articles=15, disease=None):
+    """Return the ranked top num_articles hits as pmc_id/pmid/distance, without article text."""
+    cache_key = query_cache_key(events_text, disease)
+    hits = cached_ranking(cache_key, num_articles)
+    if hits is not None:
+        return hits
+    return run_vector_search(cache_key, events_text, num_articles, disease, include_text=False)
+
+def retrieve_articles(events_text, num_articles=15, disease=None):
+    """Return the top num_articles rows (pmc_id, pmid, article_text, distance), using the caches.
+
+    A search cached for at least num_articles results is sliced and only the
+    article texts are fetched. Otherwise the search runs, reusing a cached
+    query embedding when there is one.
+    """
+    cache_key = query_cache_key(events_text, disease)
+    hits = cached_ranking(cache_key, num_articles)
+    if hits is None:
+        return run_vector_search(cache_key, events_text, num_articles, disease, include_text=True)
+    articles = fetch_articles_by_id([hit["pmc_id"] for hit in hits])
+    return [
+        {**articles[hit["pmc_id"]], "distance": hit["distance"]}
+        for hit in hits if hit["pmc_id"] in articles
+    ]
+
+def iter_ranked_articles(ranked, page_size=None, skip=None):
+    """Yield (article_number, row) for ranked hits as their texts arrive from BigQuery.
+
+    Rows arrive in storage order, not rank order; article_number is the
+    retrieval rank. Hits whose text could not be found are yielded last with
+    row=None. Article numbers in skip are neither fetched nor yielded.
+    """
+    skip = skip or ()
+    ranks = {hit["pmc_id"]: idx for idx, hit in enumerate(ranked, 1) if idx not in skip}
+    distances = {hit["pmc_id"]: hit["distance"] for hit in ranked}
+    seen = set()
+    for row in (iter_articles_by_id(list(ranks), page_size=page_size) if ranks else ()):
+        pmcid = row['pmc_id']
+        if pmcid in seen:
+            continue
+        seen.add(pmcid)
+        yield ranks[pmcid], {"pmc_id": pmcid, "pmid": row['pmid'], "article_text": row['article_text'],
+                             "distance": distances[pmcid]}
+    for hit in ranked:
+        if hit["pmc_id"] in ranks and hit["pmc_id"] not in seen:
+            yield ranks[hit["pmc_id"]], None
+
+def restore_article_texts(ranked, stored_events):
+    """Re-attach the full article texts that JobStore leaves out of stored analysis events.
+
+    Texts come from the content store, or from BigQuery for those it no longer holds.
+    """
+    pmcids = {number: ranked[number - 1]["pmc_id"] for number, event in stored_events.items()
+              if event["type"] == "article_analysis"}
+    if not pmcids:
+        return stored_events
+    texts = article_store.get_many(pmcids.values())
+    missing = [pmcid for pmcid in set(pmcids.values()) if pmcid not in texts]
+    if missing:
+        fetched = {pmcid: row['article_text'] for pmcid, row in fetch_articles_by_id(missing).items()}
+        article_store.put_many(fetched)
+        texts.update(fetched)
+    for number, pmcid in pmcids.items():
+        stored_events[number]["data"]["analysis"]["full_article_text"] = texts.get(pmcid)
+    return stored_events
+
+def resolve_concurrency(concurrency, total_articles):
+    """Clamp the requested worker count to [1, MAX_ANALYSIS_CONCURRENCY] and the article count."""
     try:
-        # Execute BigQuery
-        # Execute BigQuery and log results
-        query = create_bq_query(events_text, num_articles, disease=disease)
-        query_job = bq_client.query(query)
-        results = list(query_job.result())
-        total_articles = len(results)
+        workers = int(concurrency) if concurrency is not None else DEFAULT_ANALYSIS_CONCURRENCY
+    except (ValueError, TypeError):
+        workers = DEFAULT_ANALYSIS_CONCURRENCY
+    workers = max(1, min(workers, MAX_ANALYSIS_CONCURRENCY))
+    return min(workers, max(total_articles, 1))
+
+def analyze_article(idx, row, total_articles, methodology_content=None, disease=None, events_text=None,
+                    relevance_threshold=None, cancel=None):
+    """Analyze a single retrieved article and return the NDJSON event object for it.
+
+    With a relevance_threshold, articles not already in the analysis cache are
+    first screened by the gate model and skipped when their relevance
+    probability falls below the threshold. Gate failures fail open. Every
+    event carries a telemetry block with stage timings, token usage and retries.
+    If the cancellation token fires, the Gemini calls are abandoned and a
+    "cancelled" event is returned.
+    """
+    pmcid = row['pmc_id']  # This is pmc_id from the query result
+    content = row['article_text']
+    trace = Trace()
+    start = time.perf_counter()
+    event = analyze_article_event(idx, pmcid, content, total_articles, methodology_content, disease, events_text,
+                                  relevance_threshold, trace, cancel)
+    trace.record("article_total", (time.perf_counter() - start) * 1000)
+    event["data"]["telemetry"] = trace.as_dict()
+    return event
+
+def analyze_article_event(idx, pmcid, content, total_articles, methodology_content, disease, events_text,
+                          relevance_threshold, trace, cancel=None):
+    """Build the NDJSON event for one article, recording its stages on trace."""
+    try:
+        slog.sampled("article_processing", pmcid=pmcid, article_number=idx, content_tokens=estimate_tokens(content))
+
+        cache_key = analysis_cache_key(pmcid, disease, events_text, methodology_content)
+        if relevance_threshold is not None and not analysis_cache.contains(cache_key):
+            try:
+                with trace.stage("relevance_gate"):
+                    probability, reason = check_relevance(content, disease, events_text, trace=trace, cancel=cancel)
+            except Cancelled:
+                raise
+            except Exception as e:
+                logger.warning(f"Relevance gate failed for {pmcid}, running full analysis: {str(e)}")
+            else:
+                if probability < relevance_threshold:
+                    logger.info(f"Skipping {pmcid}: relevance {probability:.2f} < {relevance_threshold} ({reason})")
+                    return {
+                        "type": "skipped",
+                        "data": {
+                            "article_number": idx,
+                            "total_articles": total_articles,
+                            "pmcid": pmcid,
+                            "relevance": round(probability, 3),
+                            "reason": reason
+                        }
+                    }
+
+        # Pass PMCID for URL generation and metadata
+        analysis = analyze_with_gemini(content, pmcid, methodology_content, disease, events_text, trace=trace,
+                                       cancel=cancel)
+        if analysis:
+            return {
+                "type": "article_analysis",
+                "data": {
+                    "progress": {
+                        "article_number": idx,
+                        "total_articles": total_articles
+                    },
+                    "analysis": analysis
+                }
+            }
+        logger.error(f"Failed to analyze article {pmcid}")
+        return {
+            "type": "error",
+            "data": {
+                "message": f"Failed to analyze article {pmcid}",
+                "article_number": idx,
+                "total_articles": total_articles
+            }
+        }
+    except Cancelled:
+        logger.info(f"Abandoned analysis of {pmcid}: request cancelled")
+        return {
+            "type": "cancelled",
+            "data": {
+                "article_number": idx,
+                "pmcid": pmcid
+            }
+        }
+    except Exception as e:
+        logger.error(f"Error processing article {pmcid}: {str(e)}")
+        return {
+            "type": "error",
+            "data": {
+                "message": f"Error processing article {pmcid}: {str(e)}",
+                "article_number": idx,
+                "total_articles": total_articles
+            }
+        }
+
+def estimated_article_tokens(article_text):
+    """Approximate prompt tokens an article analysis would have sent (after compaction)."""
+    tokens = estimate_tokens(article_text or "")
+    return min(tokens, ARTICLE_TOKEN_BUDGET) if ARTICLE_COMPACTION else tokens
+
+def report_cancellation(cancel, executor, job_id, finish_job=False):
+    """Wait for abandoned analyses to stop, then log and count what the cancellation avoided.
+
+    With finish_job, the job is marked finished only once they have stopped, so
+    a resume waits for (and relays) any analysis that completed regardless.
+    """
+    if executor is not None:
+        executor.shutdown(wait=True)
+    if finish_job:
+        job_store.finish(job_id)
+    stats = cancel.stats()
+    stage_metrics.count("cancelled_requests")
+    stage_metrics.count("avoided_gemini_calls", stats["avoided_calls"])
+    stage_metrics.count("abandoned_gemini_streams", stats["abandoned_streams"])
+    stage_metrics.count("avoided_input_tokens_estimate", stats["avoided_input_tokens_estimate"])
+    slog.info("request_cancelled", job_id=job_id, **stats)
+
+def stream_response(events_text, methodology_content=None, disease=None, num_articles=15, concurrency=None,
+                    retrieval_mode=None, relevance_gate=None, relevance_threshold=None, request_id=None,
+                    job_id=None, seen_articles=None):
+    """Stream the NDJSON events of a retrieval job.
+
+    New jobs get a job_id in the initial metadata event. Passing it back
+    resumes the job with its original parameters and ranking: finished
+    articles whose numbers are not in seen_articles are replayed, and only the
+    remaining articles are analyzed.
+    """
+    # The generator runs after the view returns, so the request ID is bound here
+    log_token = structured_logging.set_request_id(request_id or structured_logging.new_request_id())
+    started = False
+    # Fired when the client disconnects; stops the work done on its behalf
+    cancel = CancellationToken()
+    # Articles that still need a Gemini analysis, for counting avoided calls
+    unstarted = 0
+    try:
+        # Request-level stages; per-article traces are added as they complete
+        request_trace = Trace()
+        request_start = time.perf_counter()
+        resumed = job_id is not None
+
+        if resumed:
+            job = job_store.get(job_id)
+            if job is None:
+                yield json.dumps({"type": "error", "data": {"message": f"Unknown or expired job {job_id}"}}) + "\n"
+                return
+            params = job["params"]
+            events_text = params["events_text"]
+            methodology_content = params["methodology_content"]
+            disease = params["disease"]
+            retrieval_mode = params["retrieval_mode"]
+            relevance_threshold = params["relevance_threshold"]
+            relevance_gate = relevance_threshold is not None
+            ranked = job["ranked"]
+        else:
+            job_id = uuid.uuid4().hex
+            retrieval_mode = retrieval_mode or RETRIEVAL_MODE
+            relevance_gate = RELEVANCE_GATE if relevance_gate is None else bool(relevance_gate)
+            if relevance_gate:
+                relevance_threshold = RELEVANCE_THRESHOLD if relevance_threshold is None else float(relevance_threshold)
+            else:
+                relevance_threshold = None
+
+            # Execute BigQuery. In two-phase mode only IDs come back here and the
+            # texts are streamed into the analysis stage below.
+            if retrieval_mode == "two_phase":
+                with request_trace.stage("vector_search"):
+                    ranked = search_article_ids(events_text, num_articles, disease=disease)
+                articles = iter_ranked_articles(ranked, page_size=ARTICLE_FETCH_PAGE_SIZE)
+            else:
+                with request_trace.stage("vector_search"):
+                    ranked = retrieve_articles(events_text, num_articles, disease=disease)
+                articles = enumerate(ranked, 1)
+            job_store.create(job_id, {
+                "events_text": events_text,
+                "methodology_content": methodology_content,
+                "disease": disease,
+                "retrieval_mode": retrieval_mode,
+                "relevance_threshold": relevance_threshold,
+            }, [{"pmc_id": hit["pmc_id"], "pmid": hit["pmid"], "distance": hit["distance"]} for hit in ranked])
+        total_articles = len(ranked)
+        unstarted = total_articles
+        workers = resolve_concurrency(concurrency, total_articles)
         
         # Get array of PMCIDs from BigQuery results and stream immediately
-        retrieved_pmcids = [row['pmc_id'] for row in results]
-        print(f"Retrieved PMCIDs: {retrieved_pmcids}")
+        retrieved_pmcids = [row['pmc_id'] for row in ranked]
+        slog.info("articles_retrieved", retrieval_mode=retrieval_mode, count=len(retrieved_pmcids),
+                  pmcids=retrieved_pmcids, job_id=job_id, resumed=resumed)
 
         # Stream PMCIDs immediately
         yield json.dumps({
@@ -486,63 +1966,156 @@ def stream_response(events_text, methodology_content=None, disease=None, num_art
             "data": {
                 "total_articles": total_articles,
                 "current_article": 0,
+                "concurrency": workers,
+                "retrieval_mode": retrieval_mode,
+                "request_id": structured_logging.current_request_id(),
+                "job_id": job_id,
+                "resumed": resumed,
                 "status": "processing"
             }
         }) + "\n"
 
-        # Process each article
-        for idx, row in enumerate(results, 1):
-            pmcid = row['pmc_id']  # This is pmc_id from the query result
-            pmid = row['pmid']   # This is pmid from the query result
-            content = row['article_text']
-            
-            # Log article details before analysis
-            logger.info(f"Processing article:\nPMCID: {pmcid}\nContent length: {len(content)}\nFirst 200 chars: {content[:200]}")
-            
-            # Add delay between articles
-            if idx > 1:  # Don't delay for first article
-                logger.info("Waiting 5 seconds before next analysis...")
-                time.sleep(5)
-            
-            # Analyze with Gemini and prepare complete response object
+        finished = set()
+        replayed = set()
+        if resumed:
+            seen = set(seen_articles or ())
+
+            def replay():
+                pending = {}
+                for number, event in job_store.events(job_id).items():
+                    finished.add(number)
+                    if number not in seen and number not in replayed:
+                        pending[number] = event
+                for number, event in sorted(restore_article_texts(ranked, pending).items()):
+                    replayed.add(number)
+                    event["data"]["replayed"] = True
+                    yield json.dumps(event) + "\n"
+
+            # A stream of this job that lost its client may still be stopping
+            # its in-flight analyses; relay any that finish instead of repeating them.
+            while not job_store.wait(job_id, 1.0):
+                yield from replay()
+            yield from replay()
+            job_store.record_resume(len(replayed))
+            articles = iter_ranked_articles(ranked, page_size=ARTICLE_FETCH_PAGE_SIZE, skip=finished)
+            unstarted = total_articles - len(finished)
+        job_store.start(job_id)
+        started = True
+
+        # Analyze articles on a bounded worker pool and stream each result as
+        # soon as it finishes. A feeder thread submits articles as their texts
+        # arrive, so the first analysis starts before the rest have downloaded.
+        # Events may arrive out of order; article_number carries the retrieval
+        # rank so the client can reorder them.
+        events = queue.Queue()
+
+        def analyze_and_store(idx, row):
+            event = analyze_article(idx, row, total_articles, methodology_content, disease, events_text,
+                                    relevance_threshold, cancel)
+            # Stored before it is streamed, so a dropped connection cannot lose
+            # it; errors are not stored and are retried on resume.
+            if event["type"] in ("article_analysis", "skipped"):
+                job_store.add_event(job_id, idx, event)
+            return event
+
+        def on_done(future, idx, row):
+            if future.cancelled():
+                # Still queued for a worker when the client went away; never started
+                cancel.record_avoided(calls=1, input_tokens=estimated_article_tokens(row['article_text']))
+                return
             try:
-                # Pass PMCID for URL generation and metadata
-                analysis = analyze_with_gemini(content, pmcid, methodology_content, disease, events_text)
-                if analysis:
-                    # Create complete response object
-                    response_obj = {
-                        "type": "article_analysis",
-                        "data": {
-                            "progress": {
-                                "article_number": idx,
-                                "total_articles": total_articles
-                            },
-                            "analysis": analysis
-                        }
-                    }
-                    # Send complete JSON object with newline
-                    yield json.dumps(response_obj) + "\n"
-                else:
-                    logger.error(f"Failed to analyze article {row['pmc_id']}")
-                    error_obj = {
-                        "type": "error",
-                        "data": {
-                            "message": f"Failed to analyze article {row['pmc_id']}",
-                            "article_number": idx,
-                            "total_articles": total_articles
-                        }
-                    }
-                    yield json.dumps(error_obj) + "\n"
+                events.put(future.result())
             except Exception as e:
-                logger.error(f"Error processing article {row['pmc_id']}: {str(e)}")
-                yield json.dumps({
+                # Every submitted article must produce one event, or the stream never completes
+                logger.error(f"Error analyzing article {idx}: {str(e)}")
+                events.put({
                     "type": "error",
                     "data": {
-                        "message": f"Error processing article {row['pmc_id']}: {str(e)}",
+                        "message": f"Error analyzing {row['pmc_id']}: {str(e)}",
                         "article_number": idx,
                         "total_articles": total_articles
                     }
-                }) + "\n"
+                })
+
+        feed_state = {"submitted": 0}
+
+        def feed(executor):
+            submitted = 0
+            fetch_ms = 0.0
+            try:
+                fetch_start = time.perf_counter()
+                for idx, row in articles:
+                    # Time spent waiting on article texts, excluding submission
+                    fetch_ms += (time.perf_counter() - fetch_start) * 1000
+                    if cancel.cancelled:
+                        break
+                    submitted += 1
+                    feed_state["submitted"] = submitted
+                    if row is None:
+                        events.put({
+                            "type": "error",
+                            "data": {
+                                "message": f"No article text found for {ranked[idx - 1]['pmc_id']}",
+                                "article_number": idx,
+                                "total_articles": total_articles
+                            }
+                        })
+                        continue
+                    article_store.put(row['pmc_id'], row['article_text'])
+                    future = executor.submit(structured_logging.propagate(analyze_and_store), idx, row)
+                    future.add_done_callback(lambda f, idx=idx, row=row: on_done(f, idx, row))
+                    fetch_start = time.perf_counter()
+            except Exception as e:
+                if cancel.cancelled:
+                    # The pool was shut down under us after a disconnect
+                    return
+                logger.error(f"Error fetching article texts: {str(e)}")
+                events.put({"type": "error", "data": {"message": f"Error fetching article texts: {str(e)}"}})
+            finally:
+                request_trace.record("article_fetch", fetch_ms)
+                events.put(submitted)
+
+        processed = 0
+        completed = len(finished)
+        skipped = 0
+        submitted = None
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="article")
+        try:
+            threading.Thread(target=structured_logging.propagate(feed), args=(executor,), name="article-feed", daemon=True).start()
+            while submitted is None or processed < submitted:
+                event = events.get()
+                if isinstance(event, int):
+                    submitted = event
+                    continue
+                # Every submitted article produces exactly one event with its rank
+                if event["type"] == "article_analysis" or "article_number" in event["data"]:
+                    processed += 1
+                    completed += 1
+                if event["type"] == "skipped":
+                    skipped += 1
+                if event["type"] == "article_analysis":
+                    event["data"]["progress"]["completed_articles"] = completed
+                if "telemetry" in event["data"]:
+                    request_trace.merge(event["data"]["telemetry"])
+                # Send complete JSON object with newline
+                yield json.dumps(event) + "\n"
+        except GeneratorExit:
+            cancel.cancel()
+            # Articles the feeder never reached are calls that will not be made
+            cancel.record_avoided(calls=max(unstarted - feed_state["submitted"], 0))
+            raise
+        finally:
+            # Queued analyses are dropped; in-flight ones stop at their next
+            # cancellation check and are reported by report_cancellation.
+            executor.shutdown(wait=not cancel.cancelled, cancel_futures=cancel.cancelled)
+            if cancel.cancelled:
+                started = False
+                threading.Thread(target=structured_logging.propagate(report_cancellation),
+                                 args=(cancel, executor, job_id, True), name="cancel-report", daemon=True).start()
+
+        request_trace.record("request_total", (time.perf_counter() - request_start) * 1000)
+        stage_metrics.count("requests")
+        stage_metrics.count("articles", processed)
 
         # Send completion message as complete JSON object
         completion_obj = {
@@ -550,11 +2123,36 @@ def stream_response(events_text, methodology_content=None, disease=None, num_art
             "data": {
                 "total_articles": total_articles,
                 "current_article": total_articles,
-                "status": "complete"
+                "status": "complete",
+                "job": {
+                    "job_id": job_id,
+                    "resumed": resumed,
+                    "replayed": len(replayed),
+                    "analyzed": processed
+                },
+                "rate_limiter": gemini_rate_controller.stats(),
+                "analysis_cache": analysis_cache.stats(),
+                "structured_output": structured_output_stats(),
+                # Per-article stages are summed across articles, so they can exceed request_total
+                "telemetry": request_trace.as_dict(),
+                "relevance_gate": {
+                    "enabled": relevance_gate,
+                    "model": RELEVANCE_GATE_MODEL if relevance_gate else None,
+                    "threshold": relevance_threshold,
+                    "skipped": skipped,
+                    "pro_calls_saved": skipped
+                }
             }
         }
         yield json.dumps(completion_obj) + "\n"
 
+    except GeneratorExit:
+        # The client disconnected or a write to it failed
+        if not cancel.cancelled:
+            cancel.cancel()
+            cancel.record_avoided(calls=unstarted)
+            report_cancellation(cancel, None, job_id)
+        raise
     except Exception as e:
         logger.error(f"Error in stream_response: {str(e)}")
         yield json.dumps({
@@ -563,9 +2161,17 @@ def stream_response(events_text, methodology_content=None, disease=None, num_art
                 "message": str(e)
             }
         }) + "\n"
+    finally:
+        if started:
+            job_store.finish(job_id)
+        structured_logging.reset_request_id(log_token)
+
+# Serve from the local journal snapshot immediately and refresh from BigQuery
+# in the background; only a missing snapshot makes the cold start wait on BigQuery.
+init_journal_data()
 
-# Fetch journal impact data when module loads
-fetch_journal_impact_data()
+if LOCAL_VECTOR_INDEX_DIR:
+    load_local_index()
 
 @functions_framework.http
 def retrieve_full_articles(request):
@@ -573,12 +2179,27 @@ def retrieve_full_articles(request):
     if request.method == 'OPTIONS':
         headers = {
             'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'POST',
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Methods': 'GET, POST',
+            'Access-Control-Allow-Headers': 'Content-Type, X-Request-Id',
             'Access-Control-Max-Age': '3600'
         }
         return ('', 204, headers)
 
+    # Report shared rate controller and cache state for monitoring
+    if request.method == 'GET':
+        return jsonify({
+            "rate_limiter": gemini_rate_controller.stats(),
+            "analysis_cache": analysis_cache.stats(),
+            "content_store": article_store.stats(),
+            "journal_data": journal_data_stats(),
+            "embedding_cache": embedding_cache.stats(),
+            "search_cache": search_cache.stats(),
+            "local_vector_index": local_index.stats() if local_index is not None else None,
+            "jobs": job_store.stats(),
+            "structured_output": structured_output_stats(),
+            "telemetry": stage_metrics.stats()
+        }), 200, {'Access-Control-Allow-Origin': '*'}
+
     headers = {
         'Access-Control-Allow-Origin': '*',
         'Content-Type': 'text/event-stream',
@@ -591,17 +2212,29 @@ def retrieve_full_articles(request):
         if not request_json:
             return jsonify({'error': 'No JSON data received'}), 400, headers
 
+        # Resuming a job only needs its ID; the job's own parameters are reused
+        job_id = request_json.get('job_id')
+        seen_articles = request_json.get('seen_article_numbers')
+        if seen_articles is None and request_json.get('last_article_number') is not None:
+            seen_articles = range(1, int(request_json['last_article_number']) + 1)
+
         events_text = request_json.get('events_text')
-        if not events_text:
+        if not events_text and not job_id:
             return jsonify({'error': 'Missing events_text field'}), 400, headers
 
         # Get methodology content, disease, and num_articles if provided
         methodology_content = request_json.get('methodology_content')
         disease = request_json.get('disease')
         num_articles = request_json.get('num_articles', 15)  # Default to 15 if not provided
+        concurrency = request_json.get('concurrency')  # Parallel article analyses; server default if omitted
+        retrieval_mode = request_json.get('retrieval_mode')  # "two_phase" or "single"; server default if omitted
+        relevance_gate = request_json.get('relevance_gate')  # Screen articles with the gate model first
+        relevance_threshold = request_json.get('relevance_threshold')
 
         return Response(
-            stream_response(events_text, methodology_content, disease, num_articles),
+            stream_response(events_text, methodology_content, disease, num_articles, concurrency, retrieval_mode,
+                            relevance_gate, relevance_threshold, structured_logging.new_request_id(request),
+                            job_id, seen_articles),
             headers=headers,
             mimetype='text/event-stream'
         )
@@ -0,0 +1,193 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Article scoring driven by a versioned scoring profile.
+
+Article metadata is turned into a feature matrix (one row per article, one
+column per feature) and scored in one NumPy operation, so a batch of cached
+analyses can be re-ranked under a different profile without calling Gemini.
+The default profile reproduces the original calculate_points weights.
+
+Each Cloud Function deploys from its own directory, so this module is copied
+into retrieve-full-articles and rerank-articles. Keep the copies identical.
+"""
+
+import copy
+import hashlib
+import json
+import math
+from datetime import datetime
+
+import numpy as np
+
+DEFAULT_SCORING_PROFILE = {
+    "name": "default",
+    "version": 1,
+    # Journal impact: min(log(SJR + 1) * scale, cap)
+    "journal_impact_scale": 5,
+    "journal_impact_cap": 25,
+    # Year points are weights["year"] per year before reference_year (null: current year)
+    "reference_year": None,
+    "weights": {
+        "year": -5,
+        "disease_match": 50,
+        "pediatric_focus": 20,
+        "paper_type_clinical_trial": 40,
+        "paper_type_review": -5,
+        "actionable_events": 15,  # per event that matches the query
+        "drugs_tested": 5,
+        "treatment_shown": 50,
+        "cell_studies": 5,
+        "mice_studies": 10,
+        "case_report": 5,
+        "series_of_case_reports": 10,
+        "clinical_study": 15,
+        "clinical_study_on_children": 20,
+        "novelty": 10,
+    },
+}
+
+# Feature columns, in breakdown order; both paper_type columns report as "paper_type"
+FEATURES = ["journal_impact"] + list(DEFAULT_SCORING_PROFILE["weights"])
+BREAKDOWN_KEYS = {"paper_type_clinical_trial": "paper_type", "paper_type_review": "paper_type"}
+BOOLEAN_FEATURES = [
+    "disease_match", "pediatric_focus", "drugs_tested", "treatment_shown", "cell_studies", "mice_studies",
+    "case_report", "series_of_case_reports", "clinical_study", "clinical_study_on_children", "novelty",
+]
+
+
+class ScoringProfileError(ValueError):
+    """Raised for a scoring profile that is not an object, or has unknown features or non-numeric weights."""
+
+
+def resolve_profile(overrides=None, base=None):
+    """Merge a partial profile onto base (default: DEFAULT_SCORING_PROFILE) and validate it."""
+    profile = copy.deepcopy(base or DEFAULT_SCORING_PROFILE)
+    overrides = {} if overrides is None else overrides
+    if not isinstance(overrides, dict):
+        raise ScoringProfileError("A scoring profile must be a JSON object")
+    weights = overrides.get("weights") or {}
+    if not isinstance(weights, dict):
+        raise ScoringProfileError("Scoring profile weights must be a JSON object")
+    unknown = set(weights) - set(profile["weights"])
+    if unknown:
+        raise ScoringProfileError(f"Unknown scoring features: {sorted(unknown)}")
+    for key, value in overrides.items():
+        if key != "weights":
+            profile[key] = value
+    profile["weights"].update(weights)
+    numbers = {"journal_impact_scale": profile["journal_impact_scale"],
+               "journal_impact_cap": profile["journal_impact_cap"]}
+    numbers.update({f"weights.{name}": value for name, value in profile["weights"].items()})
+    if profile.get("reference_year") is not None:
+        numbers["reference_year"] = profile["reference_year"]
+    for key, value in numbers.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ScoringProfileError(f"Scoring profile value {key} must be a number")
+    return profile
+
+
+def load_profile(path):
+    """Read a profile JSON file (partial profiles are merged onto the default)."""
+    with open(path, 'r', encoding='utf-8') as file:
+        return resolve_profile(json.load(file))
+
+
+def profile_id(profile):
+    """name@version plus a short hash of the effective settings, so overridden weights get their own id."""
+    settings = {key: value for key, value in profile.items() if key not in ("name", "version")}
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+    return f"{profile['name']}@{profile['version']}+{digest}"
+
+
+def feature_matrix(metadatas):
+    """Return (features, present): float and bool matrices of shape (articles, len(FEATURES)).
+
+    features holds raw values (log SJR, years since publication are computed
+    at scoring time); present marks the features that apply to an article,
+    which is what decides whether they appear in its point breakdown.
+    """
+    features = np.zeros((len(metadatas), len(FEATURES)), dtype=np.float64)
+    present = np.zeros((len(metadatas), len(FEATURES)), dtype=bool)
+    column = {name: idx for idx, name in enumerate(FEATURES)}
+    for row, metadata in enumerate(metadatas):
+        try:
+            sjr = float(metadata.get('journal_sjr') or 0)
+        except (ValueError, TypeError):
+            sjr = 0.0
+        if metadata.get('journal_title') and sjr > 0:
+            features[row, column["journal_impact"]] = math.log(sjr + 1)
+            present[row, column["journal_impact"]] = True
+
+        if metadata.get('year'):
+            try:
+                features[row, column["year"]] = int(metadata.get('year'))
+                present[row, column["year"]] = True
+            except (ValueError, TypeError):
+                # If year is not a valid integer, skip year-based points
+                pass
+
+        paper_type = (metadata.get('paper_type') or '').lower()
+        if 'clinical trial' in paper_type:
+            present[row, column["paper_type_clinical_trial"]] = True
+        elif 'review' in paper_type:
+            present[row, column["paper_type_review"]] = True
+
+        matched_events = sum(1 for event in metadata.get('actionable_events') or []
+                             if isinstance(event, dict) and event.get('matches_query', False))
+        features[row, column["actionable_events"]] = matched_events
+        present[row, column["actionable_events"]] = matched_events > 0
+
+        for name in BOOLEAN_FEATURES:
+            present[row, column[name]] = bool(metadata.get(name))
+
+    # Flag features count once when present
+    for name in BOOLEAN_FEATURES + ["paper_type_clinical_trial", "paper_type_review"]:
+        features[:, column[name]] = present[:, column[name]]
+    return features, present
+
+
+def score_matrix(features, present, profile=None):
+    """Points per feature (articles x features) under profile; absent features score 0."""
+    profile = profile or DEFAULT_SCORING_PROFILE
+    reference_year = profile.get("reference_year") or datetime.now().year
+    weights = np.array([1.0] + [profile["weights"][name] for name in FEATURES[1:]], dtype=np.float64)
+
+    values = features.copy()
+    journal, year = FEATURES.index("journal_impact"), FEATURES.index("year")
+    values[:, journal] = np.minimum(values[:, journal] * profile["journal_impact_scale"],
+                                    profile["journal_impact_cap"])
+    values[:, year] = reference_year - values[:, year]
+    return np.where(present, values * weights, 0.0)
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def score_batch(metadatas, profile=None):
+    """Return [(points, breakdown)] for a list of article metadata dicts."""
+    if not metadatas:
+        return []
+    features, present = feature_matrix(metadatas)
+    points = score_matrix(features, present, profile)
+    totals = points.sum(axis=1)
+    results = []
+    for row in range(len(metadatas)):
+        breakdown = {}
+        for col in np.flatnonzero(present[row]):
+            breakdown[BREAKDOWN_KEYS.get(FEATURES[col], FEATURES[col])] = _number(points[row, col])
+        results.append((_number(totals[row]), breakdown))
+    return results
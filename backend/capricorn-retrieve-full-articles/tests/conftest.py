@@ -0,0 +1,47 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run from this function's directory: python -m pytest tests
+
+main.py creates its Gemini and BigQuery clients at import time, so the
+`main` fixture imports it with anonymous credentials, BigQuery queries
+disabled and its SQLite stores in a temporary directory.
+"""
+
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    import google.auth
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import bigquery
+
+    store_dir = tmp_path_factory.mktemp("stores")
+    patch = pytest.MonkeyPatch()
+    patch.setattr(google.auth, "default", lambda *args, **kwargs: (AnonymousCredentials(), "test-project"))
+    patch.setattr(bigquery.Client, "query", lambda *args, **kwargs: (_ for _ in ()).throw(RuntimeError("offline")))
+    patch.setenv("ANALYSIS_CACHE_PATH", str(store_dir / "analysis_cache.sqlite"))
+    patch.setenv("JOB_STORE_PATH", str(store_dir / "jobs.sqlite"))
+    patch.setenv("JOURNAL_SNAPSHOT_PATH", str(store_dir / "journal_snapshot.json"))
+    patch.setenv("JOURNAL_BACKGROUND_REFRESH", "false")
+    module = importlib.import_module("main")
+    yield module
+    patch.undo()
@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "cache.sqlite")
+
+
+def test_memory_then_disk_hits(main, cache_path):
+    cache = main.AnalysisCache(cache_path, memory_entries=1)
+    cache.put("a", {"article_metadata": {"title": "A"}})
+    cache.put("b", {"article_metadata": {"title": "B"}})
+
+    # "a" was pushed out of the one-entry memory tier but is still on disk
+    assert cache.get("b") == {"article_metadata": {"title": "B"}}
+    assert cache.get("a") == {"article_metadata": {"title": "A"}}
+    assert cache.get("missing") is None
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_entries_survive_a_new_instance(main, cache_path):
+    main.AnalysisCache(cache_path).put("key", {"value": 1})
+    reopened = main.AnalysisCache(cache_path)
+    assert reopened.contains("key")
+    assert reopened.get("key") == {"value": 1}
+
+
+def test_expired_entries_are_misses(main, cache_path):
+    cache = main.AnalysisCache(cache_path, ttl_seconds=0.05)
+    cache.put("key", {"value": 1})
+    time.sleep(0.1)
+    assert not cache.contains("key")
+    assert cache.get("key") is None
+
+
+def test_disk_tier_is_bounded_by_least_recent_access(main, cache_path):
+    cache = main.AnalysisCache(cache_path, memory_entries=1, max_entries=2)
+    cache.put("old", 1)
+    time.sleep(0.01)
+    cache.put("kept", 2)
+    time.sleep(0.01)
+    cache.get("old")
+    time.sleep(0.01)
+    cache.put("new", 3)
+
+    reopened = main.AnalysisCache(cache_path)
+    assert reopened.get("old") == 1
+    assert reopened.get("new") == 3
+    assert reopened.get("kept") is None
+
+
+def test_unusable_path_falls_back_to_memory(main, tmp_path):
+    cache = main.AnalysisCache(str(tmp_path / "missing" / "cache.sqlite"))
+    cache.put("key", {"value": 1})
+    assert cache.get("key") == {"value": 1}
+
+
+def test_cache_key_ignores_formatting_but_not_context(main):
+    key = main.analysis_cache_key("PMC1", "Neuroblastoma ", "MYCN amplification\nALK F1174L")
+    assert key == main.analysis_cache_key("PMC1", "neuroblastoma", "alk f1174l\n\nMYCN   amplification")
+    assert key != main.analysis_cache_key("PMC2", "neuroblastoma", "alk f1174l\nmycn amplification")
+    assert key != main.analysis_cache_key("PMC1", "neuroblastoma", "alk f1174l")
+    assert key != main.analysis_cache_key("PMC1", "neuroblastoma", "alk f1174l\nmycn amplification",
+                                          methodology_content="Prefer phase III trials")
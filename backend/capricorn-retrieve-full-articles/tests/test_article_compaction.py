@@ -0,0 +1,155 @@
+import pytest
+
+SECTIONS = ['title', 'abstract', 'case', 'methods', 'results', 'discussion', 'tables']
+
+ARTICLE = """Crizotinib in ALK-mutated neuroblastoma
+A. Author, B. Author
+Children's Hospital
+
+Abstract
+ALK F1174L tumors responded to crizotinib.
+
+1. Introduction
+Neuroblastoma is the most common extracranial solid tumor.
+
+2. Materials and Methods
+2.1 Patients
+Twenty children were enrolled.
+
+3. Results
+Eight of twenty patients responded.
+
+Table 1. Patient characteristics
+Age, sex, stage.
+
+4. Discussion
+Responses were durable.
+
+Acknowledgments
+We thank the families.
+
+Funding
+Grant 123.
+
+Author Contributions
+A.A. wrote the paper.
+
+References
+1. Smith J. Neuroblastoma. 2010.
+"""
+
+
+@pytest.mark.parametrize("heading, section", [
+    ("Abstract", "abstract"),
+    ("1. Introduction", "introduction"),
+    ("2. Materials and Methods:", "methods"),
+    ("III. RESULTS", "results"),
+    ("Conclusions", "discussion"),
+    ("Case Presentation", "case"),
+    ("Clinical case report", "case"),
+    ("Presentation of the case", "case"),
+    ("Table 2 Adverse events by grade", "tables"),
+    ("References", "dropped"),
+    ("Acknowledgements", "dropped"),
+    ("Acknowledgments", "dropped"),
+    ("Funding information", "dropped"),
+    ("Author Contributions", "dropped"),
+    ("Authors' contributions", "dropped"),
+    ("Conflict of Interest", "dropped"),
+    ("Supplementary Materials", "dropped"),
+])
+def test_headings_are_classified(main, heading, section):
+    assert main.classify_heading(heading) == section
+
+
+@pytest.mark.parametrize("line", [
+    "2.1 Patients",
+    "The results were consistent with previous reports.",
+    "Results " + "x" * 100,
+    "",
+])
+def test_sub_headings_and_prose_are_not_headings(main, line):
+    assert main.classify_heading(line) is None
+
+
+def test_article_is_split_into_sections_in_document_order(main):
+    sections = main.split_article_sections(ARTICLE)
+    assert [name for name, _ in sections] == [
+        'title', 'body', 'abstract', 'introduction', 'methods', 'results', 'tables', 'discussion',
+        'dropped', 'dropped', 'dropped', 'dropped']
+    # An unrecognised sub-heading stays in its section
+    assert "2.1 Patients\nTwenty children" in dict(sections)['methods']
+
+
+def test_compaction_keeps_informative_sections_and_drops_back_matter(main):
+    compacted, report = main.compact_article(ARTICLE, sections=SECTIONS, token_budget=10000)
+    for kept in ("Crizotinib in ALK-mutated", "ALK F1174L tumors", "Twenty children", "Eight of twenty",
+                 "Age, sex, stage", "Responses were durable"):
+        assert kept in compacted
+    for dropped in ("We thank the families", "Grant 123", "A.A. wrote", "Smith J.",
+                    "Children's Hospital", "most common extracranial"):
+        assert dropped not in compacted
+    assert report["sections_kept"] == ['abstract', 'discussion', 'methods', 'results', 'tables', 'title']
+    assert report["sections_truncated"] == []
+    assert report["compacted_tokens"] < report["original_tokens"]
+
+
+def test_case_report_keeps_its_case_section(main):
+    article = """Infant with KMT2A-rearranged AML
+Abstract
+A case of infant leukemia.
+Case Presentation
+A 4-month-old girl presented with hepatosplenomegaly and was treated with venetoclax.
+Discussion
+Venetoclax was tolerated.
+References
+1. Doe J.
+"""
+    compacted, report = main.compact_article(article, sections=SECTIONS, token_budget=10000)
+    assert "treated with venetoclax" in compacted
+    assert "Doe J." not in compacted
+    assert 'case' in report["sections_kept"]
+
+
+def test_case_section_outranks_methods_under_a_tight_budget(main):
+    article = ("Title\nAbstract\nShort.\nMethods\n" + "method text. " * 200
+               + "\nCase Report\n" + "case text. " * 50 + "\n")
+    compacted, report = main.compact_article(article, sections=SECTIONS, token_budget=200)
+    assert compacted.count("case text.") == 50
+    assert report["sections_truncated"] == ['methods']
+
+
+def test_article_without_headings_is_only_truncated(main):
+    article = "Untitled\n\n" + "\n\n".join(f"Paragraph {n} about neuroblastoma outcomes." for n in range(200))
+    compacted, report = main.compact_article(article, sections=SECTIONS, token_budget=100)
+    assert report["sections_kept"] == ["body"]
+    assert report["sections_truncated"] == ["body"]
+    assert compacted.startswith("Untitled")
+    assert compacted.endswith("[...]")
+    assert main.estimate_tokens(compacted) <= 100 + 2
+
+    short = "Untitled\n\nOne paragraph."
+    assert main.compact_article(short, sections=SECTIONS, token_budget=100) == (short, {
+        "original_tokens": main.estimate_tokens(short),
+        "compacted_tokens": main.estimate_tokens(short),
+        "sections_kept": ["body"],
+        "sections_truncated": [],
+    })
+
+
+@pytest.mark.parametrize("budget", [20, 50, 80, 150, 400])
+def test_compaction_stays_within_the_token_budget(main, budget):
+    article = ARTICLE.replace("Eight of twenty patients responded.", "Eight of twenty patients responded. " * 100)
+    compacted, report = main.compact_article(article, sections=SECTIONS, token_budget=budget)
+    # Each kept section may add its "[...]" marker and a separating blank line
+    assert report["compacted_tokens"] <= budget + 2 * len(report["sections_kept"])
+    # The title and abstract rank first and always survive
+    assert "Crizotinib in ALK-mutated" in compacted
+
+
+def test_truncation_prefers_paragraph_then_sentence_boundaries(main):
+    text = "First paragraph sentence one. Sentence two.\n\n" + "Second paragraph. " * 20
+    assert main.truncate_to_tokens(text, 20) == "First paragraph sentence one. Sentence two.\n[...]"
+    assert main.truncate_to_tokens("One. Two. Three. Four.", 5) == "One. Two. Three.\n[...]"
+    assert main.truncate_to_tokens("x" * 100, 10) == "x" * 40 + " [...]"
+    assert main.truncate_to_tokens("short", 10) == "short"
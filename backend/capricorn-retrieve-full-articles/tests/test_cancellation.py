@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from cancellation import CancellationToken, Cancelled
+
+
+class ClosableStream:
+    def __init__(self, items):
+        self.items = iter(items)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.items)
+
+    def close(self):
+        self.closed = True
+
+
+def test_first_reason_wins_and_raises():
+    token = CancellationToken()
+    token.raise_if_cancelled()
+    token.cancel()
+    token.cancel("write_failed")
+    with pytest.raises(Cancelled, match="client_disconnected"):
+        token.raise_if_cancelled()
+    assert token.stats()["reason"] == "client_disconnected"
+
+
+def test_wait_ends_early_when_cancelled():
+    token = CancellationToken()
+    threading.Timer(0.05, token.cancel).start()
+    start = time.monotonic()
+    assert token.wait(5)
+    assert time.monotonic() - start < 2
+
+
+def test_iterate_closes_a_cancelled_stream_instead_of_draining_it():
+    token = CancellationToken()
+    stream = ClosableStream(range(100))
+    received = []
+    with pytest.raises(Cancelled):
+        for item in token.iterate(stream):
+            received.append(item)
+            if item == 2:
+                token.cancel()
+    assert received == [0, 1, 2]
+    assert stream.closed
+    assert token.stats()["abandoned_streams"] == 1
+
+
+def test_finished_stream_is_not_counted_as_abandoned():
+    token = CancellationToken()
+    stream = ClosableStream(range(3))
+    assert list(token.iterate(stream)) == [0, 1, 2]
+    assert stream.closed
+    assert token.stats()["abandoned_streams"] == 0
+
+
+def test_rate_controller_waiter_gives_up_when_cancelled(main, monkeypatch):
+    monkeypatch.setattr(main, "CANCEL_POLL_SECONDS", 0.01)
+    controller = main.AdaptiveRateController(initial_limit=1, max_limit=1)
+    holder_started, release_holder = threading.Event(), threading.Event()
+
+    def hold():
+        holder_started.set()
+        release_holder.wait(5)
+
+    holder = threading.Thread(target=controller.call, args=(hold,))
+    holder.start()
+    holder_started.wait(5)
+    token = CancellationToken()
+    threading.Timer(0.05, token.cancel).start()
+    try:
+        with pytest.raises(Cancelled):
+            controller.call(lambda: pytest.fail("cancelled call must not run"), cancel=token,
+                            estimated_tokens=1200)
+    finally:
+        release_holder.set()
+        holder.join()
+    assert token.stats()["avoided_calls"] == 1
+    assert token.stats()["avoided_input_tokens_estimate"] == 1200
+
+
+def test_closing_the_stream_cancels_queued_articles(main, monkeypatch, tmp_path):
+    tokens, analyzed = [], []
+
+    def analyze(article_text, pmcid, *args, trace=None, cancel=None):
+        tokens.append(cancel)
+        analyzed.append(pmcid)
+        return {"article_metadata": {"PMCID": pmcid, "overall_points": 1}, "full_article_text": article_text}
+
+    def query(query, job_config=None):
+        if "UNNEST(@pmc_ids)" in query:
+            rows = [{"pmc_id": pmc_id, "pmid": "1", "article_text": "text"}
+                    for pmc_id in job_config.query_parameters[0].values]
+        else:
+            rows = [{"pmc_id": f"PMC{n}", "pmid": str(n), "distance": n / 10, "query_embedding": []}
+                    for n in range(10)]
+        return SimpleNamespace(result=lambda page_size=None: iter(rows))
+
+    monkeypatch.setattr(main, "bq_client", SimpleNamespace(query=query))
+    monkeypatch.setattr(main, "analyze_with_gemini", analyze)
+    monkeypatch.setattr(main, "job_store", main.JobStore(str(tmp_path / "jobs.sqlite")))
+    monkeypatch.setattr(main, "analysis_cache", main.AnalysisCache(str(tmp_path / "cache.sqlite")))
+    monkeypatch.setattr(main, "search_cache", main.TTLCache())
+    monkeypatch.setattr(main, "local_index", None)
+    monkeypatch.setattr(main, "PMC_EMBEDDING_TABLE", None)
+
+    stream = main.stream_response("ALK F1174L", num_articles=10, concurrency=1)
+    for line in stream:
+        if json.loads(line)["type"] == "article_analysis":
+            break
+    stream.close()
+
+    assert tokens and all(token.cancelled for token in tokens)
+    assert len(analyzed) < 10
+
+
+def test_copies_are_identical():
+    backend = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    copies = set()
+    for function in ("capricorn-retrieve-full-articles", "capricorn-final-analysis", "capricorn-chat"):
+        with open(os.path.join(backend, function, "cancellation.py"), encoding="utf-8") as file:
+            copies.add(file.read())
+    assert len(copies) == 1
@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+import pytest
+
+import load_pmc_embeddings_to_bq as loader
+
+DEDUP_TABLE = "project.pmc_embeddings.articles_dedup"
+
+
+class FakeBigQuery:
+    """Answers each query with the rows of the first matching marker."""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.queries = []
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        rows = next((rows for marker, rows in self.answers if marker in query), [])
+        return SimpleNamespace(result=lambda **kwargs: rows)
+
+    def get_table(self, table_ref):
+        return SimpleNamespace(num_rows=3)
+
+
+@pytest.fixture
+def dedup_table(main, monkeypatch):
+    monkeypatch.setattr(main, "PMC_EMBEDDING_TABLE", DEDUP_TABLE)
+    monkeypatch.setattr(main, "VECTOR_SEARCH_OVERFETCH", 1.0)
+    monkeypatch.setattr(main, "local_index", None)
+    monkeypatch.setattr(main, "embedding_cache", main.TTLCache())
+    monkeypatch.setattr(main, "search_cache", main.TTLCache())
+
+
+def test_top_k_on_the_duplicated_table_keeps_a_margin(main, monkeypatch):
+    monkeypatch.setattr(main, "PMC_EMBEDDING_TABLE", None)
+    monkeypatch.setattr(main, "VECTOR_SEARCH_OVERFETCH", 5.0)
+    assert main.vector_search_top_k(15) == 75
+    assert main.vector_search_top_k(3) == 23
+    assert main.vector_search_top_k(200) == main.MAX_VECTOR_SEARCH_ROWS
+
+
+def test_top_k_on_the_dedup_table_is_the_request(main, dedup_table):
+    assert main.vector_search_top_k(3) == 3
+    assert main.vector_search_top_k(15) == 15
+
+
+def test_dedup_table_query_skips_text_and_dedup(main, dedup_table):
+    query = main.create_bq_query("ALK F1174L", num_articles=15, include_text=True)
+    assert f"TABLE `{DEDUP_TABLE}`" in query
+    assert "top_k => 15" in query
+    assert "article_text" not in query
+    assert "PARTITION BY pmc_id" not in query
+
+
+def test_dedup_table_search_fetches_texts_by_id(main, dedup_table, monkeypatch):
+    bq = FakeBigQuery([
+        ("VECTOR_SEARCH", [{"pmc_id": "PMC2", "pmid": "2", "distance": 0.1, "query_embedding": [0.5]},
+                           {"pmc_id": "PMC1", "pmid": "1", "distance": 0.2, "query_embedding": []}]),
+        ("UNNEST(@pmc_ids)", [{"pmc_id": "PMC1", "pmid": "1", "article_text": "one"},
+                              {"pmc_id": "PMC2", "pmid": "2", "article_text": "two"}]),
+    ])
+    monkeypatch.setattr(main, "bq_client", bq)
+
+    rows = main.retrieve_articles("ALK F1174L", num_articles=2)
+
+    assert [(row["pmc_id"], row["article_text"], row["distance"]) for row in rows] == [
+        ("PMC2", "two", 0.1), ("PMC1", "one", 0.2)]
+    assert len(bq.queries) == 2
+
+
+def test_loader_keeps_one_row_per_pmcid():
+    bq = FakeBigQuery([])
+    loader.create_dedup_table(bq, loader.SOURCE_TABLE, DEDUP_TABLE)
+    assert f"CREATE OR REPLACE TABLE `{DEDUP_TABLE}`" in bq.queries[0]
+    assert "QUALIFY ROW_NUMBER() OVER (PARTITION BY pmc_id ORDER BY pmid) = 1" in bq.queries[0]
+
+
+def test_loader_vector_index_options():
+    bq = FakeBigQuery([])
+    loader.create_vector_index(bq, DEDUP_TABLE, "articles_dedup_embedding_index", "IVF", 1000)
+    loader.create_vector_index(bq, DEDUP_TABLE, "articles_dedup_embedding_index", "TREE_AH", 1000)
+    assert "ivf_options = '{\"num_lists\": 1000}'" in bq.queries[0]
+    assert "index_type = 'TREE_AH'" in bq.queries[1]
+    assert "ivf_options" not in bq.queries[1]
+
+
+def test_loader_over_fetch_is_rows_per_distinct_article():
+    bq = FakeBigQuery([("VECTOR_SEARCH", [{"total_rows": 75, "distinct_ids": 50},
+                                          {"total_rows": 75, "distinct_ids": 75}])])
+    assert loader.measure_over_fetch(bq, DEDUP_TABLE, 2, 75) == [1.5, 1.0]
+
+
+def test_loader_measures_over_fetch_on_the_source_table(monkeypatch, capsys):
+    bq = FakeBigQuery([
+        ("COUNT(DISTINCT pmc_id) AS distinct_ids\n    FROM", [{"total_rows": 10, "distinct_ids": 8}]),
+        ("VECTOR_SEARCH", [{"total_rows": 75, "distinct_ids": 60}, {"total_rows": 75, "distinct_ids": 50}]),
+    ])
+    bq.create_dataset = lambda dataset, exists_ok=False: None
+    monkeypatch.setattr(loader.bigquery, "Client", lambda project: bq)
+    monkeypatch.setattr("sys.argv", ["load_pmc_embeddings_to_bq.py", "--project-id", "project"])
+
+    loader.main()
+
+    searches = [query for query in bq.queries if "VECTOR_SEARCH" in query]
+    assert len(searches) == 1
+    assert f"TABLE `{loader.SOURCE_TABLE}`" in searches[0]
+    assert DEDUP_TABLE not in searches[0]
+    output = capsys.readouterr().out
+    assert f"PMC_EMBEDDING_TABLE={DEDUP_TABLE}" in output
+    assert "VECTOR_SEARCH_OVERFETCH=1.5" in output
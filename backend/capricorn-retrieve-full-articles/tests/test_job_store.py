@@ -0,0 +1,136 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def store(main, tmp_path):
+    return main.JobStore(str(tmp_path / "jobs.sqlite"))
+
+
+def test_job_round_trip(store):
+    store.create("job1", {"disease": "neuroblastoma"}, [{"pmc_id": "PMC1"}])
+    store.add_event("job1", 1, {"type": "article_analysis"})
+    store.add_event("job1", 1, {"type": "article_analysis", "retry": True})
+    assert store.get("job1") == {"params": {"disease": "neuroblastoma"}, "ranked": [{"pmc_id": "PMC1"}]}
+    assert store.events("job1") == {1: {"type": "article_analysis", "retry": True}}
+    assert store.get("unknown") is None
+
+
+def test_events_are_stored_without_the_article_text(store):
+    event = {"type": "article_analysis", "data": {"analysis": {"article_metadata": {}, "full_article_text": "x" * 1000}}}
+    store.add_event("job1", 1, event)
+    assert store.events("job1") == {1: {"type": "article_analysis", "data": {"analysis": {"article_metadata": {}}}}}
+    # The caller's event, which is also streamed, keeps its text
+    assert event["data"]["analysis"]["full_article_text"] == "x" * 1000
+
+
+def test_expired_jobs_are_gone_and_purged(main, tmp_path):
+    store = main.JobStore(str(tmp_path / "jobs.sqlite"), ttl_seconds=0.05)
+    store.create("old", {}, [])
+    store.add_event("old", 1, {})
+    time.sleep(0.1)
+    assert store.get("old") is None
+    store.create("new", {}, [])
+    assert store.events("old") == {}
+    assert store.stats()["jobs"] == 1
+
+
+def test_wait_returns_once_the_running_stream_finishes(store):
+    store.start("job1")
+    assert not store.wait("job1", 0.01)
+    threading.Timer(0.05, store.finish, args=("job1",)).start()
+    assert store.wait("job1", 5)
+    assert store.wait("never-started", 0)
+
+
+class FakeBigQuery:
+    def query(self, query, job_config=None):
+        if "UNNEST(@pmc_ids)" in query:
+            rows = [{"pmc_id": pmc_id, "pmid": pmc_id[3:], "article_text": f"text of {pmc_id}"}
+                    for pmc_id in job_config.query_parameters[0].values]
+        else:
+            rows = [{"pmc_id": f"PMC{n}", "pmid": str(n), "distance": n / 10, "query_embedding": []}
+                    for n in range(6)]
+        return SimpleNamespace(result=lambda page_size=None: iter(rows))
+
+
+@pytest.fixture
+def retrieval(main, monkeypatch, store, tmp_path):
+    analyzed = []
+
+    def analyze(article_text, pmcid, *args, trace=None, cancel=None):
+        analyzed.append(pmcid)
+        return {"article_metadata": {"PMCID": pmcid, "overall_points": 1}, "full_article_text": article_text}
+
+    monkeypatch.setattr(main, "bq_client", FakeBigQuery())
+    monkeypatch.setattr(main, "analyze_with_gemini", analyze)
+    monkeypatch.setattr(main, "job_store", store)
+    monkeypatch.setattr(main, "analysis_cache", main.AnalysisCache(str(tmp_path / "cache.sqlite")))
+    monkeypatch.setattr(main, "embedding_cache", main.TTLCache())
+    monkeypatch.setattr(main, "search_cache", main.TTLCache())
+    monkeypatch.setattr(main, "local_index", None)
+    monkeypatch.setattr(main, "PMC_EMBEDDING_TABLE", None)
+    monkeypatch.setattr(main, "article_store", main.content_store.open_store("memory"))
+    return analyzed
+
+
+def events(stream):
+    return [json.loads(line) for line in stream]
+
+
+def article_numbers(stream_events):
+    return [event["data"]["progress"]["article_number"]
+            for event in stream_events if event["type"] == "article_analysis"]
+
+
+def test_resume_replays_unseen_articles_and_analyzes_only_the_rest(main, retrieval, store):
+    stream = main.stream_response("ALK F1174L", disease="neuroblastoma", num_articles=6, concurrency=1)
+    first = []
+    for line in stream:
+        first.append(json.loads(line))
+        if len(article_numbers(first)) == 2:
+            break
+    stream.close()
+    job_id = next(event["data"]["job_id"] for event in first if event["type"] == "metadata")
+    seen = article_numbers(first)
+    finished = set(store.events(job_id))
+    analyzed_before = list(retrieval)
+
+    resumed = events(main.stream_response(None, job_id=job_id, seen_articles=seen, concurrency=1))
+
+    assert sorted(seen + article_numbers(resumed)) == [1, 2, 3, 4, 5, 6]
+    assert resumed[-1]["data"]["status"] == "complete"
+    # Articles finished before the disconnect are replayed, not analyzed again
+    assert sorted(retrieval) == sorted(set(retrieval))
+    assert len(retrieval) - len(analyzed_before) == 6 - len(finished)
+    assert store.stats()["resumed"] == 1
+    # Replayed analyses get their full text back
+    replayed = [event["data"] for event in resumed if event["data"].get("replayed")]
+    assert replayed
+    for data in replayed:
+        pmcid = data["analysis"]["article_metadata"]["PMCID"]
+        assert data["analysis"]["full_article_text"] == f"text of {pmcid}"
+
+
+def test_replay_fetches_texts_the_content_store_no_longer_holds(main, retrieval, monkeypatch):
+    ranked = [{"pmc_id": "PMC1"}, {"pmc_id": "PMC2"}, {"pmc_id": "PMC3"}]
+    main.article_store.put("PMC1", "stored text")
+    stored = {
+        1: {"type": "article_analysis", "data": {"analysis": {}}},
+        2: {"type": "skipped", "data": {}},
+        3: {"type": "article_analysis", "data": {"analysis": {}}},
+    }
+    restored = main.restore_article_texts(ranked, stored)
+    assert restored[1]["data"]["analysis"]["full_article_text"] == "stored text"
+    assert restored[3]["data"]["analysis"]["full_article_text"] == "text of PMC3"
+    assert restored[2] == {"type": "skipped", "data": {}}
+    assert main.article_store.get_many(["PMC3"]) == {"PMC3": "text of PMC3"}
+
+
+def test_unknown_job_is_an_error(main, retrieval):
+    assert events(main.stream_response(None, job_id="missing")) == [
+        {"type": "error", "data": {"message": "Unknown or expired job missing"}}]
@@ -0,0 +1,75 @@
+import pytest
+
+JOURNALS = {
+    "Journal of Clinical Oncology": 10.5,
+    "Blood": 6.2,
+    "Blood Advances": 2.9,
+    "Leukemia": 4.1,
+    "Leukemia and Lymphoma": 0.9,
+    "Pediatric Blood and Cancer": 1.1,
+    "Cancers": 1.4,
+    "Science": 13.3,
+    "Frontiers in Oncology": 1.2,
+    "Revista Médica de Chile": 0.2,
+    "Journal of Physics (Conference Series)": 0.2,
+}
+
+
+@pytest.fixture(scope="module")
+def index(main):
+    return main.JournalIndex(JOURNALS)
+
+
+@pytest.mark.parametrize("query, title", [
+    ("J Clin Oncol", "Journal of Clinical Oncology"),
+    ("Blood Adv", "Blood Advances"),
+    ("Leuk Lymphoma", "Leukemia and Lymphoma"),
+    ("Pediatr Blood Cancer", "Pediatric Blood and Cancer"),
+    ("Front Oncol", "Frontiers in Oncology"),
+])
+def test_iso_abbreviations_match_their_journal(index, query, title):
+    matched, sjr, score = index.lookup(query)
+    assert (matched, sjr) == (title, JOURNALS[title])
+    assert score >= index.min_score
+
+
+@pytest.mark.parametrize("query, title", [
+    ("JOURNAL OF CLINICAL ONCOLOGY", "Journal of Clinical Oncology"),
+    ("Journal of Clinical Oncology.", "Journal of Clinical Oncology"),
+    ("J. Clin. Oncol.", "Journal of Clinical Oncology"),
+    ("Leukemia & Lymphoma", "Leukemia and Lymphoma"),
+    ("The Journal of Clinical Oncology", "Journal of Clinical Oncology"),
+    ("Revista Medica de Chile", "Revista Médica de Chile"),
+])
+def test_punctuation_case_and_accents_do_not_matter(index, query, title):
+    assert index.lookup(query) == (title, JOURNALS[title], 1.0)
+
+
+@pytest.mark.parametrize("query, title", [
+    ("Cancers (Basel)", "Cancers"),
+    ("Science (New York, N.Y.)", "Science"),
+    ("Front Oncol [Internet]", "Frontiers in Oncology"),
+    ("Journal of Physics (Conference Series)", "Journal of Physics (Conference Series)"),
+])
+def test_parenthesized_qualifiers_are_ignored(index, query, title):
+    matched, sjr, _ = index.lookup(query)
+    assert (matched, sjr) == (title, JOURNALS[title])
+
+
+def test_a_shorter_title_that_starts_like_the_query_is_not_picked(index):
+    assert index.lookup("Blood Adv")[0] == "Blood Advances"
+    assert index.lookup("Leukemia & Lymphoma")[0] == "Leukemia and Lymphoma"
+    assert index.lookup("Blood")[0] == "Blood"
+
+
+@pytest.mark.parametrize("query", ["Nature Medicine", "Oncogene", "", None, "(Basel)"])
+def test_unknown_journals_do_not_match(index, query):
+    matched, sjr, score = index.lookup(query)
+    assert (matched, sjr) == (None, 0)
+    assert score < index.min_score
+
+
+def test_the_highest_ranked_row_wins_for_duplicate_titles(main):
+    index = main.JournalIndex({"Blood": 6.2, "BLOOD": 0.1})
+    assert len(index) == 1
+    assert index.lookup("blood") == ("Blood", 6.2, 1.0)
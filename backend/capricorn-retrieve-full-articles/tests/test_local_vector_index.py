@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import local_vector_index
+
+
+class FakeBigQuery:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def query(self, query):
+        return SimpleNamespace(result=lambda page_size=None: self.rows)
+
+
+@pytest.fixture
+def corpus():
+    rng = np.random.default_rng(1)
+    return rng.normal(size=(400, 8)).astype(np.float32)
+
+
+@pytest.fixture
+def index_dir(tmp_path, corpus):
+    rows = [{"pmc_id": f"PMC{n}", "pmid": str(n), "ml_generate_embedding_result": vector.tolist()}
+            for n, vector in enumerate(corpus)]
+    # A duplicate row and a row of the wrong dimension are both skipped
+    rows.insert(10, {"pmc_id": "PMC3", "pmid": "3", "ml_generate_embedding_result": [0.0] * 8})
+    rows.append({"pmc_id": "PMC_SHORT", "pmid": None, "ml_generate_embedding_result": [0.0] * 4})
+    local_vector_index.export_embeddings(FakeBigQuery(rows), "table", str(tmp_path))
+    local_vector_index.build_index(str(tmp_path), nlist=16, iterations=5)
+    return str(tmp_path)
+
+
+def brute_force(corpus, query, k):
+    distances = np.linalg.norm(corpus - query, axis=1)
+    return [f"PMC{n}" for n in np.argsort(distances)[:k]], np.sort(distances)[:k]
+
+
+def test_export_keeps_one_row_per_pmcid(index_dir):
+    index = local_vector_index.IVFIndex.load(index_dir)
+    assert len(index) == 400
+    assert index.stats() == {"vectors": 400, "dim": 8, "lists": 16, "nprobe": 32}
+
+
+def test_probing_every_list_is_exact(index_dir, corpus):
+    index = local_vector_index.IVFIndex.load(index_dir)
+    query = corpus[7] + 0.01
+    expected_ids, expected_distances = brute_force(corpus, query, 10)
+
+    hits = index.search(query, k=10, nprobe=16)
+
+    assert [hit["pmc_id"] for hit in hits] == expected_ids
+    assert np.allclose([hit["distance"] for hit in hits], expected_distances, atol=1e-4)
+    assert hits == index.exact_search(query, k=10)
+    assert hits[0]["pmid"] == "7"
+
+
+def test_few_probes_still_find_the_nearest_vector(index_dir, corpus):
+    index = local_vector_index.IVFIndex.load(index_dir, nprobe=2)
+    for row in (0, 50, 399):
+        assert index.search(corpus[row], k=1)[0]["pmc_id"] == f"PMC{row}"
+
+
+def test_results_are_distinct_pmcids():
+    # Two rows for the same article in one list: only the closer one is returned
+    vectors = np.array([[0.0, 0.0], [0.1, 0.0], [0.2, 0.0], [5.0, 5.0]], dtype=np.float32)
+    index = local_vector_index.IVFIndex(
+        centroids=np.array([[0.0, 0.0]], dtype=np.float32), offsets=np.array([0, 4]), vectors=vectors,
+        norms=np.einsum('ij,ij->i', vectors, vectors),
+        pmc_ids=np.array([b"PMC1", b"PMC1", b"PMC2", b"PMC3"]), pmids=np.array([b"1", b"1", b"", b"3"]))
+    hits = index.search([0.0, 0.0], k=3)
+    assert [(hit["pmc_id"], hit["pmid"]) for hit in hits] == [("PMC1", "1"), ("PMC2", None), ("PMC3", "3")]
+
+
+def test_benchmark_reports_full_recall_at_full_nprobe(index_dir):
+    report = local_vector_index.benchmark(local_vector_index.IVFIndex.load(index_dir), num_queries=10, k=5,
+                                          nprobes=(1, 16))
+    recalls = [entry["recall_at_k"] for entry in report["ivf"]]
+    assert recalls[-1] == 1.0
+    assert recalls[0] <= recalls[-1]
@@ -0,0 +1,175 @@
+import threading
+
+import pytest
+
+from cancellation import CancellationToken, Cancelled
+
+QUOTA_ERROR = RuntimeError("429 RESOURCE_EXHAUSTED. Quota exceeded")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(main, monkeypatch):
+    # Cooldowns take their upper bound instead of a random point in [backoff / 2, backoff]
+    monkeypatch.setattr(main.random, "uniform", lambda low, high: high)
+    return FakeClock()
+
+
+def controller(main, clock, **kwargs):
+    return main.AdaptiveRateController(clock=clock, **kwargs)
+
+
+def succeed(rate, times=1):
+    for _ in range(times):
+        rate._acquire(float("inf"))
+        rate._release("success")
+
+
+def test_successes_grow_the_limit_additively(main, clock):
+    rate = controller(main, clock, initial_limit=4, max_limit=16)
+    succeed(rate)
+    assert rate.limit == pytest.approx(4.25)
+    # About +1 per window of `limit` successes
+    succeed(rate, 3)
+    assert 4.9 < rate.limit < 5.0
+    succeed(rate, 500)
+    assert rate.limit == 16
+    assert rate.stats()["successful_calls"] == 504
+
+
+def test_a_429_halves_the_limit_and_opens_a_cooldown(main, clock):
+    rate = controller(main, clock, initial_limit=8, base_backoff=5.0)
+    rate._acquire(float("inf"))
+    rate._release("throttled")
+    assert rate.limit == 4
+    assert rate.stats()["cooldown_remaining_s"] == 5.0
+    assert rate.stats()["throttled_calls"] == 1
+
+
+def test_429s_during_the_cooldown_decrease_the_limit_once(main, clock):
+    rate = controller(main, clock, initial_limit=8, base_backoff=5.0)
+    for _ in range(3):
+        rate._acquire(float("inf"))
+    # Every call that was in flight reports the same congestion event
+    for _ in range(3):
+        rate._release("throttled")
+        clock.now += 1
+    assert rate.limit == 4
+    assert rate.stats()["throttled_calls"] == 3
+
+    # A 429 after the cooldown is a new event: the limit halves again and the backoff doubles
+    clock.now += 5
+    rate._acquire(float("inf"))
+    rate._release("throttled")
+    assert rate.limit == 2
+    assert rate.stats()["cooldown_remaining_s"] == 10.0
+
+
+def test_no_permits_are_granted_during_the_cooldown(main, clock):
+    rate = controller(main, clock, initial_limit=4, base_backoff=5.0)
+    rate._acquire(float("inf"))
+    rate._release("throttled")
+    with pytest.raises(main.RateLimitExceeded):
+        rate._acquire(clock.now)
+    assert rate.stats()["in_flight"] == 0
+    clock.now += 5
+    rate._acquire(clock.now + 1)
+    assert rate.stats()["in_flight"] == 1
+
+
+def test_the_limit_never_goes_below_the_floor(main, clock):
+    rate = controller(main, clock, initial_limit=4, min_limit=1, max_backoff=60.0)
+    for _ in range(10):
+        clock.now += 61
+        rate._acquire(float("inf"))
+        rate._release("throttled")
+    assert rate.limit == 1
+    # The backoff is capped too
+    assert rate.stats()["cooldown_remaining_s"] == 60.0
+    # At the floor one call at a time still gets through
+    clock.now += 61
+    rate._acquire(clock.now + 1)
+    assert rate.stats()["in_flight"] == 1
+
+
+def test_a_success_resets_the_backoff(main, clock):
+    rate = controller(main, clock, initial_limit=8, base_backoff=5.0)
+    for _ in range(2):
+        rate._acquire(float("inf"))
+        rate._release("throttled")
+        clock.now += 20
+    succeed(rate)
+    rate._acquire(float("inf"))
+    rate._release("throttled")
+    assert rate.stats()["cooldown_remaining_s"] == 5.0
+
+
+def test_call_retries_a_429_and_adapts(main):
+    rate = main.AdaptiveRateController(initial_limit=4, base_backoff=0)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise QUOTA_ERROR
+        return "ok"
+
+    assert rate.call(flaky) == "ok"
+    assert len(attempts) == 2
+    assert rate.limit == pytest.approx(2.5)
+    stats = rate.stats()
+    assert (stats["throttled_calls"], stats["successful_calls"], stats["in_flight"]) == (1, 1, 0)
+
+
+def test_other_errors_release_the_permit_without_adapting(main):
+    rate = main.AdaptiveRateController(initial_limit=4)
+    with pytest.raises(ValueError):
+        rate.call(lambda: (_ for _ in ()).throw(ValueError("bad request")))
+    assert rate.limit == 4
+    assert rate.stats()["in_flight"] == 0
+
+
+def test_a_cancelled_waiter_does_not_hold_a_slot(main, clock):
+    rate = controller(main, clock, initial_limit=1, max_limit=1)
+    rate._acquire(float("inf"))
+    token = CancellationToken()
+    token.cancel()
+    with pytest.raises(Cancelled):
+        rate.call(lambda: pytest.fail("cancelled call must not run"), cancel=token, estimated_tokens=500)
+    stats = rate.stats()
+    assert (stats["in_flight"], stats["queue_depth"], stats["cancelled_waits"]) == (1, 0, 1)
+    assert token.stats()["avoided_calls"] == 1
+
+    # The only slot goes to the next caller once the holder releases it
+    rate._release("success")
+    assert rate.call(lambda: "next") == "next"
+    assert rate.stats()["in_flight"] == 0
+
+
+def test_a_waiter_cancelled_while_queued_leaves_the_queue(main, monkeypatch):
+    monkeypatch.setattr(main, "CANCEL_POLL_SECONDS", 0.01)
+    rate = main.AdaptiveRateController(initial_limit=1, max_limit=1)
+    rate._acquire(float("inf"))
+    token = CancellationToken()
+    failed = []
+
+    def wait():
+        try:
+            rate.call(lambda: None, cancel=token)
+        except Cancelled:
+            failed.append(True)
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    token.cancel()
+    waiter.join(5)
+    assert failed == [True]
+    stats = rate.stats()
+    assert (stats["in_flight"], stats["queue_depth"]) == (1, 0)
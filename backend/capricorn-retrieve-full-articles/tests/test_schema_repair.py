@@ -0,0 +1,97 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+
+def complete_metadata(**overrides):
+    metadata = {
+        "title": "Crizotinib in ALK-mutant neuroblastoma", "year": "2021", "journal_title": "J Clin Oncol",
+        "cancer_focus": True, "pediatric_focus": True, "type_of_cancer": "neuroblastoma", "disease_match": True,
+        "paper_type": "clinical trial", "actionable_events": [{"event": "ALK F1174L", "matches_query": True}],
+        "drugs_tested": True, "drug_results": ["partial response"], "treatment_shown": True, "cell_studies": False,
+        "mice_studies": False, "case_report": False, "series_of_case_reports": False, "clinical_study": True,
+        "clinical_study_on_children": True, "novelty": False,
+    }
+    metadata.update(overrides)
+    return metadata
+
+
+class FakeModels:
+    """Streams one canned analysis and answers repair calls with a canned object."""
+
+    def __init__(self, metadata, repair=None):
+        self.analysis = json.dumps({"article_metadata": metadata})
+        self.repair = repair
+        self.repair_requests = []
+
+    def generate_content_stream(self, model, contents, config):
+        part = SimpleNamespace(text=self.analysis)
+        yield SimpleNamespace(text=self.analysis, usage_metadata=None,
+                              candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+    def generate_content(self, model, contents, config):
+        self.repair_requests.append(sorted(config.response_schema["properties"]))
+        return SimpleNamespace(text=json.dumps(self.repair or {}), usage_metadata=None)
+
+
+@pytest.fixture
+def gemini(main, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "analysis_cache", main.AnalysisCache(str(tmp_path / "cache.sqlite")))
+
+    def install(metadata, repair=None):
+        models = FakeModels(metadata, repair)
+        monkeypatch.setattr(main, "client", SimpleNamespace(models=models))
+        return models
+    return install
+
+
+def test_matches_schema_is_strict(main):
+    number = {"type": "NUMBER"}
+    events = main.ARTICLE_METADATA_PROPERTIES["actionable_events"]
+    assert main.matches_schema(1.5, number)
+    assert not main.matches_schema(True, number)
+    assert not main.matches_schema("2021", {"type": "BOOLEAN"})
+    assert main.matches_schema([{"event": "ALK", "matches_query": False}], events)
+    assert not main.matches_schema([{"event": "ALK"}], events)
+    assert not main.matches_schema([{"event": "ALK", "matches_query": "yes"}], events)
+
+
+def test_invalid_fields_lists_missing_and_mistyped(main):
+    metadata = complete_metadata(year=2021)
+    del metadata["novelty"]
+    assert main.invalid_article_fields(complete_metadata()) == []
+    assert sorted(main.invalid_article_fields(metadata)) == ["novelty", "year"]
+
+
+def test_valid_first_pass_makes_no_repair_call(main, gemini):
+    models = gemini(complete_metadata())
+    analysis = main.analyze_with_gemini("Article text", "PMC1")
+    assert analysis["article_metadata"]["PMCID"] == "PMC1"
+    assert models.repair_requests == []
+
+
+def test_only_failing_fields_are_repaired(main, gemini):
+    metadata = complete_metadata(year=2021)
+    del metadata["novelty"]
+    models = gemini(metadata, repair={"year": "2021", "novelty": True})
+
+    analysis = main.analyze_with_gemini("Article text", "PMC1")
+
+    assert models.repair_requests == [["novelty", "year"]]
+    assert analysis["article_metadata"]["year"] == "2021"
+    assert analysis["article_metadata"]["novelty"] is True
+    assert analysis["article_metadata"]["title"] == "Crizotinib in ALK-mutant neuroblastoma"
+
+
+def test_unrepaired_optional_field_is_dropped(main, gemini):
+    gemini(complete_metadata(novelty="maybe"), repair={})
+    analysis = main.analyze_with_gemini("Article text", "PMC1")
+    assert "novelty" not in analysis["article_metadata"]
+
+
+def test_unrepaired_required_field_fails_the_article(main, gemini):
+    metadata = complete_metadata()
+    del metadata["type_of_cancer"]
+    gemini(metadata, repair={})
+    assert main.analyze_with_gemini("Article text", "PMC1") is None
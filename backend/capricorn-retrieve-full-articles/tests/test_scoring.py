@@ -0,0 +1,109 @@
+import math
+import os
+import random
+from datetime import datetime
+
+import pytest
+
+import scoring
+
+
+def reference_points(metadata):
+    """calculate_points as it was before scoring profiles, kept to pin the default profile."""
+    points = 0
+    breakdown = {}
+    if metadata.get('journal_title') and metadata.get('journal_sjr'):
+        sjr = float(metadata['journal_sjr'])
+        if sjr > 0:
+            impact_points = min(math.log(sjr + 1) * 5, 25)
+            points += impact_points
+            breakdown['journal_impact'] = impact_points
+    if metadata.get('year'):
+        try:
+            year_points = -5 * (datetime.now().year - int(metadata.get('year')))
+            points += year_points
+            breakdown['year'] = year_points
+        except (ValueError, TypeError):
+            pass
+    if metadata.get('disease_match'):
+        points += 50
+        breakdown['disease_match'] = 50
+    if metadata.get('pediatric_focus'):
+        points += 20
+        breakdown['pediatric_focus'] = 20
+    paper_type = metadata.get('paper_type', '').lower()
+    if 'clinical trial' in paper_type:
+        points += 40
+        breakdown['paper_type'] = 40
+    elif 'review' in paper_type:
+        points -= 5
+        breakdown['paper_type'] = -5
+    matched_events = sum(1 for event in metadata.get('actionable_events', []) if event.get('matches_query', False))
+    if matched_events > 0:
+        points += matched_events * 15
+        breakdown['actionable_events'] = matched_events * 15
+    for name, value in [('drugs_tested', 5), ('treatment_shown', 50), ('cell_studies', 5), ('mice_studies', 10),
+                        ('case_report', 5), ('series_of_case_reports', 10), ('clinical_study', 15),
+                        ('clinical_study_on_children', 20), ('novelty', 10)]:
+        if metadata.get(name):
+            points += value
+            breakdown[name] = value
+    return points, breakdown
+
+
+def random_metadata(rng):
+    metadata = {name: rng.random() < 0.5 for name in scoring.BOOLEAN_FEATURES}
+    metadata.update({
+        "journal_title": rng.choice(["", "Blood", "J Clin Oncol"]),
+        "journal_sjr": rng.choice([None, 0, 0.4, 3.2, 20000]),
+        "year": rng.choice(["", "2009", "2023", "n.d.", str(datetime.now().year)]),
+        "paper_type": rng.choice(["", "Clinical Trial", "Systematic review", "case report"]),
+        "actionable_events": [{"event": "ALK", "matches_query": rng.random() < 0.5} for _ in range(rng.randrange(4))],
+    })
+    return metadata
+
+
+def test_default_profile_matches_the_original_calculate_points():
+    rng = random.Random(0)
+    metadatas = [random_metadata(rng) for _ in range(500)]
+    for metadata, (points, breakdown) in zip(metadatas, scoring.score_batch(metadatas)):
+        expected_points, expected_breakdown = reference_points(metadata)
+        assert points == pytest.approx(expected_points)
+        assert breakdown == pytest.approx(expected_breakdown)
+
+
+def test_main_scores_new_analyses_with_the_default_profile(main):
+    metadata = random_metadata(random.Random(1))
+    assert main.calculate_points(metadata) == scoring.score_batch([metadata])[0]
+
+
+def test_overrides_change_the_score_and_the_profile_id():
+    metadata = {"disease_match": True, "novelty": True}
+    profile = scoring.resolve_profile({"weights": {"novelty": 30}})
+    assert scoring.score_batch([metadata], profile)[0] == (80, {"disease_match": 50, "novelty": 30})
+    assert scoring.profile_id(profile) != scoring.profile_id(scoring.resolve_profile())
+    assert scoring.profile_id(profile) == scoring.profile_id(scoring.resolve_profile({"weights": {"novelty": 30}}))
+    assert scoring.profile_id(profile).startswith("default@1+")
+
+
+def test_reference_year_pins_year_points():
+    profile = scoring.resolve_profile({"reference_year": 2020})
+    assert scoring.score_batch([{"year": "2016"}], profile)[0] == (-20, {"year": -20})
+
+
+@pytest.mark.parametrize("overrides", [
+    {"weights": {"impact_factor": 3}},
+    {"weights": {"novelty": "high"}},
+    {"journal_impact_cap": True},
+])
+def test_invalid_profiles_are_rejected(overrides):
+    with pytest.raises(scoring.ScoringProfileError):
+        scoring.resolve_profile(overrides)
+
+
+def test_rerank_copy_is_identical():
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(here, "scoring.py"), encoding="utf-8") as file:
+        source = file.read()
+    with open(os.path.join(here, "..", "capricorn-rerank-articles", "scoring.py"), encoding="utf-8") as file:
+        assert file.read() == source
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+
+class FakeBigQuery:
+    """Records queries and answers the vector search with fixed rows."""
+
+    def __init__(self, hits=20):
+        self.queries = []
+        self.hits = hits
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        rows = [{"pmc_id": f"PMC{n}", "pmid": str(n), "distance": n / 100,
+                 "query_embedding": [0.25, 0.5] if n == 0 else []}
+                for n in range(self.hits)]
+        return type("Job", (), {"result": lambda self, **kwargs: rows})()
+
+
+@pytest.fixture
+def search(main, monkeypatch):
+    bq = FakeBigQuery()
+    monkeypatch.setattr(main, "bq_client", bq)
+    monkeypatch.setattr(main, "local_index", None)
+    monkeypatch.setattr(main, "PMC_EMBEDDING_TABLE", None)
+    monkeypatch.setattr(main, "embedding_cache", main.TTLCache())
+    monkeypatch.setattr(main, "search_cache", main.TTLCache())
+    return bq
+
+
+def test_ttl_cache_is_a_bounded_lru(main):
+    cache = main.TTLCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats() == {"hits": 3, "misses": 1, "entries": 2}
+
+
+def test_ttl_cache_expires_entries(main):
+    cache = main.TTLCache(ttl_seconds=0.05)
+    cache.put("a", 1)
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_query_key_ignores_case_and_whitespace(main):
+    key = main.query_cache_key("MYCN amplification\nALK F1174L", "Neuroblastoma")
+    assert key == main.query_cache_key("mycn  amplification\n alk f1174l ", "neuroblastoma")
+    assert key != main.query_cache_key("MYCN amplification\nALK F1174L", "Ewing sarcoma")
+
+
+def test_smaller_request_is_sliced_from_the_cached_ranking(main, search):
+    first = main.search_article_ids("MYCN amplification", num_articles=10, disease="neuroblastoma")
+    second = main.search_article_ids("mycn amplification", num_articles=5, disease="Neuroblastoma")
+
+    assert len(search.queries) == 1
+    assert [hit["pmc_id"] for hit in second] == [hit["pmc_id"] for hit in first[:5]]
+
+
+def test_larger_request_reuses_the_cached_embedding(main, search):
+    main.search_article_ids("MYCN amplification", num_articles=5)
+    main.search_article_ids("MYCN amplification", num_articles=10)
+
+    assert len(search.queries) == 2
+    assert "ML.GENERATE_EMBEDDING" in search.queries[0]
+    # The second search inlines the embedding returned by the first instead of regenerating it
+    assert "ML.GENERATE_EMBEDDING" not in search.queries[1]
+    assert "DEFAULT [0.25, 0.5]" in search.queries[1]
@@ -69,12 +69,6 @@ The patient's disease is: {disease}
 
 The patient's actionable events are: {events}
 
-Journal Impact Data (SJR scores):
-The following is a list of journal titles and their SJR scores. When extracting the journal title from the article, find the best matching title from this list and use its SJR score. If no match is found, use 0 as the SJR score.
-
-Journal Titles and Scores:
-{journal_context}
-
 <Article>
 {article_text}
 </Article>
@@ -123,8 +117,7 @@ Please analyze the article and provide a JSON response with the following struct
 {
   "article_metadata": {
     "title": "...",
-    "journal_title": "...",  // Extract the journal title from the article
-    "journal_sjr": 0,        // Look up the SJR score from the provided list. Use the score of the best matching journal title, or 0 if no match found
+    "journal_title": "...",  // Extract the full journal title from the article
     "year": "...",
     "cancer_focus": true/false,
     "pediatric_focus": true/false,